@@ -0,0 +1,102 @@
+import os
+import json
+
+
+def write_json_atomically(data, filepath):
+    """ Write to a temporary file first so a crash never leaves half a file """
+    tmp_filepath = f'{filepath}.tmp'
+    with open(tmp_filepath, 'w') as f:
+        json.dump(data, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_filepath, filepath)
+
+
+def max_revision_id(*revision_ids):
+    revision_ids = [int(r) for r in revision_ids if r]
+    return str(max(revision_ids)) if revision_ids else None
+
+
+def max_timestamp(*timestamps):
+    timestamps = [t for t in timestamps if t]
+    return max(timestamps) if timestamps else None
+
+
+class IdentifyCheckpoint():
+    """
+    Progress of an identify run over one dump (byte offset of the last
+    completed shard, last revision id, output size) and the high-water
+    mark of the last completed run, persisted as JSON.
+    """
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.state = self.load()
+
+    def load(self):
+        if not os.path.exists(self.filepath):
+            return {}
+
+        with open(self.filepath) as f:
+            return json.load(f)
+
+    def save(self):
+        write_json_atomically(data=self.state, filepath=self.filepath)
+
+    @property
+    def byte_offset(self):
+        return self.state.get('byte_offset')
+
+    @property
+    def last_revision_id(self):
+        return self.state.get('last_revision_id')
+
+    @property
+    def output_size(self):
+        return self.state.get('output_size', 0)
+
+    @property
+    def high_water_mark(self):
+        return self.state.get('high_water_mark', {})
+
+    def is_resumable(self, input_file, input_size):
+        return self.state.get('input_file') == input_file and \
+            self.state.get('input_size') == input_size and \
+            not self.state.get('completed', True)
+
+    def start_run(self, input_file, input_size, output_size):
+        self.state.update({
+            'input_file': input_file,
+            'input_size': input_size,
+            'byte_offset': None,
+            'last_revision_id': None,
+            'output_size': output_size,
+            'run_max_revision_id': None,
+            'run_max_timestamp': None,
+            'completed': False
+        })
+
+    def update(self, byte_offset, shard_result, output_size):
+        self.state.update({
+            'byte_offset': byte_offset,
+            'last_revision_id':
+                shard_result.last_revision_id or self.last_revision_id,
+            'output_size': output_size,
+            'run_max_revision_id': max_revision_id(
+                self.state.get('run_max_revision_id'),
+                shard_result.max_revision_id),
+            'run_max_timestamp': max_timestamp(
+                self.state.get('run_max_timestamp'),
+                shard_result.max_timestamp)
+        })
+
+    def complete(self):
+        self.state['high_water_mark'] = {
+            'revision_id': max_revision_id(
+                self.high_water_mark.get('revision_id'),
+                self.state.get('run_max_revision_id')),
+            'timestamp': max_timestamp(
+                self.high_water_mark.get('timestamp'),
+                self.state.get('run_max_timestamp'))
+        }
+        self.state['completed'] = True
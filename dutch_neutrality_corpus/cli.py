@@ -0,0 +1,591 @@
+#!/usr/bin/env python3
+import os
+import sys
+import logging
+import argparse
+
+from dutch_neutrality_corpus.pipeline import (
+    Pipeline)
+from dutch_neutrality_corpus.stage import (
+    Stage)
+from dutch_neutrality_corpus.stage_checkpoint import (
+    DEFAULT_CHECKPOINT_SHARD_RECORDS)
+from dutch_neutrality_corpus.profiling import (
+    DEFAULT_PROFILE_INTERVAL)
+from dutch_neutrality_corpus.dump import (
+    PageFilter)
+from dutch_neutrality_corpus.sampling import (
+    ReservoirSampler)
+from dutch_neutrality_corpus.io import (
+    LoadJSONFileStage,
+    LoadCSVFileStage,
+    LoadXMLFileStage,
+    LoadShardedXMLFileStage,
+    ScanXMLFileStage,
+    ResumableXMLFileStage,
+    SaveIterableToJSONStage)
+from dutch_neutrality_corpus.dataset.identify import (
+    apply_npov_identification)
+from dutch_neutrality_corpus.dataset.ratelimit import (
+    DEFAULT_MAX_RETRIES,
+    DEFAULT_REQUESTS_PER_SECOND,
+    FailedRevisionLog)
+from dutch_neutrality_corpus.dataset.cache import (
+    DEFAULT_CACHE_MAX_SIZE)
+from dutch_neutrality_corpus.dataset.retrieve import (
+    retrieve_single_revision,
+    AsyncRetrievalStage)
+from dutch_neutrality_corpus.dataset.compact import (
+    apply_compaction)
+from dutch_neutrality_corpus.dataset.categories import (
+    apply_category_filter)
+from dutch_neutrality_corpus.dataset.diff import (
+    apply_example_extraction)
+from dutch_neutrality_corpus.dataset.doccano import (
+    apply_conversion_to_doccano_format)
+from dutch_neutrality_corpus.dataset.split import (
+    TrainValidationTestSplitStage)
+from dutch_neutrality_corpus.dataset.content import (
+    apply_content_filter)
+
+logging.basicConfig(
+    level='INFO',
+    format='%(asctime)s %(message)s',
+    filename='dwnc.log')
+
+RETRIEVAL_PIPELINES = ('retrieve', 'end_to_end')
+
+
+def parse_stage_workers(values):
+    """ Map function names to worker counts from FUNC=N arguments """
+    stage_workers = {}
+    for value in values:
+        func_name, _, n = value.partition('=')
+        if not func_name or not n.isdigit() or not int(n):
+            raise ValueError(f'--stage-workers expects FUNC=N, got {value}')
+        stage_workers[func_name] = int(n)
+    return stage_workers
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Process wiki meta history dump.')
+    parser.add_argument('--pipeline-name',
+                        type=str,
+                        required=True,
+                        help=('pipeline: (identify, retrieve, compact, '
+                              'diff, split, prepare_doccano, or '
+                              'end_to_end for identify to diff at once)'))
+    parser.add_argument('--input-file',
+                        type=str,
+                        required=True,
+                        help=('filepath to revision text file, Spark CSV '
+                              'output directory or dump (.xml, .xml.gz, '
+                              '.xml.bz2, multistream bz2)'))
+    parser.add_argument('--index-file',
+                        type=str,
+                        required=False,
+                        default=None,
+                        help=('multistream index for parallel bz2 '
+                              'decompression (default: next to dump)'))
+    parser.add_argument('--output-file',
+                        type=str,
+                        required=False,
+                        default='data/revisions_processed_text.json',
+                        help='filepath for processed text')
+    parser.add_argument('--n_revisions',
+                        default=None,
+                        help='max number of revisions for "identify"')
+    parser.add_argument('--sample',
+                        type=str,
+                        default='first',
+                        choices=['first', 'uniform', 'stratified'],
+                        help=('how --n_revisions are selected: first N, '
+                              'or a seeded reservoir sample in one pass'))
+    parser.add_argument('--seed',
+                        type=int,
+                        default=None,
+                        help='random seed for --sample')
+    parser.add_argument('--stratify-by',
+                        type=str,
+                        default=None,
+                        help=('field to stratify on, with at most 100 '
+                              'distinct values, e.g. timestamp together '
+                              'with --stratify-prefix 4'))
+    parser.add_argument('--stratify-prefix',
+                        type=int,
+                        default=None,
+                        help=('stratify on the first characters of the '
+                              'field, e.g. 4 for the year of a timestamp'))
+    parser.add_argument('--n-shards',
+                        type=int,
+                        default=None,
+                        help=('parse an uncompressed dump as this many '
+                              'page-aligned shards in parallel ("identify")'))
+    parser.add_argument('--xml-reader',
+                        type=str,
+                        default='iterparse',
+                        choices=['iterparse', 'scan'],
+                        help=('"scan" memory-maps an uncompressed dump '
+                              'instead of parsing XML ("identify")'))
+    parser.add_argument('--namespaces',
+                        type=int,
+                        nargs='+',
+                        default=None,
+                        help='only read pages in these namespaces, e.g. 0')
+    parser.add_argument('--title-regex',
+                        type=str,
+                        default=None,
+                        help='only read pages whose title matches')
+    parser.add_argument('--start-date',
+                        type=str,
+                        default=None,
+                        help='only read revisions from this date on')
+    parser.add_argument('--end-date',
+                        type=str,
+                        default=None,
+                        help='only read revisions before this date')
+    parser.add_argument('--checkpoint-file',
+                        type=str,
+                        default=None,
+                        help=('resumable "identify": checkpoint progress '
+                              'here and append JSONL to --output-file'))
+    parser.add_argument('--delta',
+                        type=str,
+                        default=None,
+                        choices=['revision_id', 'timestamp'],
+                        help=('with --checkpoint-file, only classify '
+                              'revisions newer than the last run'))
+    parser.add_argument('--retrieve-backend',
+                        type=str,
+                        default='async',
+                        choices=['async', 'threads', 'processes'],
+                        help=('"retrieve" on one event loop with pooled '
+                              'connections, a thread pool of '
+                              '--max-in-flight threads, or a process pool'))
+    parser.add_argument('--max-in-flight',
+                        type=int,
+                        default=64,
+                        help='max concurrent requests for async "retrieve"')
+    parser.add_argument('--per-host-limit',
+                        type=int,
+                        default=16,
+                        help='max connections per host for async "retrieve"')
+    parser.add_argument('--requests-per-second',
+                        type=float,
+                        default=DEFAULT_REQUESTS_PER_SECOND,
+                        help='sustained request rate for "retrieve"')
+    parser.add_argument('--max-retries',
+                        type=int,
+                        default=DEFAULT_MAX_RETRIES,
+                        help='retries per revision for "retrieve"')
+    parser.add_argument('--failed-file',
+                        type=str,
+                        default=None,
+                        help=('CSV of revisions "retrieve" gave up on, '
+                              'usable as --input-file later (default: '
+                              'next to --output-file)'))
+    parser.add_argument('--cache-file',
+                        type=str,
+                        default=None,
+                        help=('SQLite cache of fetched revisions for '
+                              '"retrieve" (default: next to --output-file)'))
+    parser.add_argument('--cache-max-mb',
+                        type=int,
+                        default=DEFAULT_CACHE_MAX_SIZE >> 20,
+                        help='evict cached revisions beyond this size')
+    parser.add_argument('--no-cache',
+                        action='store_true',
+                        help='always fetch revisions from the network')
+    parser.add_argument('--keep-html',
+                        action='store_true',
+                        help=('"retrieve" full pages instead of only diff '
+                              'cells and category titles'))
+    parser.add_argument('--n-workers',
+                        type=int,
+                        default=None,
+                        help='number of worker processes (default: all cores)')
+    parser.add_argument('--stage-workers',
+                        type=str,
+                        nargs='+',
+                        default=[],
+                        metavar='FUNC=N',
+                        help=('workers for single stages by function, e.g. '
+                              'apply_example_extraction=2'))
+    parser.add_argument('--concurrent-stages',
+                        action='store_true',
+                        help=('run every stage on its own thread with '
+                              'bounded queues in between, so e.g. retrieve '
+                              'and diff overlap'))
+    parser.add_argument('--stage-checkpoint-dir',
+                        type=str,
+                        default=None,
+                        help=('keep the output of every stage per record '
+                              'here, and reuse unchanged outputs on later '
+                              'runs'))
+    parser.add_argument('--checkpoint-shard-size',
+                        type=int,
+                        default=DEFAULT_CHECKPOINT_SHARD_RECORDS,
+                        help='records per --stage-checkpoint-dir shard')
+    parser.add_argument('--report-file',
+                        type=str,
+                        default=None,
+                        help=('JSON report of per-stage timings, counts, '
+                              'memory and IPC volume (default: next to '
+                              '--output-file)'))
+    parser.add_argument('--profile',
+                        action='store_true',
+                        help=('sample stacks in worker processes and write '
+                              'folded stacks per stage for flame graphs'))
+    parser.add_argument('--profile-dir',
+                        type=str,
+                        default=None,
+                        help=('directory for --profile output (default: '
+                              'next to --output-file)'))
+    parser.add_argument('--profile-interval',
+                        type=float,
+                        default=DEFAULT_PROFILE_INTERVAL,
+                        help='seconds between --profile samples')
+    parser.add_argument('--item-timeout',
+                        type=float,
+                        default=None,
+                        help=('seconds "diff" may spend on one revision '
+                              'before it is quarantined'))
+    parser.add_argument('--quarantine-file',
+                        type=str,
+                        default=None,
+                        help=('CSV of revisions over --item-timeout, usable '
+                              'as --input-file later (default: next to '
+                              '--output-file)'))
+    parser.add_argument('--max-tasks-per-worker',
+                        type=int,
+                        default=None,
+                        help=('replace "diff" worker processes after this '
+                              'many tasks to cap memory growth'))
+
+    args = parser.parse_args()
+    pipeline_name = str(args.pipeline_name)
+    input_file = str(args.input_file)
+    output_file = str(args.output_file)
+    index_file = args.index_file
+    n_shards = args.n_shards
+    xml_reader = args.xml_reader
+    checkpoint_file = args.checkpoint_file
+    delta = args.delta
+    page_filter = PageFilter(
+        namespaces=args.namespaces,
+        title_regex=args.title_regex,
+        start_timestamp=args.start_date,
+        end_timestamp=args.end_date)
+    n_workers = args.n_workers
+
+    try:
+        stage_workers = parse_stage_workers(args.stage_workers)
+    except ValueError as e:
+        parser.error(str(e))
+
+    def get_n_workers(func, default=n_workers):
+        return stage_workers.get(func.__name__, default)
+
+    n_revisions = None
+    if args.n_revisions:
+        n_revisions = int(args.n_revisions)
+
+    sampler = None
+    if args.sample != 'first':
+        if not n_revisions:
+            parser.error('--sample requires --n_revisions')
+        if args.sample == 'stratified' and not args.stratify_by:
+            parser.error('--sample stratified requires --stratify-by')
+        if pipeline_name == 'identify' and \
+                (n_shards or checkpoint_file or xml_reader != 'iterparse'):
+            parser.error('--sample requires the default "identify" reader')
+
+        stratify_by = None
+        if args.sample == 'stratified':
+            stratify_by = args.stratify_by
+
+        sampler = ReservoirSampler(
+            n_items=n_revisions,
+            seed=args.seed,
+            stratify_by=stratify_by,
+            stratify_prefix=args.stratify_prefix)
+
+    failed_file = args.failed_file
+    if pipeline_name in RETRIEVAL_PIPELINES:
+        failed_file = failed_file or \
+            f'{os.path.splitext(output_file)[0]}_failed.csv'
+        FailedRevisionLog(failed_file)
+
+    quarantine_file = None
+    if args.item_timeout is not None:
+        quarantine_file = args.quarantine_file or \
+            f'{os.path.splitext(output_file)[0]}_quarantine.csv'
+
+    cache_file = None
+    cache_max_size = args.cache_max_mb << 20
+    if pipeline_name in RETRIEVAL_PIPELINES and not args.no_cache:
+        cache_file = args.cache_file or os.path.join(
+            os.path.dirname(output_file), 'revision_cache.sqlite')
+
+    # Later stages only read the diff cells and category links
+    compaction_stages = []
+    if not args.keep_html:
+        compaction_stages = [
+            Stage(
+                func=apply_compaction,
+                n_workers=get_n_workers(apply_compaction))
+        ]
+
+    if pipeline_name == 'identify' and checkpoint_file:
+        stages = [
+            ResumableXMLFileStage(
+                filepath=input_file,
+                output_filepath=output_file,
+                checkpoint_filepath=checkpoint_file,
+                func=apply_npov_identification,
+                delta_by=delta,
+                n_workers=n_workers,
+                page_filter=page_filter
+            )
+        ]
+
+    elif pipeline_name == 'identify' and n_shards:
+        stages = [
+            LoadShardedXMLFileStage(
+                filepath=input_file,
+                func=apply_npov_identification,
+                n_revisions=n_revisions,
+                n_shards=n_shards,
+                n_workers=n_workers,
+                page_filter=page_filter
+            ),
+            SaveIterableToJSONStage(filepath=output_file)
+        ]
+
+    elif pipeline_name == 'identify' and xml_reader == 'scan':
+        stages = [
+            ScanXMLFileStage(
+                filepath=input_file,
+                n_revisions=n_revisions,
+                func=apply_npov_identification,
+                page_filter=page_filter
+            ),
+            SaveIterableToJSONStage(filepath=output_file)
+        ]
+
+    elif pipeline_name == 'identify':
+        stages = [
+            LoadXMLFileStage(
+                filepath=input_file,
+                n_revisions=n_revisions,
+                index_filepath=index_file,
+                func=apply_npov_identification,
+                page_filter=page_filter,
+                sampler=sampler
+            ),
+            SaveIterableToJSONStage(filepath=output_file)
+        ]
+
+    elif pipeline_name == 'retrieve' and \
+            args.retrieve_backend == 'async':
+        stages = [
+            LoadCSVFileStage(
+                filepath=input_file,
+                select_fields=['revision_id'],
+                n_revisions=n_revisions,
+                sampler=sampler
+            ),
+            AsyncRetrievalStage(
+                max_in_flight=args.max_in_flight,
+                per_host_limit=args.per_host_limit,
+                requests_per_second=args.requests_per_second,
+                max_retries=args.max_retries,
+                failed_filepath=failed_file,
+                cache_filepath=cache_file,
+                cache_max_size=cache_max_size),
+            *compaction_stages,
+            SaveIterableToJSONStage(
+                filepath=output_file,
+                write_as_array=False)
+        ]
+
+    elif pipeline_name == 'retrieve':
+        executor = args.retrieve_backend
+        retrieve_workers = get_n_workers(
+            retrieve_single_revision,
+            default=args.max_in_flight if executor == 'threads' else n_workers)
+
+        # Threads share one rate limiter, processes pace their own share
+        requests_per_second = args.requests_per_second
+        if executor == 'processes':
+            requests_per_second /= (retrieve_workers or os.cpu_count())
+
+        stages = [
+            LoadCSVFileStage(
+                filepath=input_file,
+                select_fields=['revision_id'],
+                n_revisions=n_revisions,
+                sampler=sampler
+            ),
+            Stage(
+                func=retrieve_single_revision,
+                n_workers=retrieve_workers,
+                executor=executor,
+                filter_collection=True,
+                func_kwargs={
+                    'requests_per_second': requests_per_second,
+                    'max_retries': args.max_retries,
+                    'failed_filepath': failed_file,
+                    'cache_filepath': cache_file,
+                    'cache_max_size': cache_max_size
+                }),
+            *compaction_stages,
+            SaveIterableToJSONStage(
+                filepath=output_file,
+                write_as_array=False)
+        ]
+
+    elif pipeline_name == 'compact':
+        stages = [
+            LoadJSONFileStage(
+                filepath=input_file,
+                n_revisions=n_revisions,
+                sampler=sampler
+            ),
+            *compaction_stages,
+            SaveIterableToJSONStage(
+                filepath=output_file,
+                write_as_array=False)
+        ]
+
+    elif pipeline_name == 'diff':
+        stages = [
+            LoadJSONFileStage(
+                filepath=input_file,
+                n_revisions=n_revisions,
+                sampler=sampler
+            ),
+            Stage(
+                func=apply_category_filter,
+                n_workers=get_n_workers(apply_category_filter),
+                filter_collection=True,
+                max_tasks_per_worker=args.max_tasks_per_worker),
+            Stage(
+                func=apply_example_extraction,
+                n_workers=get_n_workers(apply_example_extraction),
+                filter_collection=True,
+                flatten=True,
+                timeout=args.item_timeout,
+                quarantine_filepath=quarantine_file,
+                max_tasks_per_worker=args.max_tasks_per_worker),
+            Stage(
+                func=apply_content_filter,
+                n_workers=get_n_workers(apply_content_filter),
+                filter_collection=True,
+                max_tasks_per_worker=args.max_tasks_per_worker),
+            SaveIterableToJSONStage(
+                filepath=output_file,
+                write_as_array=False)
+        ]
+
+    elif pipeline_name == 'end_to_end':
+        stages = [
+            LoadXMLFileStage(
+                filepath=input_file,
+                n_revisions=n_revisions,
+                index_filepath=index_file,
+                func=apply_npov_identification,
+                page_filter=page_filter,
+                sampler=sampler
+            ),
+            AsyncRetrievalStage(
+                max_in_flight=args.max_in_flight,
+                per_host_limit=args.per_host_limit,
+                requests_per_second=args.requests_per_second,
+                max_retries=args.max_retries,
+                failed_filepath=failed_file,
+                cache_filepath=cache_file,
+                cache_max_size=cache_max_size),
+            *compaction_stages,
+            Stage(
+                func=apply_category_filter,
+                n_workers=get_n_workers(apply_category_filter),
+                filter_collection=True,
+                max_tasks_per_worker=args.max_tasks_per_worker),
+            Stage(
+                func=apply_example_extraction,
+                n_workers=get_n_workers(apply_example_extraction),
+                filter_collection=True,
+                flatten=True,
+                timeout=args.item_timeout,
+                quarantine_filepath=quarantine_file,
+                max_tasks_per_worker=args.max_tasks_per_worker),
+            Stage(
+                func=apply_content_filter,
+                n_workers=get_n_workers(apply_content_filter),
+                filter_collection=True,
+                max_tasks_per_worker=args.max_tasks_per_worker),
+            SaveIterableToJSONStage(
+                filepath=output_file,
+                write_as_array=False)
+        ]
+
+    elif pipeline_name == 'split':
+        stages = [
+            LoadJSONFileStage(
+                filepath=input_file,
+                n_revisions=n_revisions,
+                sampler=sampler
+            ),
+            TrainValidationTestSplitStage(
+                labels_column='labels',
+                train_set_ratio=.7,
+                validation_set_ratio=.15,
+                test_set_ratio=.15),
+            SaveIterableToJSONStage(
+                filepath=output_file,
+                from_dict=True,
+                write_as_array=False)
+        ]
+
+    elif pipeline_name == 'prepare_doccano':
+        stages = [
+            LoadJSONFileStage(
+                filepath=input_file,
+                n_revisions=n_revisions,
+                sampler=sampler
+            ),
+            Stage(func=apply_conversion_to_doccano_format,
+                  n_workers=get_n_workers(
+                      apply_conversion_to_doccano_format),
+                  filter_collection=True),
+            SaveIterableToJSONStage(
+                filepath=output_file,
+                write_as_array=False)
+        ]
+
+    report_file = args.report_file or \
+        f'{os.path.splitext(output_file)[0]}_report.json'
+
+    profile_dir = None
+    if args.profile:
+        profile_dir = args.profile_dir or \
+            f'{os.path.splitext(output_file)[0]}_profile'
+
+    # Run pipeline, streaming records through all stages
+    pipeline = Pipeline(
+        stages=stages,
+        streaming=True,
+        concurrent=args.concurrent_stages,
+        checkpoint_dirpath=args.stage_checkpoint_dir,
+        shard_size=args.checkpoint_shard_size,
+        report_filepath=report_file,
+        profile_dirpath=profile_dir,
+        profile_interval=args.profile_interval)
+    _ = pipeline.apply(collection=None)
+
+
+if __name__ == '__main__':
+    main()
+    sys.exit()
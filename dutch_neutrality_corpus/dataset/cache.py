@@ -0,0 +1,111 @@
+import time
+import zlib
+import sqlite3
+import logging
+
+logging.basicConfig(
+    level='INFO',
+    format='%(asctime)s %(message)s',
+    filename='dwnc.log')
+
+DEFAULT_CACHE_MAX_SIZE = 4 << 30
+# Evict down to this fraction of max_size, so eviction runs rarely
+EVICTION_TARGET = 0.9
+
+
+class RevisionCache():
+    """
+    Fetched revision HTML in a single SQLite file, zlib-compressed and
+    keyed by the URL it came from (so by revision id and wiki). Diff pages
+    never change, so entries only leave the cache when the compressed
+    total exceeds max_size, least recently used first. Safe to share
+    between processes.
+    """
+
+    def __init__(self,
+                 filepath,
+                 max_size=DEFAULT_CACHE_MAX_SIZE,
+                 compression_level=6):
+        self.filepath = filepath
+        self.max_size = max_size
+        self.compression_level = compression_level
+        self.n_hits = 0
+        self.n_misses = 0
+
+        self.connection = sqlite3.connect(
+            filepath,
+            timeout=60,
+            isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS revisions ('
+            'url TEXT PRIMARY KEY, '
+            'content BLOB NOT NULL, '
+            'size INTEGER NOT NULL, '
+            'accessed_at REAL NOT NULL)')
+        self.connection.execute(
+            'CREATE INDEX IF NOT EXISTS revisions_accessed_at '
+            'ON revisions (accessed_at)')
+        self.size = self.get_total_size()
+
+    def get_total_size(self):
+        (size,) = self.connection.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM revisions').fetchone()
+        return size
+
+    def get(self, url):
+        row = self.connection.execute(
+            'SELECT content FROM revisions WHERE url = ?',
+            (url,)).fetchone()
+
+        if row is None:
+            self.n_misses += 1
+            return None
+
+        self.n_hits += 1
+        self.connection.execute(
+            'UPDATE revisions SET accessed_at = ? WHERE url = ?',
+            (time.time(), url))
+        return zlib.decompress(row[0]).decode()
+
+    def put(self, url, html_content):
+        content = zlib.compress(
+            html_content.encode(),
+            self.compression_level)
+        self.connection.execute(
+            'INSERT OR REPLACE INTO revisions '
+            '(url, content, size, accessed_at) VALUES (?, ?, ?, ?)',
+            (url, content, len(content), time.time()))
+
+        self.size += len(content)
+        if self.size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        # Other processes may have written or evicted in the meantime
+        self.size = self.get_total_size()
+        excess = self.size - int(self.max_size * EVICTION_TARGET)
+        if excess <= 0:
+            return
+
+        urls = []
+        freed = 0
+        rows = self.connection.execute(
+            'SELECT url, size FROM revisions ORDER BY accessed_at')
+        for url, size in rows:
+            if freed >= excess:
+                break
+            urls.append((url,))
+            freed += size
+
+        self.connection.executemany(
+            'DELETE FROM revisions WHERE url = ?', urls)
+        self.size -= freed
+        logging.info(f'Evicted {len(urls)} revisions from {self.filepath}')
+
+    def close(self):
+        logging.info(
+            f'Revision cache {self.filepath}: '
+            f'{self.n_hits} hits, {self.n_misses} misses')
+        self.connection.close()
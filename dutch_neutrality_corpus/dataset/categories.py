@@ -38,12 +38,18 @@ def is_category_to_filter(text):
     return contains_filtered_category
 
 
-def extract_categories(html):
-    # TODO: "Twijfel aan de neutraliteit"
-    soup = BeautifulSoup(html, features='html.parser')
+def select_category_titles(soup):
     categories_html = soup.select(CATEGORY_SELECTOR)
-    unique_categories = list(set([a.text for a in categories_html]))
+    return list(dict.fromkeys(a.text for a in categories_html))
+
+
+def extract_category_titles(html):
+    soup = BeautifulSoup(html, features='html.parser')
+    return select_category_titles(soup)
 
+
+def classify_categories(unique_categories):
+    # TODO: "Twijfel aan de neutraliteit"
     categories_to_keep = []
     wikipedia_categories = []
     categories_to_filter = []
@@ -66,12 +72,19 @@ def extract_categories(html):
             wikipedia_categories)
 
 
+def extract_categories(html):
+    return classify_categories(extract_category_titles(html))
+
+
 def apply_category_filter(row):
-    html = row['html_content']
+    # Compacted rows carry their category titles already
+    category_titles = row.get('category_titles')
+    if category_titles is None:
+        category_titles = extract_category_titles(row['html_content'])
 
     # TODO: Ignore guidelines: 'Wikipedia:Richtlijnen'...
     categories_to_keep, categories_to_filter, wikpedia_article_tag = \
-        extract_categories(html=html)
+        classify_categories(category_titles)
 
     if categories_to_filter:
         return {}
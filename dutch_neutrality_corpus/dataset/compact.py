@@ -0,0 +1,39 @@
+import re
+
+from bs4 import BeautifulSoup
+
+from dutch_neutrality_corpus.dataset.categories import (
+    select_category_titles)
+
+NODE_REGEX = re.compile(
+    r'(diff-deletedline)|(diff-addedline)|(diff-empty)')
+
+
+def compact_html(html_content):
+    """
+    Reduce a rendered diff page to what later stages read: the diff
+    table cells, in page order, and the category link titles.
+    """
+    soup = BeautifulSoup(html_content, features='html.parser')
+    diff_cells = [str(node) for node in soup.find_all(class_=NODE_REGEX)]
+    category_titles = select_category_titles(soup)
+    return diff_cells, category_titles
+
+
+def get_diff_html(row):
+    """ Diff table markup of a full or compacted revision """
+    if 'html_content' in row:
+        return row['html_content']
+    return ''.join(row['diff_cells'])
+
+
+def apply_compaction(row):
+    # Rows compacted by an earlier run pass through unchanged
+    if 'html_content' not in row:
+        return row
+
+    html_content = row.pop('html_content')
+    row['diff_cells'], row['category_titles'] = \
+        compact_html(html_content=html_content)
+
+    return row
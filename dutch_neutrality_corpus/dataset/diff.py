@@ -10,9 +10,10 @@ from nltk import word_tokenize
 from dutch_neutrality_corpus.dataset.text import text_sanitation
 from dutch_neutrality_corpus.dataset.retrieve import (
     get_wikipedia_revision_url)
+from dutch_neutrality_corpus.dataset.compact import (
+    NODE_REGEX,
+    get_diff_html)
 
-NODE_REGEX = re.compile(
-    r'(diff-deletedline)|(diff-addedline)|(diff-empty)')
 DIV_REGEX = re.compile(r'<div.*?>(.*)</div>', re.DOTALL)
 
 EMPTY_DIV_REGEX = re.compile(r'(diff-empty)')
@@ -417,7 +418,7 @@ def extract_examples(html_content, revision_id):
 
 def apply_example_extraction(row):
     revision_id = row['revision_id']
-    html_content = row['html_content']
+    html_content = get_diff_html(row)
 
     revision_wiki_url = f'https://nl.wikipedia.org/wiki/?diff={revision_id}'
     logging.info(f'Processing revision_id={revision_id} : {revision_wiki_url}')
@@ -1,4 +1,7 @@
 import re
+from collections import namedtuple
+
+import numpy as np
 
 # negative filter on revisions
 INVALID_REVISION_REGEX = r'revert|undo|undid|robot'
@@ -12,6 +15,77 @@ NPOV_REGEX = (r'([- wnv\/\\\:\{\(\[\"\+\'\.\|\_\)\#\=\;\~](rm)'
               r'?(attribute)?(yes)?(de)?n?pov)|([- n\/\\\:\{\('
               r'\[\"\+\'\.\|\_\)\#\;\~]neutral)')
 
+# Every NPOV_REGEX match contains one of these terms
+NPOV_PREFILTER_TERMS = ('pov', 'neutral')
+
+# povere = poor
+# special case: "poverty", "impovershiment", etc
+POOR_WORD_TERMS = ('pover', 'povere')
+
+
+# Compact revision passed between processes instead of XML elements
+RevisionRecord = namedtuple(
+    'RevisionRecord',
+    ['revision_id', 'timestamp', 'comment', 'page_id', 'title'],
+    defaults=(None, None))
+
+
+class NPOVCommentClassifier():
+    """
+    Decides whether revision comments mark an NPOV edit.
+
+    Patterns are compiled once and comments without any NPOV term are
+    rejected by substring checks before any regex runs. Shared by
+    RevisionComment and the Spark comment filtering job.
+    """
+
+    def __init__(self,
+                 npov_regex=NPOV_REGEX,
+                 invalid_revision_regex=INVALID_REVISION_REGEX,
+                 prefilter_terms=NPOV_PREFILTER_TERMS):
+        self.npov_pattern = re.compile(npov_regex)
+        self.invalid_revision_pattern = re.compile(invalid_revision_regex)
+        self.prefilter_terms = prefilter_terms
+
+    def is_npov(self, comment):
+        if not comment or not isinstance(comment, str):
+            return False
+
+        comment = comment.lower()
+
+        if not any(term in comment for term in self.prefilter_terms):
+            return False
+
+        if self.invalid_revision_pattern.search(comment):
+            return False
+
+        # TODO: create Dutch NPOV tags
+        if self.npov_pattern.search(comment):
+
+            # TODO: remove redundancy later...
+            return not any(term in comment for term in POOR_WORD_TERMS)
+
+        return False
+
+    def classify(self, comments):
+        """
+        Boolean mask over a batch of comments. Lists give a list, numpy
+        arrays a boolean array and pandas Series a boolean Series.
+        """
+        if isinstance(comments, list):
+            return [self.is_npov(c) for c in comments]
+
+        if hasattr(comments, 'map') and hasattr(comments, 'index'):
+            return comments.map(self.is_npov).astype(bool)
+
+        return np.fromiter(
+            (self.is_npov(c) for c in comments),
+            dtype=bool,
+            count=len(comments))
+
+
+NPOV_CLASSIFIER = NPOVCommentClassifier()
+
 
 def strip_tag_name(tag):
     idx = tag.rfind('}')
@@ -23,11 +97,19 @@ def strip_tag_name(tag):
 # TODO: consider using DTO plus functions instead...
 class RevisionComment():
 
-    def __init__(self, element):
+    def __init__(self, element=None, record=None, page_id=None, title=None):
         self.revision_id = None
         self.timestamp = None
         self.comment = None
-        self.extract_details(element=element)
+        self.page_id = page_id
+        self.title = title
+
+        if element is not None:
+            self.extract_details(element=element)
+
+        elif record is not None:
+            self.revision_id, self.timestamp, self.comment, \
+                self.page_id, self.title = record
 
     def extract_details(self, element):
         """  Store revision attributes """
@@ -48,47 +130,39 @@ class RevisionComment():
         return not self.revision_id or not self.comment or not self.timestamp
 
     def is_admissible(self):
+        return NPOV_CLASSIFIER.is_npov(self.comment)
 
-        if not self.comment:
-            return False
-
-        comment = self.comment.lower()
-
-        if re.search(INVALID_REVISION_REGEX, comment):
-            return False
-
-        # TODO: create Dutch NPOV tags
-        if re.search(NPOV_REGEX, comment):
-
-            # TODO: remove redundancy later...
-            # povere = poor
-            # special case: "poverty", "impovershiment", etc
-            if 'pover' in comment or 'povere' in comment:
-                return False
-            return True
-
-        return False
+    def asrecord(self):
+        return RevisionRecord(
+            revision_id=self.revision_id,
+            timestamp=self.timestamp,
+            comment=self.comment,
+            page_id=self.page_id,
+            title=self.title)
 
     def asdict(self):
         return {
             'revision_id': self.revision_id,
             'timestamp': self.timestamp,
-            'comment': self.comment
+            'comment': self.comment,
+            'page_id': self.page_id,
+            'title': self.title
         }
 
     def __repr__(self):
         return f'{self.revision_id} {self.timestamp}: {self.comment}'
 
 
-def apply_npov_identification(item_context):
-    event, revision_element = item_context
+def extract_revision_record(element, page_id=None, title=None):
+    """ Reduce a completed <revision> element to a RevisionRecord """
+    return RevisionComment(
+        element=element,
+        page_id=page_id,
+        title=title).asrecord()
 
-    tag_name = strip_tag_name(tag=revision_element.tag)
-
-    if not(event == 'start' and tag_name == 'revision'):
-        return {}
 
-    comment = RevisionComment(element=revision_element)
+def apply_npov_identification(record):
+    comment = RevisionComment(record=record)
 
     if not comment.is_admissible():
         return {}
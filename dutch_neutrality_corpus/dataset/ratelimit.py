@@ -0,0 +1,203 @@
+import os
+import csv
+import time
+import random
+import asyncio
+import logging
+import threading
+from collections import deque
+from email.utils import parsedate_to_datetime
+
+logging.basicConfig(
+    level='INFO',
+    format='%(asctime)s %(message)s',
+    filename='dwnc.log')
+
+# Responses worth retrying, all others fail immediately
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+DEFAULT_REQUESTS_PER_SECOND = 50
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_BASE_DELAY = 1.0
+DEFAULT_MAX_DELAY = 60.0
+
+
+class RetryableResponseError(Exception):
+
+    def __init__(self, status, retry_after=None):
+        super().__init__(f'HTTP {status}')
+        self.status = status
+        self.retry_after = retry_after
+
+
+class PermanentResponseError(Exception):
+
+    def __init__(self, status):
+        super().__init__(f'HTTP {status}')
+        self.status = status
+
+
+def parse_retry_after(value):
+    """ Seconds to wait from a Retry-After header (seconds or HTTP date) """
+    if not value:
+        return None
+
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+def check_response_status(status, headers):
+    """ Raise for anything but a successful response """
+    if status in RETRYABLE_STATUS_CODES:
+        raise RetryableResponseError(
+            status=status,
+            retry_after=parse_retry_after(headers.get('Retry-After')))
+
+    if status >= 400:
+        raise PermanentResponseError(status=status)
+
+
+class TokenBucket():
+    """
+    Thread-safe token bucket allowing rate requests per second with
+    bursts of up to capacity. Callers reserve a token and sleep for the
+    returned wait, from threads or coroutines. pause() holds back all
+    callers, e.g. for a server's Retry-After.
+    """
+
+    def __init__(self, rate=DEFAULT_REQUESTS_PER_SECOND, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(1.0, rate))
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """ Take a token, returning the seconds to wait before using it """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity,
+                self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+
+            self.tokens -= 1
+            wait = 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+            return max(wait, self.paused_until - now)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(
+                self.paused_until,
+                time.monotonic() + seconds)
+
+    def acquire(self):
+        time.sleep(self.reserve())
+
+    async def acquire_async(self):
+        await asyncio.sleep(self.reserve())
+
+
+class BackoffPolicy():
+    """ Capped exponential backoff with full jitter, honouring Retry-After """
+
+    def __init__(self,
+                 max_retries=DEFAULT_MAX_RETRIES,
+                 base_delay=DEFAULT_BASE_DELAY,
+                 max_delay=DEFAULT_MAX_DELAY,
+                 seed=None):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.rng = random.Random(seed)
+
+    def should_retry(self, attempt):
+        return attempt < self.max_retries
+
+    def get_delay(self, attempt, retry_after=None):
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+
+        ceiling = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return self.rng.uniform(0, ceiling)
+
+
+class AdaptiveConcurrency():
+    """
+    Additive-increase/multiplicative-decrease limit on requests in
+    flight. The limit is cut by decrease_factor when the error rate over
+    the last window outcomes exceeds max_error_rate, and grows by one
+    after every limit consecutive successes.
+    """
+
+    def __init__(self,
+                 initial_limit,
+                 min_limit=1,
+                 max_limit=None,
+                 window=50,
+                 max_error_rate=0.1,
+                 decrease_factor=0.5):
+        self.limit = initial_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit or initial_limit
+        self.max_error_rate = max_error_rate
+        self.decrease_factor = decrease_factor
+        self.outcomes = deque(maxlen=window)
+        self.n_successes = 0
+
+    def error_rate(self):
+        if not self.outcomes:
+            return 0.0
+        return self.outcomes.count(False) / len(self.outcomes)
+
+    def record(self, success):
+        self.outcomes.append(success)
+
+        if not success:
+            self.n_successes = 0
+            full_window = len(self.outcomes) == self.outcomes.maxlen
+            if full_window and self.error_rate() > self.max_error_rate:
+                self.limit = max(
+                    self.min_limit,
+                    int(self.limit * self.decrease_factor))
+                self.outcomes.clear()
+                logging.info(f'Lowering concurrency to {self.limit}')
+            return
+
+        self.n_successes += 1
+        if self.n_successes >= self.limit and self.limit < self.max_limit:
+            self.limit += 1
+            self.n_successes = 0
+
+
+class FailedRevisionLog():
+    """
+    Revision ids that could not be retrieved, appended to a CSV file with
+    a revision_id column so it can be passed back as --input-file.
+    """
+
+    FIELDS = ['revision_id', 'reason']
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        if not os.path.exists(filepath) or not os.path.getsize(filepath):
+            with open(filepath, 'w', newline='') as f:
+                csv.writer(f).writerow(self.FIELDS)
+
+    def record(self, revision_id, reason):
+        # Single short appends are atomic across worker processes
+        with open(self.filepath, 'a', newline='') as f:
+            csv.writer(f).writerow([revision_id, reason])
+
+    def load_revision_ids(self):
+        with open(self.filepath, newline='') as f:
+            return [row['revision_id'] for row in csv.DictReader(f)]
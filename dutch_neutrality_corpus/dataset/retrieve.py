@@ -1,6 +1,23 @@
+import time
+import asyncio
 import logging
+import threading
+
+import aiohttp
 import requests
 
+from dutch_neutrality_corpus.dataset.ratelimit import (
+    DEFAULT_MAX_RETRIES,
+    TokenBucket,
+    BackoffPolicy,
+    AdaptiveConcurrency,
+    FailedRevisionLog,
+    RetryableResponseError,
+    check_response_status)
+from dutch_neutrality_corpus.dataset.cache import (
+    DEFAULT_CACHE_MAX_SIZE,
+    RevisionCache)
+
 
 logging.basicConfig(
     level='INFO',
@@ -11,34 +28,374 @@ logging.basicConfig(
 DUTCH_WIKIPEDIA_REVISION_URL_TEMPLATE = \
     'https://nl.wikipedia.org/wiki/?diff={revision_id}'
 
+DEFAULT_MAX_IN_FLIGHT = 64
+DEFAULT_PER_HOST_LIMIT = 16
+DEFAULT_TIMEOUT = 60
+
+END_OF_INPUT = object()
+
+# Connection-level failures worth retrying
+RETRYABLE_REQUESTS_ERRORS = (
+    RetryableResponseError,
+    requests.ConnectionError,
+    requests.Timeout)
+RETRYABLE_AIOHTTP_ERRORS = (
+    RetryableResponseError,
+    aiohttp.ClientConnectionError,
+    asyncio.TimeoutError)
 
-def get_wikipedia_revision_url(revision_id):
-    return DUTCH_WIKIPEDIA_REVISION_URL_TEMPLATE.format(
+# Reused across revisions within a worker process. Sessions and cache
+# connections are per thread, rate limiters are shared by all threads
+LOCAL = threading.local()
+RATE_LIMITERS = {}
+RATE_LIMITERS_LOCK = threading.Lock()
+
+
+def get_wikipedia_revision_url(
+        revision_id,
+        url_template=DUTCH_WIKIPEDIA_REVISION_URL_TEMPLATE):
+    return url_template.format(
         revision_id=revision_id)
 
 
-def query_url_with_backoff(url):
-    session = requests.Session()
-    response = session.get(url)
-    html = response.content.decode()
-    return html
+def get_session():
+    if not hasattr(LOCAL, 'session'):
+        LOCAL.session = requests.Session()
+    return LOCAL.session
+
+
+def get_rate_limiter(requests_per_second):
+    with RATE_LIMITERS_LOCK:
+        if requests_per_second not in RATE_LIMITERS:
+            RATE_LIMITERS[requests_per_second] = TokenBucket(
+                rate=requests_per_second)
+        return RATE_LIMITERS[requests_per_second]
+
+
+def get_cache(cache_filepath, cache_max_size):
+    if not hasattr(LOCAL, 'caches'):
+        LOCAL.caches = {}
+    if cache_filepath not in LOCAL.caches:
+        LOCAL.caches[cache_filepath] = RevisionCache(
+            filepath=cache_filepath,
+            max_size=cache_max_size)
+    return LOCAL.caches[cache_filepath]
+
+
+def record_failed_revision(failed_filepath, revision_id, reason):
+    if failed_filepath:
+        FailedRevisionLog(failed_filepath).record(revision_id, reason)
+
+
+def query_url_with_backoff(url,
+                           session=None,
+                           rate_limiter=None,
+                           backoff_policy=None,
+                           timeout=DEFAULT_TIMEOUT):
+    """
+    GET url, retrying rate-limited, unavailable and failed connections
+    with exponential backoff (or the server's Retry-After) up to the
+    policy's retry cap. Other error responses raise immediately.
+    """
+    session = session or get_session()
+    backoff_policy = backoff_policy or BackoffPolicy()
+
+    attempt = 0
+    while True:
+        if rate_limiter:
+            rate_limiter.acquire()
+
+        try:
+            response = session.get(url, timeout=timeout)
+            check_response_status(response.status_code, response.headers)
+            return response.content.decode()
 
+        except RETRYABLE_REQUESTS_ERRORS as e:
+            if not backoff_policy.should_retry(attempt):
+                raise
 
-def retrieve_single_revision(row):
+            retry_after = getattr(e, 'retry_after', None)
+            if retry_after and rate_limiter:
+                rate_limiter.pause(retry_after)
+
+            delay = backoff_policy.get_delay(attempt, retry_after)
+            logging.info(f'{e} for {url}, retrying in {delay:.1f}s')
+            time.sleep(delay)
+            attempt += 1
+
+
+def retrieve_single_revision(row,
+                             requests_per_second=None,
+                             max_retries=DEFAULT_MAX_RETRIES,
+                             failed_filepath=None,
+                             cache_filepath=None,
+                             cache_max_size=DEFAULT_CACHE_MAX_SIZE):
     revision_id = row['revision_id']
     logging.info(f'Processing revision_id={revision_id}')
 
+    rate_limiter = None
+    if requests_per_second:
+        rate_limiter = get_rate_limiter(requests_per_second)
+
+    cache = None
+    if cache_filepath:
+        cache = get_cache(cache_filepath, cache_max_size)
+
     result = {}
     try:
         url = get_wikipedia_revision_url(revision_id=revision_id)
-        html_content = query_url_with_backoff(url=url)
+
+        html_content = cache.get(url) if cache else None
+        if html_content is None:
+            html_content = query_url_with_backoff(
+                url=url,
+                rate_limiter=rate_limiter,
+                backoff_policy=BackoffPolicy(max_retries=max_retries))
+            if cache:
+                cache.put(url, html_content)
+
         result = {
             'revision_id': revision_id,
             'html_content': html_content
         }
     except Exception as e:
-        # TODO: Ignore/filter out failed queries for now...
         logging.info(f'{e} revision_id={revision_id}')
-        pass
+        record_failed_revision(failed_filepath, revision_id, str(e))
 
     return result
+
+
+class AsyncRetrievalStage():
+    """ Retrieves revisions on a single asyncio event loop """
+
+    def __init__(self,
+                 max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+                 per_host_limit=DEFAULT_PER_HOST_LIMIT,
+                 url_template=DUTCH_WIKIPEDIA_REVISION_URL_TEMPLATE,
+                 timeout=DEFAULT_TIMEOUT,
+                 requests_per_second=None,
+                 max_retries=DEFAULT_MAX_RETRIES,
+                 failed_filepath=None,
+                 cache_filepath=None,
+                 cache_max_size=DEFAULT_CACHE_MAX_SIZE,
+                 materialize=True):
+        self.max_in_flight = max_in_flight
+        self.per_host_limit = per_host_limit
+        self.url_template = url_template
+        self.timeout = timeout
+        self.requests_per_second = requests_per_second
+        self.backoff_policy = BackoffPolicy(max_retries=max_retries)
+        self.failed_filepath = failed_filepath
+        self.cache_filepath = cache_filepath
+        self.cache_max_size = cache_max_size
+        self.materialize = materialize
+        self.rate_limiter = None
+        self.concurrency = None
+        self.cache = None
+
+    async def create_session(self):
+        connector = aiohttp.TCPConnector(
+            limit=self.max_in_flight,
+            limit_per_host=self.per_host_limit)
+        return aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=self.timeout))
+
+    async def fetch(self, session, url):
+        async with session.get(url) as response:
+            check_response_status(response.status, response.headers)
+            return await response.read()
+
+    async def retrieve_revision(self, session, row):
+        revision_id = row['revision_id']
+        logging.info(f'Processing revision_id={revision_id}')
+
+        url = get_wikipedia_revision_url(
+            revision_id=revision_id,
+            url_template=self.url_template)
+
+        if self.cache:
+            html_content = self.cache.get(url)
+            if html_content is not None:
+                return {
+                    'revision_id': revision_id,
+                    'html_content': html_content
+                }
+
+        attempt = 0
+        while True:
+            if self.rate_limiter:
+                await self.rate_limiter.acquire_async()
+
+            try:
+                content = await self.fetch(session, url)
+                self.concurrency.record(success=True)
+
+                html_content = content.decode()
+                if self.cache:
+                    self.cache.put(url, html_content)
+
+                return {
+                    'revision_id': revision_id,
+                    'html_content': html_content
+                }
+
+            except RETRYABLE_AIOHTTP_ERRORS as e:
+                self.concurrency.record(success=False)
+
+                if not self.backoff_policy.should_retry(attempt):
+                    error = e
+                    break
+
+                retry_after = getattr(e, 'retry_after', None)
+                if retry_after and self.rate_limiter:
+                    self.rate_limiter.pause(retry_after)
+
+                delay = self.backoff_policy.get_delay(attempt, retry_after)
+                logging.info(
+                    f'{e} revision_id={revision_id}, '
+                    f'retrying in {delay:.1f}s')
+                await asyncio.sleep(delay)
+                attempt += 1
+
+            except Exception as e:
+                error = e
+                break
+
+        logging.info(f'{error} revision_id={revision_id}')
+        record_failed_revision(self.failed_filepath, revision_id, str(error))
+        return {}
+
+    def read_input(self, collection, loop, input_queue, slots, stopped):
+        """
+        Reader thread: hand rows to the event loop as they arrive, at
+        most max_in_flight ahead of the requests sent
+        """
+        def put(item):
+            # The loop is closed once the consumer stopped
+            if not stopped.is_set():
+                loop.call_soon_threadsafe(input_queue.put_nowait, item)
+
+        try:
+            for row in collection:
+                slots.acquire()
+                if stopped.is_set():
+                    return
+                put(row)
+            put(END_OF_INPUT)
+        except BaseException as e:
+            put(e)
+
+    async def send_requests(self, session, input_queue, slots, completed):
+        """ Start a request per input row while the concurrency allows """
+        pending = set()
+        slot_freed = asyncio.Event()
+
+        def on_done(task):
+            pending.discard(task)
+            slot_freed.set()
+            completed.put_nowait(task)
+
+        try:
+            while True:
+                while len(pending) >= self.concurrency.limit:
+                    slot_freed.clear()
+                    await slot_freed.wait()
+
+                row = await input_queue.get()
+                slots.release()
+                if row is END_OF_INPUT:
+                    break
+                if isinstance(row, BaseException):
+                    raise row
+
+                task = asyncio.ensure_future(
+                    self.retrieve_revision(session, row))
+                pending.add(task)
+                task.add_done_callback(on_done)
+
+            if pending:
+                await asyncio.wait(pending)
+            completed.put_nowait(END_OF_INPUT)
+
+        except asyncio.CancelledError:
+            raise
+
+        except BaseException as e:
+            completed.put_nowait(e)
+
+        finally:
+            # Only left over when the consumer stopped early
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.wait(pending)
+
+    def iterate_results(self, collection):
+        """ Yield non-empty results as their requests complete """
+        if self.requests_per_second:
+            self.rate_limiter = TokenBucket(rate=self.requests_per_second)
+        self.concurrency = AdaptiveConcurrency(
+            initial_limit=self.max_in_flight)
+        if self.cache_filepath:
+            self.cache = RevisionCache(
+                filepath=self.cache_filepath,
+                max_size=self.cache_max_size)
+
+        loop = asyncio.new_event_loop()
+        session = loop.run_until_complete(self.create_session())
+        input_queue = asyncio.Queue()
+        completed = asyncio.Queue()
+        slots = threading.Semaphore(self.max_in_flight)
+        stopped = threading.Event()
+
+        # Rows come from a thread, so the loop keeps sending requests
+        # while a slow upstream stage produces the next row
+        reader = threading.Thread(
+            target=self.read_input,
+            args=(collection, loop, input_queue, slots, stopped),
+            name='retrieval-input',
+            daemon=True)
+        reader.start()
+        sender = loop.create_task(self.send_requests(
+            session, input_queue, slots, completed))
+        n_results = 0
+
+        try:
+            while True:
+                task = loop.run_until_complete(completed.get())
+                if task is END_OF_INPUT:
+                    break
+                if isinstance(task, BaseException):
+                    raise task
+
+                result = task.result()
+                if result:
+                    n_results += 1
+                    yield result
+
+        finally:
+            stopped.set()
+            # Wake the reader if it waits for a free slot
+            slots.release()
+            sender.cancel()
+            loop.run_until_complete(
+                asyncio.gather(sender, return_exceptions=True))
+            loop.run_until_complete(session.close())
+            loop.close()
+            if self.cache:
+                self.cache.close()
+                self.cache = None
+
+        logging.info(f'Completed retrieval with {n_results} results')
+
+    def apply(self, collection):
+        logging.info(
+            f'Retrieving revisions with max_in_flight={self.max_in_flight}, '
+            f'per_host_limit={self.per_host_limit}...')
+
+        results = self.iterate_results(collection)
+        if self.materialize:
+            results = list(results)
+
+        return results
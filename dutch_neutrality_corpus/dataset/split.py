@@ -6,6 +6,9 @@ from sklearn.model_selection import train_test_split
 
 class TrainValidationTestSplitStage():
 
+    # Splits need the whole collection
+    barrier = True
+
     def __init__(self,
                  labels_column,
                  train_set_ratio=.7,
@@ -0,0 +1,543 @@
+import io
+import os
+import re
+import bz2
+import gzip
+import logging
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+from dutch_neutrality_corpus.dataset.identify import (
+    RevisionRecord,
+    NPOV_PREFILTER_TERMS)
+
+logging.basicConfig(
+    level='INFO',
+    format='%(asctime)s %(message)s',
+    filename='dwnc.log')
+
+GZIP_SUFFIX = '.gz'
+BZ2_SUFFIX = '.bz2'
+MULTISTREAM_SUFFIX = 'multistream.xml.bz2'
+MULTISTREAM_INDEX_SUFFIX = 'multistream-index.txt.bz2'
+
+# Each multistream bz2 stream holds 100 pages
+STREAMS_PER_TASK = 32
+
+PAGE_START_TAG = b'<page>'
+PAGE_END_TAG = b'</page>'
+ROOT_END_TAG = b'</mediawiki>'
+SCAN_CHUNK_SIZE = 1 << 20
+
+REVISION_START_TAG = b'<revision>'
+REVISION_END_TAG = b'</revision>'
+REVISION_ID_PATTERN = re.compile(rb'<id>([^<]*)</id>')
+TIMESTAMP_PATTERN = re.compile(rb'<timestamp>([^<]*)</timestamp>')
+COMMENT_PATTERN = re.compile(rb'<comment>([^<]*)</comment>')
+TITLE_PATTERN = re.compile(rb'<title>([^<]*)</title>')
+NAMESPACE_PATTERN = re.compile(rb'<ns>([^<]*)</ns>')
+LINE_BREAK_PATTERN = re.compile(rb'\r\n?')
+
+# Entity references a dump can contain (XML predefined and numeric)
+ENTITY_PATTERN = re.compile(r'&(#[0-9]+|#x[0-9a-fA-F]+|amp|lt|gt|quot|apos);')
+ENTITY_MAP = {'amp': '&', 'lt': '<', 'gt': '>', 'quot': '"', 'apos': "'"}
+NUMERIC_ENTITY_PREFIX = b'&#'
+PREFILTER_TERMS = tuple(term.encode() for term in NPOV_PREFILTER_TERMS)
+
+
+def is_multistream_filepath(filepath):
+    return filepath.endswith(MULTISTREAM_SUFFIX)
+
+
+def get_multistream_index_filepath(filepath):
+    """ nlwiki-*-multistream.xml.bz2 -> nlwiki-*-multistream-index.txt.bz2 """
+    prefix = filepath[:-len(MULTISTREAM_SUFFIX)]
+    return f'{prefix}{MULTISTREAM_INDEX_SUFFIX}'
+
+
+def read_stream_offsets(index_filepath):
+    """ Unique stream offsets from lines of 'offset:page_id:title' """
+    offsets = []
+    with bz2.open(index_filepath, 'rt', encoding='utf-8') as f:
+        for line in f:
+            offset = int(line.split(':', 1)[0])
+            if not offsets or offsets[-1] != offset:
+                offsets.append(offset)
+    return offsets
+
+
+def get_stream_ranges(offsets, file_size):
+    """ Byte ranges of every stream, including header and footer streams """
+    boundaries = [0] + [o for o in offsets if 0 < o < file_size]
+    boundaries.append(file_size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+class MultistreamBZ2Reader(io.RawIOBase):
+    """
+    Readable file object over a Wikimedia multistream bz2 dump.
+
+    Groups of independent bz2 streams (located via the multistream
+    index) are decompressed in a thread pool, as bz2 releases the GIL,
+    and handed out in file order. At most two groups per worker are
+    held in memory at once.
+    """
+
+    def __init__(self,
+                 filepath,
+                 index_filepath,
+                 n_workers=None,
+                 streams_per_task=STREAMS_PER_TASK):
+        super().__init__()
+        self.filepath = filepath
+        self.index_filepath = index_filepath
+        self.n_workers = n_workers or os.cpu_count()
+        self.streams_per_task = streams_per_task
+
+        self.file = open(filepath, 'rb')
+        self.pool = ThreadPool(self.n_workers)
+        self.blocks = self.iterate_decompressed_blocks()
+        self.buffer = memoryview(b'')
+
+    def iterate_compressed_tasks(self):
+        file_size = os.path.getsize(self.filepath)
+        offsets = read_stream_offsets(self.index_filepath)
+        ranges = get_stream_ranges(offsets, file_size)
+
+        for i in range(0, len(ranges), self.streams_per_task):
+            task_ranges = ranges[i:i + self.streams_per_task]
+            start, end = task_ranges[0][0], task_ranges[-1][1]
+            self.file.seek(start)
+            yield self.file.read(end - start)
+
+    def iterate_decompressed_blocks(self):
+        in_flight = deque()
+        max_in_flight = 2 * self.n_workers
+
+        for data in self.iterate_compressed_tasks():
+            in_flight.append(self.pool.apply_async(bz2.decompress, (data,)))
+            if len(in_flight) >= max_in_flight:
+                yield in_flight.popleft().get()
+
+        while in_flight:
+            yield in_flight.popleft().get()
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.buffer:
+            block = next(self.blocks, None)
+            if block is None:
+                return 0
+            self.buffer = memoryview(block)
+
+        n = min(len(b), len(self.buffer))
+        b[:n] = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.pool.terminate()
+            self.file.close()
+        super().close()
+
+
+class PageFilter():
+    """
+    Predicates pushed down into the dump readers. Pages outside the
+    namespaces or not matching title_regex are skipped as a whole,
+    revisions outside [start_timestamp, end_timestamp) are dropped.
+    Timestamps compare as ISO 8601 strings, so dates such as
+    '2010-01-01' work as bounds.
+    """
+
+    def __init__(self,
+                 namespaces=None,
+                 title_regex=None,
+                 start_timestamp=None,
+                 end_timestamp=None):
+        self.namespaces = None
+        if namespaces is not None:
+            self.namespaces = {str(n) for n in namespaces}
+
+        self.title_pattern = re.compile(title_regex) if title_regex else None
+        self.start_timestamp = start_timestamp
+        self.end_timestamp = end_timestamp
+
+    def has_time_window(self):
+        return bool(self.start_timestamp or self.end_timestamp)
+
+    def has_page_filter(self):
+        return self.namespaces is not None or self.title_pattern is not None
+
+    def accepts_page(self, namespace, title):
+        if self.namespaces is not None and namespace not in self.namespaces:
+            return False
+
+        if self.title_pattern and \
+                not (title and self.title_pattern.search(title)):
+            return False
+
+        return True
+
+    def accepts_timestamp(self, timestamp):
+        if not self.has_time_window():
+            return True
+
+        if not timestamp:
+            return False
+
+        if self.start_timestamp and timestamp < self.start_timestamp:
+            return False
+
+        if self.end_timestamp and timestamp >= self.end_timestamp:
+            return False
+
+        return True
+
+
+def open_dump(filepath, index_filepath=None, n_workers=None):
+    """
+    Open a (possibly compressed) XML dump as a binary file object.
+
+    Supports plain .xml, .xml.gz, .xml.bz2 and multistream .xml.bz2
+    dumps. Multistream dumps are decompressed in parallel when their
+    index file is available, otherwise sequentially.
+    """
+    if is_multistream_filepath(filepath):
+        index_filepath = \
+            index_filepath or get_multistream_index_filepath(filepath)
+
+        if os.path.exists(index_filepath):
+            logging.info(
+                f'Decompressing {filepath} in parallel '
+                f'using {index_filepath}')
+            return io.BufferedReader(
+                MultistreamBZ2Reader(
+                    filepath=filepath,
+                    index_filepath=index_filepath,
+                    n_workers=n_workers))
+
+        logging.info(f'No index found for {filepath}, decompressing serially')
+
+    if filepath.endswith(BZ2_SUFFIX):
+        return bz2.open(filepath, 'rb')
+
+    if filepath.endswith(GZIP_SUFFIX):
+        return gzip.open(filepath, 'rb')
+
+    return open(filepath, 'rb')
+
+
+def is_compressed_filepath(filepath):
+    return filepath.endswith(GZIP_SUFFIX) or filepath.endswith(BZ2_SUFFIX)
+
+
+def find_tag_offset(f, tag, offset, chunk_size=SCAN_CHUNK_SIZE):
+    """ Offset of first occurrence of tag at or after offset, else None """
+    overlap = len(tag) - 1
+    while True:
+        f.seek(offset)
+        chunk = f.read(chunk_size)
+        idx = chunk.find(tag)
+        if idx != -1:
+            return offset + idx
+        if len(chunk) < chunk_size:
+            return None
+        offset += len(chunk) - overlap
+
+
+def read_root_tag(f, first_page_offset):
+    """ Opening <mediawiki ...> tag (with namespaces) from the dump header """
+    f.seek(0)
+    header = f.read(first_page_offset)
+    start = header.index(b'<mediawiki')
+    end = header.index(b'>', start) + 1
+    return header[start:end]
+
+
+def get_page_aligned_shards(filepath,
+                            n_shards=None,
+                            shard_size=None,
+                            start_offset=None):
+    """
+    Cut an uncompressed dump into byte ranges which each start on a
+    <page> tag and together cover every page exactly once, either as
+    (at most) n_shards ranges or as ranges of about shard_size bytes.
+    Ranges begin at start_offset, a previous range boundary, if given.
+
+    Returns the root tag needed to parse each range on its own and the
+    list of (start, end) offsets.
+    """
+    if is_compressed_filepath(filepath):
+        raise ValueError(
+            f'Sharding requires an uncompressed dump, got {filepath}')
+
+    file_size = os.path.getsize(filepath)
+
+    with open(filepath, 'rb') as f:
+        first_page = find_tag_offset(f, PAGE_START_TAG, 0)
+        if first_page is None:
+            raise ValueError(f'No <page> found in {filepath}')
+
+        root_tag = read_root_tag(f, first_page)
+
+        f.seek(max(first_page, file_size - SCAN_CHUNK_SIZE))
+        tail_offset = f.tell()
+        pages_end = tail_offset + f.read().rindex(ROOT_END_TAG)
+
+        start = max(first_page, start_offset or 0)
+        if start >= pages_end:
+            return root_tag, []
+
+        if shard_size:
+            n_shards = -(-(pages_end - start) // shard_size)
+        shard_size = max(1, (pages_end - start) // n_shards)
+
+        boundaries = [start]
+        for i in range(1, n_shards):
+            offset = find_tag_offset(
+                f, PAGE_START_TAG, start + i * shard_size)
+            if offset is None or offset >= pages_end:
+                break
+            if offset > boundaries[-1]:
+                boundaries.append(offset)
+        boundaries.append(pages_end)
+
+    shards = list(zip(boundaries[:-1], boundaries[1:]))
+    return root_tag, shards
+
+
+class ShardReader(io.RawIOBase):
+    """
+    Readable file object presenting a byte range of pages as a standalone
+    document: root tag + file[start:end] + closing root tag.
+    """
+
+    def __init__(self, filepath, root_tag, start, end):
+        super().__init__()
+        self.file = open(filepath, 'rb')
+        self.file.seek(start)
+        self.remaining = end - start
+        self.prefix = memoryview(root_tag)
+        self.suffix = memoryview(ROOT_END_TAG)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self.prefix:
+            n = min(len(b), len(self.prefix))
+            b[:n] = self.prefix[:n]
+            self.prefix = self.prefix[n:]
+            return n
+
+        if self.remaining:
+            n = self.file.readinto(
+                memoryview(b)[:min(len(b), self.remaining)])
+            self.remaining -= n
+            if n:
+                return n
+            self.remaining = 0
+
+        n = min(len(b), len(self.suffix))
+        b[:n] = self.suffix[:n]
+        self.suffix = self.suffix[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.file.close()
+        super().close()
+
+
+def replace_entity(match):
+    entity = match.group(1)
+    if entity.startswith('#x'):
+        return chr(int(entity[2:], 16))
+    if entity.startswith('#'):
+        return chr(int(entity[1:]))
+    return ENTITY_MAP[entity]
+
+
+def unescape_xml_text(raw):
+    """ Decode raw element text exactly as an XML parser would """
+    raw = LINE_BREAK_PATTERN.sub(b'\n', raw)
+    return ENTITY_PATTERN.sub(replace_entity, raw.decode('utf-8'))
+
+
+def is_npov_candidate(raw_comment):
+    """
+    Cheap pre-filter on escaped bytes. Comments with numeric entities
+    are kept as they could hide a term until unescaped.
+    """
+    lowered = raw_comment.lower()
+    return any(term in lowered for term in PREFILTER_TERMS) or \
+        NUMERIC_ENTITY_PREFIX in raw_comment
+
+
+def search_text(pattern, buffer, start, end):
+    match = pattern.search(buffer, start, end)
+    return match.group(1) if match else None
+
+
+def iterate_accepted_bytes(source, page_filter, chunk_size=SCAN_CHUNK_SIZE):
+    """
+    Bytes of source with the <page> blocks rejected by page_filter left
+    out. Only page headers are held until they are complete; rejected
+    pages are searched for their end tag and dropped.
+    """
+    buffer = b''
+    skipping = False
+    is_eof = False
+
+    while not is_eof:
+        chunk = source.read(chunk_size)
+        is_eof = not chunk
+        buffer += chunk
+
+        while True:
+            if skipping:
+                end = buffer.find(PAGE_END_TAG)
+                if end == -1:
+                    # The end tag may be split over two reads
+                    buffer = buffer[-(len(PAGE_END_TAG) - 1):]
+                    break
+                buffer = buffer[end + len(PAGE_END_TAG):]
+                skipping = False
+
+            start = buffer.find(PAGE_START_TAG)
+            if start == -1:
+                split = len(buffer)
+                if not is_eof:
+                    split = max(0, split - len(PAGE_START_TAG) + 1)
+                yield buffer[:split]
+                buffer = buffer[split:]
+                break
+
+            header_ends = [
+                end for end in (buffer.find(REVISION_START_TAG, start),
+                                buffer.find(PAGE_END_TAG, start))
+                if end != -1]
+            if not header_ends:
+                yield buffer[:start]
+                buffer = buffer[start:]
+                if is_eof:
+                    yield buffer
+                break
+            header_end = min(header_ends)
+
+            title = search_text(TITLE_PATTERN, buffer, start, header_end)
+            title = title if title is None else unescape_xml_text(title)
+            namespace = search_text(
+                NAMESPACE_PATTERN, buffer, start, header_end)
+            namespace = namespace if namespace is None else namespace.decode()
+
+            if page_filter.accepts_page(namespace, title):
+                yield buffer[:header_end]
+                buffer = buffer[header_end:]
+            else:
+                yield buffer[:start]
+                buffer = buffer[start:]
+                skipping = True
+
+
+class PageFilterReader(io.RawIOBase):
+    """ Readable file object over a dump without rejected pages """
+
+    def __init__(self, source, page_filter):
+        super().__init__()
+        self.chunks = iterate_accepted_bytes(source, page_filter)
+        self.chunk = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.chunk:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return 0
+            self.chunk = memoryview(chunk)
+
+        n = min(len(b), len(self.chunk))
+        b[:n] = self.chunk[:n]
+        self.chunk = self.chunk[n:]
+        return n
+
+
+def scan_revision_records(buffer, n_revisions=None, page_filter=None):
+    """
+    Scan raw dump bytes for <page> and <revision> blocks without an XML
+    parser.
+
+    Pages rejected by page_filter are skipped without looking at their
+    revisions. Yields a RevisionRecord for every revision (within the
+    first n_revisions passing page_filter) whose comment passes the NPOV
+    pre-filter. Only those comments are decoded and unescaped.
+    """
+    page_filter = page_filter or PageFilter()
+    check_timestamp = page_filter.has_time_window()
+
+    n_seen = 0
+    page_start = buffer.find(PAGE_START_TAG)
+
+    while page_start != -1:
+        page_end = buffer.find(PAGE_END_TAG, page_start)
+        if page_end == -1:
+            break
+
+        start = buffer.find(REVISION_START_TAG, page_start, page_end)
+        header_end = page_end if start == -1 else start
+
+        title = search_text(TITLE_PATTERN, buffer, page_start, header_end)
+        title = title if title is None else unescape_xml_text(title)
+        namespace = search_text(
+            NAMESPACE_PATTERN, buffer, page_start, header_end)
+        namespace = namespace if namespace is None else namespace.decode()
+
+        if not page_filter.accepts_page(namespace, title):
+            start = -1
+        else:
+            page_id = search_text(
+                REVISION_ID_PATTERN, buffer, page_start, header_end)
+            page_id = page_id if page_id is None else page_id.decode()
+
+        while start != -1:
+            end = buffer.find(REVISION_END_TAG, start, page_end)
+            if end == -1:
+                break
+
+            timestamp = None
+            if check_timestamp:
+                timestamp = search_text(TIMESTAMP_PATTERN, buffer, start, end)
+                timestamp = timestamp and timestamp.decode()
+
+            if page_filter.accepts_timestamp(timestamp):
+                n_seen += 1
+                if n_revisions and n_seen > n_revisions:
+                    return
+
+                comment = search_text(COMMENT_PATTERN, buffer, start, end)
+                if comment and is_npov_candidate(comment):
+
+                    # First <id> in a revision is its own
+                    revision_id = search_text(
+                        REVISION_ID_PATTERN, buffer, start, end)
+                    if timestamp is None:
+                        timestamp = search_text(
+                            TIMESTAMP_PATTERN, buffer, start, end)
+                        timestamp = timestamp and timestamp.decode()
+
+                    yield RevisionRecord(
+                        revision_id=revision_id and revision_id.decode(),
+                        timestamp=timestamp,
+                        comment=unescape_xml_text(comment),
+                        page_id=page_id,
+                        title=title)
+
+            start = buffer.find(REVISION_START_TAG, end, page_end)
+
+        page_start = buffer.find(PAGE_START_TAG, page_end)
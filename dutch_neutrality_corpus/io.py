@@ -1,139 +1,656 @@
+import io
 import os
+import re
 import json
 import csv
+import mmap
 import logging
 import types
-import multiprocessing
+import itertools
+from collections import namedtuple
 from functools import partial
-import xml.etree.cElementTree as ET
+import xml.etree.ElementTree as ET
+
+from dutch_neutrality_corpus.checkpoint import IdentifyCheckpoint
+from dutch_neutrality_corpus.pools import managed_pool
+from dutch_neutrality_corpus.dump import (
+    open_dump,
+    is_compressed_filepath,
+    get_page_aligned_shards,
+    scan_revision_records,
+    PageFilter,
+    PageFilterReader,
+    ShardReader)
+from dutch_neutrality_corpus.dataset.identify import (
+    strip_tag_name,
+    extract_revision_record)
 
 logging.basicConfig(
     level='INFO',
     format='%(asctime)s %(message)s',
     filename='dwnc.log')
 
+# Checkpoint granularity of resumable identify runs
+DEFAULT_SHARD_SIZE = 64 << 20
+
+# Part files written by Spark, e.g. part-00000-<uuid>.csv
+SPARK_PART_PREFIX = 'part-'
+
+# Streaming JSON reads
+READ_CHUNK_SIZE = 1 << 20
+JSON_WHITESPACE = re.compile(r'\s*')
+JSON_SEPARATOR = re.compile(r'[\s,]*')
+JSON_DELIMITER = re.compile(r'[\s,\]]')
+
+# Streaming writes
+WRITE_BUFFER_SIZE = 1 << 20
+DEFAULT_FSYNC_EVERY = 1000
+
 
 class IOStage():
 
-    def __init__(self, filepath):
+    def __init__(self, filepath, sampler=None):
         self.filepath = filepath
+        self.sampler = sampler
+
+    def select_revisions(self, collection, n_revisions):
+        """ Reservoir sample if a sampler is set, else first n_revisions """
+        if self.sampler:
+            logging.info(
+                f'Sampling {self.sampler.n_items} from {self.filepath} '
+                f'(seed={self.sampler.seed}, '
+                f'stratify_by={self.sampler.stratify_by})'
+            )
+            return self.sampler.sample(collection)
+
+        if n_revisions:
+            logging.info(
+                f'Selecting first {n_revisions} from {self.filepath}'
+            )
+            return itertools.islice(collection, int(n_revisions))
+
+        return collection
 
     def apply(self, collection):
         pass
 
 
+def get_part_filepaths(dirpath):
+    """ Data files of a Spark output directory, skipping markers and CRCs """
+    filenames = sorted(
+        filename for filename in os.listdir(dirpath)
+        if filename.startswith(SPARK_PART_PREFIX) and
+        not filename.endswith('.crc'))
+    return [os.path.join(dirpath, filename) for filename in filenames]
+
+
 class LoadCSVFileStage(IOStage):
+    """ Streams rows of a CSV file or Spark output directory """
+
+    ROW_TYPES = ('dict', 'tuple')
 
     def __init__(self,
                  filepath,
                  n_revisions=None,
                  select_fields=None,
-                 n_workers=None):
-        super().__init__(filepath)
+                 sampler=None,
+                 row_type='dict',
+                 materialize=True):
+        super().__init__(filepath, sampler=sampler)
         self.n_revisions = n_revisions
         self.select_fields = select_fields
-        self.n_workers = n_workers
+        self.row_type = row_type
+        self.materialize = materialize
 
-    def filter_dict(self, item_dict, fields):
-        return {k: v for k, v in item_dict.items() if k in fields}
+        if isinstance(select_fields, str):
+            self.select_fields = [select_fields]
 
-    def filter_fields(self, collection, fields):
+        if row_type not in self.ROW_TYPES:
+            raise ValueError(f'row_type must be one of {self.ROW_TYPES}')
 
-        if isinstance(fields, str):
-            fields = [fields]
+    def get_filepaths(self):
+        if os.path.isdir(self.filepath):
+            return get_part_filepaths(self.filepath)
+        return [self.filepath]
 
-        pool = multiprocessing.Pool(self.n_workers)
+    def get_field_indices(self, header, filepath):
+        fields = self.select_fields or header
 
-        kwargs = {'fields': fields}
-        filter_func = partial(
-            self.filter_dict,
-            **kwargs)
+        missing_fields = [f for f in fields if f not in header]
+        if missing_fields:
+            raise ValueError(f'{filepath} has no fields {missing_fields}')
 
-        return pool.imap(filter_func, collection)
+        return fields, [header.index(f) for f in fields]
 
-    def apply(self, collection):
-        logging.info(f'Loading {self.filepath}...')
+    def iterate_file(self, filepath):
+        with open(filepath, newline='') as f:
+            reader = csv.reader(f)
+            header = next(reader, None)
+            if header is None:
+                return
 
-        with open(self.filepath, "r") as f:
-            reader = csv.DictReader(f)
-            collection = list(reader)
+            fields, indices = self.get_field_indices(header, filepath)
+            for values in reader:
+                if not values:
+                    continue
 
-        if self.n_revisions:
-            logging.info(
-                f'Selecting first {self.n_revisions} from {self.filepath}'
-            )
-            collection = collection[:self.n_revisions]
+                n_values = len(values)
+                row = tuple(
+                    values[i] if i < n_values else None for i in indices)
 
-        if self.select_fields:
-            logging.info('Filtering fields...')
-            collection = self.filter_fields(
-                collection=collection,
-                fields=self.select_fields
-            )
+                if self.row_type == 'dict':
+                    row = dict(zip(fields, row))
+                yield row
+
+    def iterate_files(self):
+        for filepath in self.get_filepaths():
+            yield from self.iterate_file(filepath)
 
         logging.info(f'Completed loading {self.filepath}')
 
+    def apply(self, collection):
+        logging.info(f'Loading {self.filepath}...')
+
+        collection = self.select_revisions(
+            self.iterate_files(),
+            self.n_revisions)
+
+        if self.materialize:
+            collection = list(collection)
+
         return collection
 
 
 class LoadXMLFileStage(IOStage):
+    """
+    Streams revisions from a plain, gzip, bz2 or multistream bz2 dump.
 
-    def __init__(self, filepath, n_revisions):
-        super().__init__(filepath)
+    Revisions are reduced to RevisionRecord tuples, carrying their page id
+    and title, in the parsing process. If func is given it is applied
+    in-process as well and only non-empty results are returned, so
+    nothing crosses a process boundary. Pages rejected by page_filter
+    are cut from the byte stream before it reaches the XML parser.
+    """
+
+    def __init__(self,
+                 filepath,
+                 n_revisions,
+                 index_filepath=None,
+                 n_workers=None,
+                 func=None,
+                 page_filter=None,
+                 sampler=None,
+                 materialize=True):
+        super().__init__(filepath, sampler=sampler)
         self.n_revisions = n_revisions
+        self.index_filepath = index_filepath
+        self.n_workers = n_workers
+        self.func = func
+        self.page_filter = page_filter or PageFilter()
+        self.materialize = materialize
 
     def truncate_generator(self, generator, first_n):
-        return (generator.__next__() for _ in range(int(first_n)))
+        return itertools.islice(generator, int(first_n))
+
+    def iterate_revisions(self, source):
+        """
+        Stream a RevisionRecord for every completed <revision> element.
+
+        Parsed subtrees are released as soon as their record is extracted,
+        so memory stays flat regardless of dump size.
+        """
+        if self.page_filter.has_page_filter():
+            source = PageFilterReader(source, self.page_filter)
+
+        context = iter(ET.iterparse(source, events=('start', 'end')))
+
+        # Keep root only to release finished pages from it
+        event, root = context.__next__()
+
+        page = root
+        page_id = title = None
+        in_revision = False
+        for event, element in context:
+            tag_name = strip_tag_name(tag=element.tag)
+
+            if event == 'start':
+                if tag_name == 'page':
+                    page = element
+                    page_id = title = None
+                elif tag_name == 'revision':
+                    in_revision = True
+                continue
+
+            if tag_name == 'revision':
+                in_revision = False
+
+                record = extract_revision_record(
+                    element,
+                    page_id=page_id,
+                    title=title)
+
+                if self.page_filter.accepts_timestamp(record.timestamp):
+                    yield record
+
+                # Drop revision (and processed siblings) from its page
+                element.clear()
+                del page[:]
+
+            elif in_revision:
+                continue
+
+            elif tag_name == 'title':
+                title = element.text
+
+            elif tag_name == 'id' and page is not root:
+                page_id = element.text
+
+            elif tag_name == 'page':
+                page = root
+                root.clear()
+
+    def iterate_file(self):
+        with open_dump(
+                filepath=self.filepath,
+                index_filepath=self.index_filepath,
+                n_workers=self.n_workers) as source:
+            yield from self.iterate_revisions(source=source)
 
     # TODO: replace 'collection' with nuisance parameter...
     def apply(self, collection):
         logging.info(f'Loading {self.filepath}...')
 
-        context = ET.iterparse(
-            self.filepath,
-            events=("start", "end")
-        )
-        context = iter(context)
+        context = self.select_revisions(
+            self.iterate_file(),
+            self.n_revisions)
 
-        # Ignore the root element
-        event, root = context.__next__()
+        if self.func:
+            function_name = self.func.__name__
+            logging.info(f'Applying func={function_name} in-process...')
+            context = filter(None, map(self.func, context))
+            if self.materialize:
+                context = list(context)
+
+        logging.info(f'Completed loading {self.filepath}')
+
+        return context
+
+
+class ScanXMLFileStage(IOStage):
+    """
+    High-throughput alternative to LoadXMLFileStage for uncompressed
+    dumps: memory-maps the file and scans it for revision blocks with
+    byte patterns instead of parsing XML.
+
+    Only revisions whose comment passes the NPOV pre-filter are yielded,
+    so apply_npov_identification gives the same results as with
+    LoadXMLFileStage.
+    """
+
+    def __init__(self,
+                 filepath,
+                 n_revisions,
+                 func=None,
+                 page_filter=None,
+                 materialize=True):
+        super().__init__(filepath)
+        self.n_revisions = n_revisions
+        self.func = func
+        self.page_filter = page_filter
+        self.materialize = materialize
+
+    def iterate_file(self):
+        with open(self.filepath, 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            yield from scan_revision_records(
+                buffer=buffer,
+                n_revisions=self.n_revisions,
+                page_filter=self.page_filter)
+
+    def apply(self, collection):
+        if is_compressed_filepath(self.filepath):
+            raise ValueError(
+                f'Scanning requires an uncompressed dump, got {self.filepath}')
+
+        logging.info(f'Scanning {self.filepath}...')
 
         if self.n_revisions:
             logging.info(
                 f'Selecting first {self.n_revisions} from {self.filepath}'
             )
 
-            context = self.truncate_generator(
-                generator=context,
-                first_n=self.n_revisions)
+        context = self.iterate_file()
 
-        logging.info(f'Completed loading {self.filepath}')
+        if self.func:
+            function_name = self.func.__name__
+            logging.info(f'Applying func={function_name} in-process...')
+            context = filter(None, map(self.func, context))
+            if self.materialize:
+                context = list(context)
+
+        logging.info(f'Completed scanning {self.filepath}')
 
         return context
 
 
+# Outcome of parsing one shard, with the bounds needed for checkpoints
+ShardResult = namedtuple(
+    'ShardResult',
+    ['n_seen', 'results', 'last_revision_id',
+     'max_revision_id', 'max_timestamp'])
+
+
+def is_after_high_water_mark(record, revision_id=None, timestamp=None):
+    if revision_id and int(record.revision_id) <= int(revision_id):
+        return False
+    if timestamp and record.timestamp <= timestamp:
+        return False
+    return True
+
+
+def apply_to_xml_shard(shard,
+                       filepath,
+                       root_tag,
+                       func,
+                       n_revisions=None,
+                       min_revision_id=None,
+                       min_timestamp=None,
+                       page_filter=None):
+    """
+    Parse a single page-aligned shard and apply func to its revisions,
+    optionally only to those newer than min_revision_id/min_timestamp.
+    """
+    start, end = shard
+    loader = LoadXMLFileStage(
+        filepath=filepath,
+        n_revisions=None,
+        page_filter=page_filter)
+
+    n_seen = 0
+    results = []
+    last_revision_id = None
+    max_revision_id = None
+    max_timestamp = None
+    with io.BufferedReader(
+            ShardReader(filepath, root_tag, start, end)) as source:
+
+        revisions = loader.iterate_revisions(source=source)
+        if n_revisions:
+            revisions = loader.truncate_generator(revisions, n_revisions)
+
+        for idx, record in enumerate(revisions):
+            n_seen += 1
+            last_revision_id = record.revision_id
+
+            if record.revision_id and (
+                    max_revision_id is None or
+                    int(record.revision_id) > int(max_revision_id)):
+                max_revision_id = record.revision_id
+
+            if record.timestamp and (
+                    max_timestamp is None or record.timestamp > max_timestamp):
+                max_timestamp = record.timestamp
+
+            if not is_after_high_water_mark(
+                    record,
+                    revision_id=min_revision_id,
+                    timestamp=min_timestamp):
+                continue
+
+            result = func(record)
+            if result:
+                results.append((idx, result))
+
+    return ShardResult(
+        n_seen=n_seen,
+        results=results,
+        last_revision_id=last_revision_id,
+        max_revision_id=max_revision_id,
+        max_timestamp=max_timestamp)
+
+
+class LoadShardedXMLFileStage(IOStage):
+    """
+    Parses an uncompressed dump as byte ranges aligned to <page> tags,
+    each in its own worker, and applies func to every revision in the
+    worker. Non-empty results are merged in file order.
+    """
+
+    # Set by Pipeline to share worker pools between stages
+    pool_manager = None
+
+    def __init__(self,
+                 filepath,
+                 func,
+                 n_revisions=None,
+                 n_shards=None,
+                 n_workers=None,
+                 page_filter=None):
+        super().__init__(filepath)
+        self.func = func
+        self.n_revisions = n_revisions
+        self.page_filter = page_filter
+        self.n_workers = n_workers or os.cpu_count()
+        self.n_shards = n_shards or 4 * self.n_workers
+
+    def iterate_shard_results(self, root_tag, shards):
+        shard_func = partial(
+            apply_to_xml_shard,
+            filepath=self.filepath,
+            root_tag=root_tag,
+            func=self.func,
+            n_revisions=self.n_revisions,
+            page_filter=self.page_filter)
+
+        n_total = 0
+        with managed_pool(self.pool_manager, self.n_workers) as pool:
+            for shard_result in pool.imap(shard_func, shards):
+
+                for idx, result in shard_result.results:
+                    if self.n_revisions and \
+                            n_total + idx >= self.n_revisions:
+                        break
+                    yield result
+
+                n_total += shard_result.n_seen
+                if self.n_revisions and n_total >= self.n_revisions:
+                    break
+
+    def apply(self, collection):
+        logging.info(f'Sharding {self.filepath}...')
+
+        root_tag, shards = get_page_aligned_shards(
+            filepath=self.filepath,
+            n_shards=self.n_shards)
+
+        function_name = self.func.__name__
+        logging.info(
+            f'Applying func={function_name} to {len(shards)} shards '
+            f'with {self.n_workers} workers...')
+
+        collection = list(self.iterate_shard_results(root_tag, shards))
+
+        logging.info(
+            f'Completed loading {self.filepath} '
+            f'with {len(collection)} results')
+
+        return collection
+
+
+class ResumableXMLFileStage(IOStage):
+    """
+    Identify over an uncompressed dump in page-aligned shards of about
+    shard_size bytes. Matches of each shard are appended to
+    output_filepath as JSONL, then the byte offset and last revision id
+    are checkpointed, so an interrupted run resumes after its last
+    completed shard.
+
+    With delta_by ('revision_id' or 'timestamp') only revisions newer
+    than the high-water mark of the previous completed run are
+    classified and appended to the existing output.
+    """
+
+    pool_manager = None
+
+    def __init__(self,
+                 filepath,
+                 output_filepath,
+                 checkpoint_filepath,
+                 func,
+                 delta_by=None,
+                 shard_size=DEFAULT_SHARD_SIZE,
+                 n_workers=None,
+                 page_filter=None):
+        super().__init__(filepath)
+        self.page_filter = page_filter
+        self.output_filepath = output_filepath
+        self.checkpoint_filepath = checkpoint_filepath
+        self.func = func
+        self.delta_by = delta_by
+        self.shard_size = shard_size
+        self.n_workers = n_workers or os.cpu_count()
+
+    def get_output_size(self):
+        if os.path.exists(self.output_filepath):
+            return os.path.getsize(self.output_filepath)
+        return 0
+
+    def prepare_run(self, checkpoint):
+        input_size = os.path.getsize(self.filepath)
+
+        if checkpoint.is_resumable(self.filepath, input_size):
+            logging.info(
+                f'Resuming {self.filepath} from byte '
+                f'{checkpoint.byte_offset} after revision_id='
+                f'{checkpoint.last_revision_id}')
+
+        elif self.delta_by:
+            checkpoint.start_run(
+                input_file=self.filepath,
+                input_size=input_size,
+                output_size=self.get_output_size())
+
+        else:
+            checkpoint.start_run(
+                input_file=self.filepath,
+                input_size=input_size,
+                output_size=0)
+
+        # Drop anything appended after the last checkpoint
+        with open(self.output_filepath, 'a') as outfile:
+            outfile.truncate(checkpoint.output_size)
+
+        checkpoint.save()
+
+    def get_delta_bounds(self, checkpoint):
+        if not self.delta_by:
+            return {}
+
+        bound = checkpoint.high_water_mark.get(self.delta_by)
+        logging.info(f'Classifying revisions with {self.delta_by} > {bound}')
+        return {f'min_{self.delta_by}': bound}
+
+    def apply(self, collection):
+        checkpoint = IdentifyCheckpoint(self.checkpoint_filepath)
+        self.prepare_run(checkpoint)
+
+        root_tag, shards = get_page_aligned_shards(
+            filepath=self.filepath,
+            shard_size=self.shard_size,
+            start_offset=checkpoint.byte_offset)
+
+        logging.info(f'Identifying over {len(shards)} remaining shards...')
+
+        shard_func = partial(
+            apply_to_xml_shard,
+            filepath=self.filepath,
+            root_tag=root_tag,
+            func=self.func,
+            page_filter=self.page_filter,
+            **self.get_delta_bounds(checkpoint))
+
+        n_results = 0
+        with managed_pool(self.pool_manager, self.n_workers) as pool, \
+                open(self.output_filepath, 'a') as outfile:
+
+            shard_results = pool.imap(shard_func, shards)
+            for (start, end), shard_result in zip(shards, shard_results):
+
+                for _, result in shard_result.results:
+                    json.dump(result, outfile)
+                    outfile.write('\n')
+                n_results += len(shard_result.results)
+
+                outfile.flush()
+                os.fsync(outfile.fileno())
+
+                checkpoint.update(
+                    byte_offset=end,
+                    shard_result=shard_result,
+                    output_size=outfile.tell())
+                checkpoint.save()
+
+        checkpoint.complete()
+        checkpoint.save()
+
+        logging.info(
+            f'Appended {n_results} results to {self.output_filepath}')
+
+        return n_results
+
+
 class SaveIterableToJSONStage(IOStage):
+    """
+    Writes a collection, or any iterator of records, as it is consumed.
+
+    With write_as_array=False records are written as JSON lines and the
+    file is flushed and fsynced every fsync_every records, so a crash
+    leaves all but the last few records readable.
+    """
 
-    def __init__(self, filepath, from_dict=False, write_as_array=True):
+    def __init__(self,
+                 filepath,
+                 from_dict=False,
+                 write_as_array=True,
+                 fsync_every=DEFAULT_FSYNC_EVERY):
         super().__init__(filepath)
         self.from_dict = from_dict
         self.write_as_array = write_as_array
+        self.fsync_every = fsync_every
 
-    def log_statistics(self, collection):
-        logging.info(f'Length of saved file: {len(collection)}')
+    def log_statistics(self, n_records):
+        logging.info(f'Length of saved file: {n_records}')
+
+    def sync(self, outfile):
+        outfile.flush()
+        os.fsync(outfile.fileno())
 
     def write_file(self, collection, filepath, write_as_array):
-        self.log_statistics(collection)
+        n_records = 0
 
-        if write_as_array:
-            with open(filepath, 'w') as outfile:
-                json.dump(collection, outfile)
-        else:
-            with open(filepath, 'w') as outfile:
+        with open(filepath, 'w', buffering=WRITE_BUFFER_SIZE) as outfile:
+            if write_as_array:
+                # Same layout as json.dump of a list
+                outfile.write('[')
+                for row in collection:
+                    if n_records:
+                        outfile.write(', ')
+                    json.dump(row, outfile)
+                    n_records += 1
+                outfile.write(']')
+
+            else:
                 for row in collection:
                     json.dump(row, outfile)
                     outfile.write('\n')
+                    n_records += 1
+
+                    if n_records % self.fsync_every == 0:
+                        self.sync(outfile)
+
+            self.sync(outfile)
 
+        self.log_statistics(n_records)
         logging.info(f'Save complete to {filepath}')
 
     def apply(self, collection):
@@ -159,6 +676,8 @@ class SaveIterableToJSONStage(IOStage):
 
 class SaveIterableToCSVStage(IOStage):
 
+    barrier = True
+
     def __init__(self, filepath):
         super().__init__(filepath)
 
@@ -181,55 +700,116 @@ class SaveIterableToCSVStage(IOStage):
         return True
 
 
+def iterate_json_array(json_file, chunk_size=READ_CHUNK_SIZE):
+    """
+    Yield the elements of a top-level JSON array one at a time, reading
+    json_file in chunks, so only the current element is held in memory.
+    """
+    name = getattr(json_file, 'name', repr(json_file))
+    decoder = json.JSONDecoder()
+    buffer = ''
+    is_eof = False
+
+    def read_more(keep_from):
+        nonlocal buffer, is_eof
+        chunk = json_file.read(chunk_size)
+        is_eof = not chunk
+        buffer = buffer[keep_from:] + chunk
+
+    while not is_eof and JSON_WHITESPACE.match(buffer).end() == len(buffer):
+        read_more(keep_from=0)
+    pos = JSON_WHITESPACE.match(buffer).end()
+
+    if buffer[pos:pos + 1] != '[':
+        raise ValueError(f'Expected a JSON array in {name}')
+    pos += 1
+
+    while True:
+        pos = JSON_SEPARATOR.match(buffer, pos).end()
+
+        if pos < len(buffer) and buffer[pos] == ']':
+            return
+
+        try:
+            element, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            element, end = None, None
+
+        if end is not None:
+            # Only a following ',' or ']' shows the element is complete;
+            # a number split by a read ('1.' of '1.5') decodes too soon
+            next_pos = JSON_WHITESPACE.match(buffer, end).end()
+            if next_pos < len(buffer) and buffer[next_pos] not in ',]':
+                if is_eof or JSON_DELIMITER.search(buffer, end):
+                    raise ValueError(f'Invalid JSON array in {name}')
+                end = None
+            elif next_pos == len(buffer) and not is_eof:
+                end = None
+
+        if end is None:
+            if is_eof:
+                raise ValueError(f'Truncated JSON array in {name}')
+            read_more(keep_from=pos)
+            pos = 0
+            continue
+
+        yield element
+        pos = end
+
+
 class LoadJSONFileStage(IOStage):
+    """ Streams records of a JSON array or JSON lines file """
 
     def __init__(self,
                  filepath,
                  n_revisions=None,
                  select_fields=None,
-                 n_workers=None):
-        super().__init__(filepath)
+                 sampler=None,
+                 materialize=True):
+        super().__init__(filepath, sampler=sampler)
         self.n_revisions = n_revisions
         self.select_fields = select_fields
-        self.n_workers = n_workers
+        self.materialize = materialize
+
+        if isinstance(select_fields, str):
+            self.select_fields = [select_fields]
 
     def filter_dict(self, item_dict, fields):
         return {k: v for k, v in item_dict.items() if k in fields}
 
-    def filter_fields(self, collection, fields):
+    def is_json_lines(self, json_file):
+        """ JSON lines start with an object (or are empty) """
+        first_char = json_file.read(1)
+        while first_char.isspace():
+            first_char = json_file.read(1)
 
-        if isinstance(fields, str):
-            fields = [fields]
+        json_file.seek(0)
+        return first_char in ('{', '')
 
-        pool = multiprocessing.Pool(self.n_workers)
+    def iterate_file(self):
+        with open(self.filepath) as json_file:
+            if self.is_json_lines(json_file):
+                records = (
+                    json.loads(line) for line in json_file if line.strip())
+            else:
+                records = iterate_json_array(json_file)
 
-        kwargs = {'fields': fields}
-        filter_func = partial(
-            self.filter_dict,
-            **kwargs)
+            for record in records:
+                if self.select_fields:
+                    record = self.filter_dict(record, self.select_fields)
+                yield record
 
-        return pool.imap(filter_func, collection)
+        logging.info(f'Completed loading {self.filepath}')
 
     def apply(self, collection):
 
         logging.info(f'Loading {self.filepath}...')
 
-        with open(self.filepath) as json_file:
-            collection = json.load(json_file)
-
-        logging.info(f'Completed loading {self.filepath}')
-
-        if self.select_fields:
-            logging.info('Filtering fields...')
-            collection = self.filter_fields(
-                collection=collection,
-                fields=self.select_fields
-            )
+        collection = self.select_revisions(
+            self.iterate_file(),
+            self.n_revisions)
 
-        if self.n_revisions:
-            logging.info(
-                f'Selecting first {self.n_revisions} from {self.filepath}'
-            )
-            collection = list(collection)[:self.n_revisions]
+        if self.materialize:
+            collection = list(collection)
 
         return collection
@@ -0,0 +1,235 @@
+import sys
+import time
+import resource
+from collections import Counter
+
+from dutch_neutrality_corpus.checkpoint import write_json_atomically
+
+THROUGHPUT_PERCENTILES = (10, 50, 90)
+
+
+def get_peak_rss():
+    """ Peak resident set size of the calling process, in bytes """
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in kilobytes on Linux, bytes on macOS
+    if sys.platform != 'darwin':
+        peak_rss *= 1024
+    return peak_rss
+
+
+def get_percentile(values, percentile):
+    """ Nearest-rank percentile of a non-empty list """
+    values = sorted(values)
+    rank = max(1, -(-len(values) * percentile // 100))
+    return values[int(rank) - 1]
+
+
+class StageMetrics():
+    """
+    Counters for one stage of a Pipeline run. The pipeline records when
+    the stage starts and what it outputs; a Stage adds what its workers
+    report per chunk: CPU time, peak RSS and bytes pickled both ways.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.started_at = None
+        self.finished_at = None
+        self.n_in = None
+        self.n_out = 0
+        self.n_results = 0
+        self.n_flattened = None
+        self.n_reused = None
+        self.n_chunks = 0
+        self.cpu_seconds = 0.
+        self.worker_peak_rss = 0
+        self.parent_peak_rss = 0
+        self.ipc_bytes_sent = 0
+        self.ipc_bytes_received = 0
+        # Output rows per second since the stage started
+        self.output_per_second = Counter()
+
+    def start(self):
+        self.started_at = time.perf_counter()
+
+    def finish(self):
+        self.finished_at = time.perf_counter()
+        self.parent_peak_rss = get_peak_rss()
+
+    def record_chunk(self, n_items, cpu_seconds, peak_rss, step_stats=None):
+        # Counts per function of a StageChain are for ChainMetrics
+        self.n_chunks += 1
+        self.n_results += n_items
+        self.cpu_seconds += cpu_seconds
+        self.worker_peak_rss = max(self.worker_peak_rss, peak_rss)
+
+    def record_sent(self, n_bytes):
+        self.ipc_bytes_sent += n_bytes
+
+    def record_received(self, n_bytes):
+        self.ipc_bytes_received += n_bytes
+
+    def record_step(self, step_stats, peak_rss):
+        """ Counts a worker reported for this stage's function in a chain """
+        self.record_chunk(
+            n_items=step_stats.n_in,
+            cpu_seconds=step_stats.cpu_seconds,
+            peak_rss=peak_rss)
+        self.n_in = (self.n_in or 0) + step_stats.n_in
+        if step_stats.n_flattened is not None:
+            self.n_flattened = \
+                (self.n_flattened or 0) + step_stats.n_flattened
+        self.record_outputs(step_stats.n_out)
+
+    def count_flattened(self, results):
+        self.n_flattened = 0
+        for result in results:
+            self.n_flattened += 1
+            yield result
+
+    def record_output(self):
+        self.record_outputs(1)
+
+    def record_outputs(self, n_out):
+        self.n_out += n_out
+        self.output_per_second[
+            int(time.perf_counter() - self.started_at)] += n_out
+
+    def iterate(self, results):
+        """ Pass results through, counting them until exhausted """
+        for result in results:
+            self.record_output()
+            yield result
+        self.finish()
+
+    def record_collection(self, collection):
+        """ Count a stage's materialized output """
+        if hasattr(collection, '__len__'):
+            self.record_outputs(len(collection))
+        self.finish()
+
+    def get_throughput_percentiles(self):
+        if not self.output_per_second:
+            return {}
+
+        # Include seconds without output; the last one is partial
+        n_seconds = max(self.output_per_second) + 1
+        rates = [self.output_per_second[s] for s in range(n_seconds)]
+        if len(rates) > 1:
+            rates = rates[:-1]
+        return {f'p{p}': get_percentile(rates, p)
+                for p in THROUGHPUT_PERCENTILES}
+
+    def asdict(self):
+        wall_seconds = None
+        if self.started_at is not None and self.finished_at is not None:
+            wall_seconds = self.finished_at - self.started_at
+
+        report = {
+            'name': self.name,
+            'wall_seconds': wall_seconds,
+            'items_in': self.n_in,
+            'items_out': self.n_out,
+            'items_per_second': self.n_out / wall_seconds
+            if wall_seconds else None,
+            'throughput_percentiles': self.get_throughput_percentiles(),
+            'parent_peak_rss_bytes': self.parent_peak_rss
+        }
+
+        if self.n_reused is not None:
+            report['items_reused'] = self.n_reused
+
+        if self.n_chunks:
+            n_before_filter = self.n_results
+            if self.n_flattened is not None:
+                n_before_filter = self.n_flattened
+                report['flatten_ratio'] = \
+                    self.n_flattened / max(self.n_results, 1)
+            report.update({
+                'filter_ratio': self.n_out / max(n_before_filter, 1),
+                'chunks': self.n_chunks,
+                'cpu_seconds': self.cpu_seconds,
+                'worker_peak_rss_bytes': self.worker_peak_rss,
+                'ipc_bytes_sent': self.ipc_bytes_sent,
+                'ipc_bytes_received': self.ipc_bytes_received
+            })
+
+        return report
+
+
+class ChainMetrics():
+    """
+    Metrics of a stage that runs the functions of several stages (see
+    StageChain), kept as a StageMetrics per function. Workers count
+    rows, outputs and CPU time per function; bytes sent are the first
+    function's, bytes received the last's, and all share the wall time.
+    """
+
+    def __init__(self, stage_metrics):
+        self.stage_metrics = stage_metrics
+
+    def start(self):
+        for metrics in self.stage_metrics:
+            metrics.start()
+            # Counted from the rows each function receives
+            metrics.n_in = 0
+
+    def finish(self):
+        for metrics in self.stage_metrics:
+            metrics.finish()
+
+    def record_sent(self, n_bytes):
+        self.stage_metrics[0].record_sent(n_bytes)
+
+    def record_received(self, n_bytes):
+        self.stage_metrics[-1].record_received(n_bytes)
+
+    def record_chunk(self, n_items, cpu_seconds, peak_rss, step_stats=None):
+        for metrics, stats in zip(self.stage_metrics, step_stats or ()):
+            metrics.record_step(stats, peak_rss)
+
+    def count_flattened(self, results):
+        # Workers already counted the rows each function flattened
+        return results
+
+    def iterate(self, results):
+        """ Pass results through, which workers already counted """
+        yield from results
+        self.finish()
+
+    def record_collection(self, collection):
+        self.finish()
+
+
+class RunReport():
+    """ Per-stage metrics of a Pipeline run, written out as JSON """
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.stage_metrics = []
+        self.started_at = time.perf_counter()
+
+    def add_stage(self, name):
+        stage_metrics = StageMetrics(name)
+        self.stage_metrics.append(stage_metrics)
+        return stage_metrics
+
+    def add_stages(self, names):
+        """ ChainMetrics for a stage running the functions named """
+        return ChainMetrics([self.add_stage(name) for name in names])
+
+    def save(self):
+        # Every stage consumes the output of the stage before it,
+        # unless its workers counted what it received
+        for previous, current in zip(self.stage_metrics,
+                                     self.stage_metrics[1:]):
+            if current.n_in is None:
+                current.n_in = previous.n_out
+
+        write_json_atomically(
+            data={
+                'wall_seconds': time.perf_counter() - self.started_at,
+                'peak_rss_bytes': get_peak_rss(),
+                'stages': [m.asdict() for m in self.stage_metrics]
+            },
+            filepath=self.filepath)
@@ -1,13 +1,312 @@
+import os
+import queue
+import logging
+import itertools
+import threading
+
+from dutch_neutrality_corpus.pools import PoolManager
+from dutch_neutrality_corpus.metrics import RunReport
+from dutch_neutrality_corpus.profiling import (
+    DEFAULT_PROFILE_INTERVAL,
+    StageProfile,
+    ChainProfile)
+from dutch_neutrality_corpus.stage import Stage, FusedStage
+from dutch_neutrality_corpus.stage_checkpoint import (
+    DEFAULT_CHECKPOINT_SHARD_RECORDS,
+    CheckpointedStages)
+
+logging.basicConfig(
+    level='INFO',
+    format='%(asctime)s %(message)s',
+    filename='dwnc.log')
+
+# Results buffered between two concurrently running stages
+DEFAULT_QUEUE_SIZE = 256
+
+END_OF_STAGE = object()
+
+
+class StageFailure():
+
+    def __init__(self, error):
+        self.error = error
+
+
+class StageThread():
+    """
+    Drains a stage's output iterator on its own thread into a bounded
+    queue, and iterates over that queue. The thread starts on first
+    iteration, so every stage has created its pool before any runs.
+    Errors are re-raised in the consuming thread.
+    """
+
+    def __init__(self, results, name, queue_size=DEFAULT_QUEUE_SIZE):
+        self.results = results
+        self.name = name
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.thread = None
+
+    def run(self):
+        try:
+            for result in self.results:
+                self.queue.put(result)
+        except BaseException as e:
+            self.queue.put(StageFailure(e))
+        else:
+            self.queue.put(END_OF_STAGE)
+
+    def __iter__(self):
+        if self.thread is None:
+            # Daemonic, so a consumer that stops early does not hang exit
+            self.thread = threading.Thread(
+                target=self.run,
+                name=self.name,
+                daemon=True)
+            self.thread.start()
+
+        while True:
+            result = self.queue.get()
+            if result is END_OF_STAGE:
+                return
+            if isinstance(result, StageFailure):
+                raise result.error
+            yield result
+
 
 class Pipeline():
     """
     Sequentially iterates over stages
+
+    With streaming=True every stage but the last passes an iterator on
+    to the next, so records flow through all stages at once. Stages
+    marked as a barrier receive the fully materialized collection.
+
+    With concurrent=True each streaming stage also runs on its own
+    thread, handing results to the next stage over a bounded queue, so
+    e.g. a network-bound stage and a CPU-bound stage overlap instead of
+    taking turns.
+
+    Worker pools are shared by all stages for the duration of apply and
+    shut down when it returns, so the last stage must consume its input.
+
+    With fuse=True, runs of plain Stages sharing an executor and worker
+    count are applied as a single FusedStage.
+
+    With checkpoint_dirpath set, runs of consecutive Stages are applied
+    per shard of shard_size input records instead, and each stage's
+    output per input record is kept in checkpoint_dirpath for later runs (see
+    CheckpointedStages). These stages are not fused.
+
+    With report_filepath set, per-stage metrics of the run (see
+    StageMetrics) are written there as JSON once it completes.
+
+    With profile_dirpath set, Stage workers sample their stacks every
+    profile_interval seconds, and the samples of each stage are written
+    to profile_dirpath/<stage>.folded for flame graphs.
     """
 
-    def __init__(self, stages):
+    def __init__(self,
+                 stages,
+                 streaming=False,
+                 concurrent=False,
+                 queue_size=DEFAULT_QUEUE_SIZE,
+                 fuse=True,
+                 checkpoint_dirpath=None,
+                 shard_size=DEFAULT_CHECKPOINT_SHARD_RECORDS,
+                 report_filepath=None,
+                 profile_dirpath=None,
+                 profile_interval=DEFAULT_PROFILE_INTERVAL):
         self.stages = stages
+        self.streaming = streaming or concurrent
+        self.concurrent = concurrent
+        self.queue_size = queue_size
+        self.fuse = fuse
+        self.checkpoint_dirpath = checkpoint_dirpath
+        self.shard_size = shard_size
+        self.report_filepath = report_filepath
+        self.profile_dirpath = profile_dirpath
+        self.profile_interval = profile_interval
+
+    def fuse_stages(self, stages):
+        fused_stages = []
+        group = []
+        for stage in stages + [None]:
+            if group and stage is not None and \
+                    FusedStage.can_fuse(group[-1], stage):
+                group.append(stage)
+                continue
+
+            if len(group) > 1:
+                fused_stages.append(FusedStage(group))
+            else:
+                fused_stages.extend(group)
+            group = [stage] if stage is not None else []
+
+        return fused_stages
+
+    def checkpoint_stages(self, stages):
+        checkpointed_stages = []
+        for is_plain, group in itertools.groupby(
+                stages, key=lambda stage: type(stage) is Stage):
+            if is_plain:
+                checkpointed_stages.append(CheckpointedStages(
+                    stages=list(group),
+                    dirpath=self.checkpoint_dirpath,
+                    shard_size=self.shard_size))
+            else:
+                checkpointed_stages.extend(group)
+
+        return checkpointed_stages
+
+    def prepare_streaming(self, stage, collection, is_last):
+        if getattr(stage, 'barrier', False):
+            if collection is not None and \
+                    not isinstance(collection, (list, dict)):
+                collection = list(collection)
+
+        elif hasattr(stage, 'materialize') and not is_last:
+            stage.materialize = False
+
+        return collection
+
+    def get_warm_modules(self):
+        """ Modules of the stage functions, imported by every worker """
+        # Fused and checkpointed stages list the stages they run
+        return [
+            getattr(sub_stage.func, '__module__', None)
+            for stage in self.stages
+            for sub_stage in getattr(stage, 'stages', [stage])
+            if callable(getattr(sub_stage, 'func', None))
+        ]
+
+    def get_stage_name(self, stage):
+        func = getattr(stage, 'func', None)
+        if func is not None:
+            return getattr(func, '__name__', type(stage).__name__)
+        return type(stage).__name__
+
+    def add_stage_metrics(self, report, stage):
+        # One entry per stage function, also when stages run together
+        sub_stages = getattr(stage, 'stages', None)
+        if sub_stages is None:
+            return report.add_stage(self.get_stage_name(stage))
+        return report.add_stages(
+            [self.get_stage_name(sub_stage) for sub_stage in sub_stages])
+
+    def create_profile(self, stage):
+        # One profile per stage function, also when stages run together
+        sub_stages = getattr(stage, 'stages', None)
+        if sub_stages is None:
+            return StageProfile(
+                name=self.get_stage_name(stage),
+                interval=self.profile_interval)
+        return ChainProfile(
+            profiles=[
+                StageProfile(
+                    name=self.get_stage_name(sub_stage),
+                    interval=self.profile_interval)
+                for sub_stage in sub_stages],
+            funcs=[sub_stage.func for sub_stage in sub_stages],
+            glue=StageProfile(
+                name=self.get_stage_name(stage),
+                interval=self.profile_interval))
+
+    def save_profiles(self, stages):
+        # Stages applying the same function share its file
+        profiles = {}
+        for stage in stages:
+            profile = getattr(stage, 'profile', None)
+            if profile is None:
+                continue
+            for sub_profile in getattr(profile, 'profiles', [profile]):
+                if not sub_profile.counts:
+                    continue
+                if sub_profile.name in profiles:
+                    profiles[sub_profile.name].merge(sub_profile.counts)
+                else:
+                    profiles[sub_profile.name] = sub_profile
+
+        if not profiles:
+            return
+
+        os.makedirs(self.profile_dirpath, exist_ok=True)
+        for profile in profiles.values():
+            filepath = profile.save(self.profile_dirpath)
+            logging.info(f'Wrote profile of {profile.name} to {filepath}')
+
+    def apply_stages(self, stages, collection, pool_manager, report=None):
+        n_stages = len(stages)
+        for idx, stage in enumerate(stages):
+            is_last = idx == n_stages - 1
+
+            if hasattr(stage, 'pool_manager'):
+                stage.pool_manager = pool_manager
+
+            if self.streaming:
+                collection = self.prepare_streaming(
+                    stage=stage,
+                    collection=collection,
+                    is_last=is_last)
+
+            metrics = None
+            if report is not None:
+                metrics = self.add_stage_metrics(report, stage)
+                if hasattr(stage, 'metrics'):
+                    stage.metrics = metrics
+                metrics.start()
+
+            if self.profile_dirpath and hasattr(stage, 'profile'):
+                stage.profile = self.create_profile(stage)
 
-    def apply(self, collection):
-        for stage in self.stages:
             collection = stage.apply(collection)
+
+            if metrics is not None:
+                if hasattr(collection, '__next__'):
+                    collection = metrics.iterate(collection)
+                else:
+                    metrics.record_collection(collection)
+
+            if self.concurrent and not is_last and \
+                    hasattr(collection, '__next__'):
+                collection = StageThread(
+                    results=collection,
+                    name=self.get_stage_name(stage),
+                    queue_size=self.queue_size)
+
+        return collection
+
+    def apply(self, collection):
+        stages = self.stages
+        if self.checkpoint_dirpath:
+            stages = self.checkpoint_stages(stages)
+        if self.fuse:
+            stages = self.fuse_stages(stages)
+
+        report = None
+        if self.report_filepath:
+            report = RunReport(self.report_filepath)
+
+        pool_manager = PoolManager(warm_modules=self.get_warm_modules())
+        try:
+            collection = self.apply_stages(
+                stages, collection, pool_manager, report)
+        except BaseException:
+            pool_manager.terminate()
+            raise
+        else:
+            pool_manager.close()
+            if self.profile_dirpath:
+                self.save_profiles(stages)
+        finally:
+            for stage in stages:
+                if hasattr(stage, 'pool_manager'):
+                    stage.pool_manager = None
+                if hasattr(stage, 'metrics'):
+                    stage.metrics = None
+                if hasattr(stage, 'profile'):
+                    stage.profile = None
+
+        if report is not None:
+            report.save()
+
         return collection
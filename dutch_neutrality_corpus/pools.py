@@ -0,0 +1,108 @@
+import os
+import logging
+import importlib
+import multiprocessing
+import multiprocessing.pool
+from contextlib import contextmanager
+
+logging.basicConfig(
+    level='INFO',
+    format='%(asctime)s %(message)s',
+    filename='dwnc.log')
+
+
+def create_pool(n_workers=None,
+                executor='processes',
+                warm_modules=(),
+                max_tasks_per_worker=None):
+    if executor == 'threads':
+        return multiprocessing.pool.ThreadPool(n_workers)
+
+    # Worker processes are replaced after max_tasks_per_worker tasks,
+    # releasing whatever memory they accumulated
+    return multiprocessing.Pool(
+        n_workers,
+        initializer=warm_worker,
+        initargs=(tuple(warm_modules),),
+        maxtasksperchild=max_tasks_per_worker)
+
+
+def warm_worker(module_names):
+    """
+    Worker initializer: import the modules stage functions live in, so
+    models and compiled patterns load at startup, not on the first task.
+    """
+    for module_name in module_names:
+        if module_name:
+            importlib.import_module(module_name)
+
+
+class PoolManager():
+    """
+    Worker pools shared by all stages of a Pipeline, created on first
+    use and kept until close(). Stages asking for the same executor and
+    number of workers (and worker recycling) get the same pool, unless
+    they pass an owner, which gets a pool of its own it may replace.
+    """
+
+    def __init__(self, warm_modules=()):
+        self.warm_modules = tuple(sorted(set(filter(None, warm_modules))))
+        self.pools = {}
+
+    def get_pool(self,
+                 n_workers=None,
+                 executor='processes',
+                 max_tasks_per_worker=None,
+                 owner=None):
+        n_workers = n_workers or os.cpu_count()
+        key = (executor, n_workers, max_tasks_per_worker, owner)
+
+        if key not in self.pools:
+            logging.info(f'Starting {n_workers} worker {executor}...')
+            self.pools[key] = create_pool(
+                n_workers=n_workers,
+                executor=executor,
+                warm_modules=self.warm_modules,
+                max_tasks_per_worker=max_tasks_per_worker)
+
+        return self.pools[key]
+
+    def replace_pool(self, pool):
+        """ Terminate pool, e.g. with a stuck task, and start a new one """
+        key = next(k for k, p in self.pools.items() if p is pool)
+        pool.terminate()
+        pool.join()
+
+        executor, n_workers, max_tasks_per_worker, _ = key
+        self.pools[key] = create_pool(
+            n_workers=n_workers,
+            executor=executor,
+            warm_modules=self.warm_modules,
+            max_tasks_per_worker=max_tasks_per_worker)
+        return self.pools[key]
+
+    def close(self):
+        """ Let workers finish outstanding tasks, then stop them """
+        for pool in self.pools.values():
+            pool.close()
+        for pool in self.pools.values():
+            pool.join()
+        self.pools = {}
+
+    def terminate(self):
+        for pool in self.pools.values():
+            pool.terminate()
+        for pool in self.pools.values():
+            pool.join()
+        self.pools = {}
+
+
+@contextmanager
+def managed_pool(pool_manager, n_workers=None, executor='processes'):
+    """ Borrow a shared pool, or run a private one for the block """
+    if pool_manager is not None:
+        yield pool_manager.get_pool(n_workers=n_workers, executor=executor)
+        return
+
+    with create_pool(n_workers=n_workers, executor=executor) as pool:
+        yield pool
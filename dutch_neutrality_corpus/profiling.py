@@ -0,0 +1,148 @@
+import os
+import sys
+import time
+import threading
+from collections import Counter
+
+DEFAULT_PROFILE_INTERVAL = 0.01
+
+# Started in each worker process on its first profiled chunk
+SAMPLER = None
+SAMPLER_LOCK = threading.Lock()
+
+
+def reset_sampler():
+    """
+    A forked worker inherits the parent's sampler without its thread,
+    and possibly its locks held, so starts over with a sampler of its own
+    """
+    global SAMPLER, SAMPLER_LOCK
+    SAMPLER = None
+    SAMPLER_LOCK = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_sampler)
+
+
+def get_frame_label(code):
+    name = getattr(code, 'co_qualname', code.co_name)
+    filename = code.co_filename
+    if 'site-packages' + os.sep in filename:
+        filename = filename.split('site-packages' + os.sep, 1)[1]
+    else:
+        filename = os.path.basename(filename)
+    return f'{name} ({filename})'
+
+
+def fold_stack(frame, root_frame):
+    """ Semicolon-separated frame labels from below root_frame to frame """
+    labels = []
+    while frame is not None and frame is not root_frame:
+        labels.append(get_frame_label(frame.f_code))
+        frame = frame.f_back
+    return ';'.join(reversed(labels))
+
+
+class StackSampler():
+    """
+    Daemon thread that every interval seconds records the stacks of the
+    threads currently registered with start, from just below their
+    root frame. Samples are folded stacks counted per thread.
+    """
+
+    def __init__(self, interval=DEFAULT_PROFILE_INTERVAL):
+        self.interval = interval
+        # Thread id -> (root frame, Counter of folded stacks)
+        self.active = {}
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(
+            target=self.run,
+            name='stack-sampler',
+            daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                if not self.active:
+                    continue
+                frames = sys._current_frames()
+                for thread_id, (root_frame, counts) in self.active.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        stack = fold_stack(frame, root_frame)
+                        if stack:
+                            counts[stack] += 1
+
+    def start(self, root_frame):
+        with self.lock:
+            self.active[threading.get_ident()] = (root_frame, Counter())
+
+    def stop(self):
+        with self.lock:
+            _, counts = self.active.pop(threading.get_ident())
+        return counts
+
+
+def get_sampler(interval):
+    global SAMPLER
+    with SAMPLER_LOCK:
+        if SAMPLER is None:
+            SAMPLER = StackSampler(interval=interval)
+    return SAMPLER
+
+
+class StageProfile():
+    """
+    Folded stack samples of one stage, merged over all workers, written
+    in the collapsed format read by flamegraph.pl and speedscope.
+    """
+
+    def __init__(self, name, interval=DEFAULT_PROFILE_INTERVAL):
+        self.name = name
+        self.interval = interval
+        self.counts = Counter()
+
+    def merge(self, counts):
+        self.counts.update(counts)
+
+    def save(self, dirpath):
+        filename = self.name.replace(os.sep, '_')
+        filepath = os.path.join(dirpath, f'{filename}.folded')
+        with open(filepath, 'w') as f:
+            for stack, count in sorted(self.counts.items()):
+                f.write(f'{stack} {count}\n')
+        return filepath
+
+
+class ChainProfile():
+    """
+    Profiles of the functions of several stages run in one worker call
+    (see StageChain). A sample goes to the function of the outermost
+    frame that is one of them, stacks from that frame; samples taken
+    between functions go to glue.
+    """
+
+    def __init__(self, profiles, funcs, glue):
+        self.interval = glue.interval
+        self.glue = glue
+        self.profiles = profiles + [glue]
+        self.profile_by_label = {}
+        for profile, func in zip(profiles, funcs):
+            code = getattr(func, '__code__', None)
+            if code is not None:
+                self.profile_by_label.setdefault(
+                    get_frame_label(code), profile)
+
+    def merge(self, counts):
+        for stack, count in counts.items():
+            labels = stack.split(';')
+            for idx, label in enumerate(labels):
+                profile = self.profile_by_label.get(label)
+                if profile is not None:
+                    profile.counts[';'.join(labels[idx:])] += count
+                    break
+            else:
+                self.glue.counts[stack] += count
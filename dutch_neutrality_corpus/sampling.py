@@ -0,0 +1,149 @@
+import math
+import random
+import logging
+from collections import defaultdict
+
+logging.basicConfig(
+    level='INFO',
+    format='%(asctime)s %(message)s',
+    filename='dwnc.log')
+
+# Each stratum keeps up to n_items, so their number bounds memory
+DEFAULT_MAX_STRATA = 100
+
+
+def open_unit_interval(rng):
+    """ Uniform draw from (0, 1), safe to take the log of """
+    u = rng.random()
+    while u == 0.0:
+        u = rng.random()
+    return u
+
+
+class Reservoir():
+    """
+    Uniform sample of up to k items from a stream of unknown length
+    (Li's Algorithm L), keeping each item's position in the stream.
+    """
+
+    def __init__(self, k, rng):
+        self.k = k
+        self.rng = rng
+        self.items = []
+        self.n_seen = 0
+        self.w = 1.0
+        self.next_index = None
+
+    def draw_next_index(self):
+        self.w *= math.exp(math.log(open_unit_interval(self.rng)) / self.k)
+        skip = math.floor(
+            math.log(open_unit_interval(self.rng)) / math.log1p(-self.w))
+        self.next_index = self.n_seen + skip + 1
+
+    def add(self, idx, item):
+        self.n_seen += 1
+
+        if len(self.items) < self.k:
+            self.items.append((idx, item))
+            if len(self.items) == self.k:
+                self.draw_next_index()
+
+        elif self.n_seen == self.next_index:
+            self.items[self.rng.randrange(self.k)] = (idx, item)
+            self.draw_next_index()
+
+
+class ReservoirSampler():
+    """
+    Seeded sample of n_items from an iterable in a single streaming pass.
+
+    Uniform by default. With stratify_by (a field name or a function of
+    the item) every stratum keeps its own reservoir of n_items and the
+    final sample is allocated proportionally to stratum sizes, so memory
+    is bounded by n_items per stratum. stratify_prefix truncates field
+    values, e.g. 4 to stratify timestamps by year. A stream with more
+    than max_strata strata raises a ValueError.
+
+    The sample is returned in stream order.
+    """
+
+    def __init__(self,
+                 n_items,
+                 seed=None,
+                 stratify_by=None,
+                 stratify_prefix=None,
+                 max_strata=DEFAULT_MAX_STRATA):
+        self.n_items = int(n_items)
+        self.seed = seed
+        self.stratify_by = stratify_by
+        self.stratify_prefix = stratify_prefix
+        self.max_strata = max_strata
+
+    def get_stratum(self, item):
+        if callable(self.stratify_by):
+            return self.stratify_by(item)
+
+        if isinstance(item, dict):
+            value = item.get(self.stratify_by)
+        else:
+            value = getattr(item, self.stratify_by, None)
+
+        if self.stratify_prefix and value is not None:
+            value = str(value)[:self.stratify_prefix]
+        return value
+
+    def allocate(self, reservoirs):
+        """ Proportional allocation by largest remainder """
+        n_total = sum(r.n_seen for r in reservoirs.values())
+        n_items = min(self.n_items, n_total)
+
+        quotas = {
+            stratum: n_items * r.n_seen / n_total
+            for stratum, r in reservoirs.items()
+        }
+        allocation = {s: int(q) for s, q in quotas.items()}
+
+        remainders = sorted(
+            quotas,
+            key=lambda s: (quotas[s] - allocation[s], str(s)),
+            reverse=True)
+        for stratum in remainders[:n_items - sum(allocation.values())]:
+            allocation[stratum] += 1
+
+        return allocation
+
+    def sample(self, iterable):
+        rng = random.Random(self.seed)
+
+        if not self.stratify_by:
+            reservoir = Reservoir(k=self.n_items, rng=rng)
+            for idx, item in enumerate(iterable):
+                reservoir.add(idx, item)
+            sample = reservoir.items
+
+        else:
+            reservoirs = defaultdict(
+                lambda: Reservoir(k=self.n_items, rng=rng))
+            for idx, item in enumerate(iterable):
+                stratum = self.get_stratum(item)
+                if stratum not in reservoirs and \
+                        len(reservoirs) >= self.max_strata:
+                    raise ValueError(
+                        f'More than {self.max_strata} strata for '
+                        f'stratify_by={self.stratify_by!r}; set '
+                        'stratify_prefix, e.g. 4 for the year of a '
+                        'timestamp, or stratify on a coarser field')
+                reservoirs[stratum].add(idx, item)
+
+            if not reservoirs:
+                return []
+
+            allocation = self.allocate(reservoirs)
+            logging.info(f'Stratified sample allocation: {allocation}')
+
+            sample = []
+            for stratum, reservoir in reservoirs.items():
+                sample.extend(
+                    rng.sample(reservoir.items, allocation[stratum]))
+
+        return [item for _, item in sorted(sample, key=lambda x: x[0])]
@@ -1,37 +1,341 @@
+import os
+import sys
+import time
+import queue
+import pickle
 import logging
-import multiprocessing
+import itertools
+import threading
 from functools import partial
+from collections import deque, namedtuple
+
+from dutch_neutrality_corpus.pools import create_pool
+from dutch_neutrality_corpus.metrics import get_peak_rss
+from dutch_neutrality_corpus.profiling import get_sampler
+from dutch_neutrality_corpus.dataset.ratelimit import FailedRevisionLog
 
 logging.basicConfig(
     level='INFO',
     format='%(asctime)s %(message)s',
     filename='dwnc.log')
 
+# Tasks queued per worker before the stage stops pulling input
+IN_FLIGHT_PER_WORKER = 4
+
+# Automatic chunk sizing aims for chunks taking about this long
+TARGET_CHUNK_SECONDS = 0.05
+MAX_AUTO_CHUNKSIZE = 1024
+CHUNK_COST_SMOOTHING = 0.2
+
+
+# What a worker reports back for each chunk
+ChunkResult = namedtuple(
+    'ChunkResult',
+    ['seconds', 'cpu_seconds', 'peak_rss', 'results', 'profile',
+     'step_stats'])
+
+
+class StepStats():
+    """ What one function of a StageChain did over a chunk """
+
+    def __init__(self, flatten=False):
+        self.n_in = 0
+        self.n_flattened = 0 if flatten else None
+        self.n_out = 0
+        self.cpu_seconds = 0.
+
+
+def apply_chunk(func, items, profile_interval=None):
+    """
+    Worker side: apply func to a chunk of items and time it. With a
+    profile_interval, also sample the stacks below this call.
+    """
+    sampler = None
+    if profile_interval:
+        sampler = get_sampler(profile_interval)
+        sampler.start(root_frame=sys._getframe())
+
+    step_stats = None
+    if isinstance(func, StageChain):
+        step_stats = func.get_step_stats()
+        func = partial(func, step_stats=step_stats)
+
+    start = time.perf_counter()
+    cpu_start = time.thread_time()
+    try:
+        results = []
+        for item in items:
+            results.append(func(item))
+    finally:
+        profile = sampler.stop() if sampler is not None else None
+
+    return ChunkResult(
+        seconds=time.perf_counter() - start,
+        cpu_seconds=time.thread_time() - cpu_start,
+        peak_rss=get_peak_rss(),
+        results=results,
+        profile=profile,
+        step_stats=step_stats)
+
+
+def apply_pickled_chunk(func, payload, profile_interval=None):
+    """ apply_chunk on pickled items and results, to measure their size """
+    chunk_result = apply_chunk(func, pickle.loads(payload), profile_interval)
+    return chunk_result._replace(results=pickle.dumps(
+        chunk_result.results,
+        protocol=pickle.HIGHEST_PROTOCOL))
+
+
+class ChunkSizer():
+    """
+    Chunk size for a stage, fixed or (chunksize='auto') derived from
+    the measured per-item cost so each chunk takes about
+    TARGET_CHUNK_SECONDS. Starts at one item per chunk.
+    """
+
+    def __init__(self, chunksize=1):
+        self.is_auto = chunksize == 'auto'
+        self.chunksize = 1 if self.is_auto else int(chunksize)
+        self.item_seconds = None
+
+    def record(self, seconds, n_items):
+        if not self.is_auto or not n_items:
+            return
+
+        item_seconds = seconds / n_items
+        if self.item_seconds is None:
+            self.item_seconds = item_seconds
+        else:
+            self.item_seconds += CHUNK_COST_SMOOTHING * \
+                (item_seconds - self.item_seconds)
+
+        self.chunksize = int(min(
+            MAX_AUTO_CHUNKSIZE,
+            max(1, TARGET_CHUNK_SECONDS / max(self.item_seconds, 1e-9))))
+
+
+def restore_order(results, index_field, drop_index=True):
+    """
+    Sort rows from an unordered stage back into input order by the
+    index it stored in index_field. Needs the whole collection.
+    """
+    results = sorted(results, key=lambda row: row[index_field])
+    if drop_index:
+        for row in results:
+            del row[index_field]
+    return results
+
 
 class Stage():
     """
     Parallelises function as part of Pipeline object
     """
 
+    EXECUTORS = ('processes', 'threads')
+
+    # Stages that need the whole collection at once set this
+    barrier = False
+
+    # Set by Pipeline to share worker pools between stages
+    pool_manager = None
+
+    # Set by Pipeline to a StageMetrics when it reports on the run
+    metrics = None
+
+    # Set by Pipeline to a StageProfile to sample worker stacks
+    profile = None
+
     def __init__(self,
                  func,
                  n_workers=None,
                  filter_collection=False,
                  func_kwargs={},
                  accumulate=False,
-                 flatten=False):
+                 flatten=False,
+                 materialize=True,
+                 max_in_flight=None,
+                 executor='processes',
+                 chunksize='auto',
+                 ordered=True,
+                 index_field=None,
+                 timeout=None,
+                 quarantine_filepath=None,
+                 max_tasks_per_worker=None):
         self.func = func
         self.n_workers = n_workers
         self.filter_collection = filter_collection
         self.func_kwargs = func_kwargs
         self.accumulate = accumulate
         self.flatten = flatten
+        # False: apply returns an iterator over the results instead of a
+        # list, for streaming; the other stages with apply follow this
+        self.materialize = materialize
+        # Chunks read ahead of the results consumed
+        self.max_in_flight = max_in_flight
+        # 'threads' for stages that mostly wait on the network
+        self.executor = executor
+        # Items per chunk, or 'auto' to size from the cost per item
+        self.chunksize = chunksize
+        # With ordered=False, index_field stores each item's input
+        # position in its results for restore_order
+        self.ordered = ordered
+        self.index_field = index_field
+        # Items running longer are abandoned, their revision ids
+        # appended to quarantine_filepath, and the workers replaced
+        self.timeout = timeout
+        self.quarantine_filepath = quarantine_filepath
+        # Replace worker processes after this many tasks
+        self.max_tasks_per_worker = max_tasks_per_worker
 
-    def update_collection(self, collection, results):
-        """ Merge within stage """
-        if not isinstance(results, list):
-            results = list(results)
-        return ({**c, **r} for c, r in zip(collection, results))
+        if executor not in self.EXECUTORS:
+            raise ValueError(f'executor must be one of {self.EXECUTORS}')
+        if timeout is not None and executor == 'threads':
+            raise ValueError('timeout needs executor=\'processes\'')
+
+    def get_max_in_flight(self):
+        return self.max_in_flight or \
+            IN_FLIGHT_PER_WORKER * (self.n_workers or os.cpu_count())
+
+    def get_pool(self):
+        """ A shared pool, or a private one the stage shuts down """
+        if self.pool_manager is not None:
+            # Pools are torn down on timeouts, so those are not shared
+            # with other stages, only kept for the stage's next apply
+            pool = self.pool_manager.get_pool(
+                n_workers=self.n_workers,
+                executor=self.executor,
+                max_tasks_per_worker=self.max_tasks_per_worker,
+                owner=id(self) if self.timeout is not None else None)
+            return pool, False
+
+        return self.create_private_pool(), True
+
+    def create_private_pool(self):
+        warm_modules = [getattr(self.func, '__module__', None)]
+        if self.pool_manager is not None:
+            warm_modules = self.pool_manager.warm_modules
+
+        return create_pool(
+            n_workers=self.n_workers,
+            executor=self.executor,
+            warm_modules=warm_modules,
+            max_tasks_per_worker=self.max_tasks_per_worker)
+
+    def get_worker_func(self):
+        if self.func_kwargs:
+            return partial(self.func, **self.func_kwargs)
+        return self.func
+
+    def iterate_chunks(self, collection, chunk_sizer):
+        """ Lists of (index, item), sized at the time each is cut """
+        indexed_items = enumerate(collection)
+        while True:
+            chunk = list(itertools.islice(
+                indexed_items, chunk_sizer.chunksize))
+            if not chunk:
+                return
+            yield chunk
+
+    def attach_index(self, result, idx):
+        rows = result if isinstance(result, list) else [result]
+        for row in rows:
+            if isinstance(row, dict) and row:
+                row[self.index_field] = idx
+
+    def iterate_chunk_results(self, chunk, chunk_result, chunk_sizer):
+        chunk_sizer.record(chunk_result.seconds, len(chunk))
+
+        if self.profile is not None and chunk_result.profile:
+            self.profile.merge(chunk_result.profile)
+
+        results = chunk_result.results
+        if self.metrics is not None:
+            if isinstance(results, bytes):
+                self.metrics.record_received(len(results))
+                results = pickle.loads(results)
+            self.metrics.record_chunk(
+                n_items=len(chunk),
+                cpu_seconds=chunk_result.cpu_seconds,
+                peak_rss=chunk_result.peak_rss,
+                step_stats=chunk_result.step_stats)
+
+        for (idx, item), result in zip(chunk, results):
+            # Merge within stage
+            if self.accumulate:
+                result = {**item, **result}
+            if self.index_field:
+                self.attach_index(result, idx)
+            yield result
+
+    def dispatch(self, pool, chunk, callback=None, error_callback=None):
+        profile_interval = None
+        if self.profile is not None:
+            profile_interval = self.profile.interval
+
+        worker_func = apply_chunk
+        items = [item for _, item in chunk]
+
+        # Pickle here rather than in the pool, to count the bytes
+        if self.metrics is not None and self.executor == 'processes':
+            items = pickle.dumps(items, protocol=pickle.HIGHEST_PROTOCOL)
+            self.metrics.record_sent(len(items))
+            worker_func = apply_pickled_chunk
+
+        args = (self.get_worker_func(), items, profile_interval)
+
+        return pool.apply_async(
+            worker_func,
+            args,
+            callback=callback,
+            error_callback=error_callback)
+
+    def imap_bounded(self, pool, collection):
+        """ Ordered imap that only reads ahead max_in_flight chunks """
+        max_in_flight = self.get_max_in_flight()
+        chunk_sizer = ChunkSizer(self.chunksize)
+        window = deque()
+
+        for chunk in self.iterate_chunks(collection, chunk_sizer):
+            window.append((chunk, self.dispatch(pool, chunk)))
+            if len(window) >= max_in_flight:
+                chunk, async_result = window.popleft()
+                yield from self.iterate_chunk_results(
+                    chunk, async_result.get(), chunk_sizer)
+
+        while window:
+            chunk, async_result = window.popleft()
+            yield from self.iterate_chunk_results(
+                chunk, async_result.get(), chunk_sizer)
+
+    def imap_unordered_bounded(self, pool, collection):
+        """ As imap_bounded, yielding chunks in completion order """
+        max_in_flight = self.get_max_in_flight()
+        chunk_sizer = ChunkSizer(self.chunksize)
+        completed = queue.Queue()
+        n_pending = 0
+
+        def pop_completed():
+            chunk, chunk_result, error = completed.get()
+            if error is not None:
+                raise error
+            return self.iterate_chunk_results(chunk, chunk_result, chunk_sizer)
+
+        for chunk in self.iterate_chunks(collection, chunk_sizer):
+            self.dispatch(
+                pool,
+                chunk,
+                callback=partial(
+                    lambda c, r: completed.put((c, r, None)), chunk),
+                error_callback=lambda e: completed.put((None, None, e)))
+            n_pending += 1
+
+            if n_pending >= max_in_flight:
+                yield from pop_completed()
+                n_pending -= 1
+
+        while n_pending:
+            yield from pop_completed()
+            n_pending -= 1
 
     def flatten_results(self, results):
         """ Flatten list of lists """
@@ -43,39 +347,302 @@ class Stage():
             for row in rows:
                 yield row
 
-    def apply(self, collection):
+    def quarantine(self, chunk):
+        for _, item in chunk:
+            if isinstance(item, dict):
+                revision_id = item.get('revision_id')
+            else:
+                revision_id = getattr(item, 'revision_id', None)
 
-        function_name = self.func.__name__
-        logging.info(f'Applying Stage(func={function_name})...')
+            logging.warning(
+                f'Quarantined revision_id={revision_id}: '
+                f'{self.func.__name__} exceeded {self.timeout}s')
+            if self.quarantine_filepath:
+                FailedRevisionLog(self.quarantine_filepath).record(
+                    revision_id=revision_id,
+                    reason=f'timeout {self.timeout}s')
 
-        # Distributes work over cores
-        pool = multiprocessing.Pool(self.n_workers)
+    def pop_ready(self, window):
+        """ Completed entries of the window that may be yielded now """
+        ready = []
+        for idx, (chunk, async_result, _) in list(window.items()):
+            if async_result.ready():
+                ready.append((chunk, async_result))
+                del window[idx]
+            elif self.ordered:
+                break
+        return ready
 
-        if self.func_kwargs:
-            self.func = partial(
-                self.func,
-                **self.func_kwargs)
+    def pop_expired(self, window):
+        now = time.monotonic()
+        expired = []
+        for idx, (chunk, async_result, deadline) in list(window.items()):
+            if deadline <= now and not async_result.ready():
+                expired.append(chunk)
+                del window[idx]
+        return expired
 
-        results = pool.imap(self.func, collection)
+    def get_wait_seconds(self, window):
+        deadline = min(deadline for _, _, deadline in window.values())
+        return max(0, deadline - time.monotonic())
 
-        # Update collection with new results
-        if self.accumulate:
-            results = self.update_collection(collection, results)
+    def recycle_pool(self, pool, created_pools):
+        """ Kill the workers, stragglers included, and start new ones """
+        if self.pool_manager is not None:
+            return self.pool_manager.replace_pool(pool)
 
-        if self.flatten:
-            logging.info(f'Flattening Stage(func={function_name})...')
-            results = self.flatten_results(results)
+        pool.terminate()
+        pool.join()
+        pool = self.create_private_pool()
+        created_pools.append(pool)
+        return pool
 
-        # Remove empty elements
-        if self.filter_collection:
-            logging.info(f'Filtering Stage(func={function_name})...')
-            results = filter(None, results)
+    def imap_with_timeout(self, pool, collection):
+        """ Dispatch one item per free worker, abandoning stragglers """
+        n_workers = self.n_workers or os.cpu_count()
+        chunk_sizer = ChunkSizer(1)
+        chunks = self.iterate_chunks(collection, chunk_sizer)
+        completed = threading.Event()
+        # Input index -> (chunk, async result, deadline), in input order
+        window = {}
+        created_pools = []
 
-        # Invoke
-        results = list(results)
+        def submit(chunk):
+            async_result = self.dispatch(
+                pool,
+                chunk,
+                callback=lambda _: completed.set(),
+                error_callback=lambda _: completed.set())
+            window[chunk[0][0]] = (
+                chunk, async_result, time.monotonic() + self.timeout)
+
+        def settle(limit):
+            """ Yield results until fewer than limit items are in flight """
+            nonlocal pool
+            while len(window) >= limit:
+                completed.clear()
+                ready = self.pop_ready(window)
+                for chunk, async_result in ready:
+                    yield from self.iterate_chunk_results(
+                        chunk, async_result.get(), chunk_sizer)
+                if ready:
+                    continue
+
+                expired = self.pop_expired(window)
+                if not expired:
+                    completed.wait(self.get_wait_seconds(window))
+                    continue
+
+                pool = self.recycle_pool(pool, created_pools)
+                for chunk in expired:
+                    self.quarantine(chunk)
+                for chunk, _, _ in list(window.values()):
+                    submit(chunk)
+
+        try:
+            for chunk in chunks:
+                submit(chunk)
+                yield from settle(limit=n_workers)
+            yield from settle(limit=1)
+
+        finally:
+            for created_pool in created_pools:
+                created_pool.terminate()
+
+    def iterate_results(self, pool, owns_pool, collection, function_name):
+        try:
+            if self.timeout is not None:
+                results = self.imap_with_timeout(pool, collection)
+            elif self.ordered:
+                results = self.imap_bounded(pool, collection)
+            else:
+                results = self.imap_unordered_bounded(pool, collection)
+
+            if self.flatten:
+                logging.info(f'Flattening Stage(func={function_name})...')
+                results = self.flatten_results(results)
+                if self.metrics is not None:
+                    results = self.metrics.count_flattened(results)
+
+            # Remove empty elements
+            if self.filter_collection:
+                logging.info(f'Filtering Stage(func={function_name})...')
+                results = filter(None, results)
+
+            n_results = 0
+            for result in results:
+                n_results += 1
+                yield result
+
+        finally:
+            if owns_pool:
+                pool.terminate()
 
         logging.info(
             f'Completed Stage(func={function_name}) '
-            f'with {len(results)} results')
+            f'with {n_results} results')
+
+    def apply(self, collection):
+
+        function_name = self.func.__name__
+        logging.info(f'Applying Stage(func={function_name})...')
+
+        # Distributes work over cores. Created here rather than in the
+        # iterator, which may be advanced from another stage's thread
+        pool, owns_pool = self.get_pool()
+
+        results = self.iterate_results(
+            pool=pool,
+            owns_pool=owns_pool,
+            collection=collection,
+            function_name=function_name)
+
+        # Invoke
+        if self.materialize:
+            results = list(results)
 
         return results
+
+
+class RestoreOrderStage():
+    """ Puts the output of an unordered Stage back into input order """
+
+    # Sorting needs the whole collection
+    barrier = True
+
+    def __init__(self, index_field, drop_index=True):
+        self.index_field = index_field
+        self.drop_index = drop_index
+
+    def apply(self, collection):
+        return restore_order(
+            results=[row for row in collection if row],
+            index_field=self.index_field,
+            drop_index=self.drop_index)
+
+
+class StageChain():
+    """
+    Applies the functions of consecutive stages to one item in a single
+    worker call, reproducing each stage's accumulate, flatten and
+    filter_collection behaviour. Returns the list of resulting rows.
+    Given step_stats, counts rows and CPU time per function in them.
+    """
+
+    def __init__(self, stages):
+        self.steps = [
+            (partial(s.func, **s.func_kwargs) if s.func_kwargs else s.func,
+             s.accumulate,
+             s.flatten,
+             s.filter_collection)
+            for s in stages
+        ]
+        self.__name__ = '+'.join(s.func.__name__ for s in stages)
+
+    def get_step_stats(self):
+        return [StepStats(flatten=flatten)
+                for _, _, flatten, _ in self.steps]
+
+    def __call__(self, item, step_stats=None):
+        rows = [item]
+        for idx, step in enumerate(self.steps):
+            func, accumulate, flatten, filter_collection = step
+            cpu_start = time.thread_time()
+            n_flattened = 0
+            next_rows = []
+            for row in rows:
+                result = func(row)
+
+                if accumulate:
+                    result = {**row, **result}
+
+                # Flattening an empty result yields one empty row
+                results = (result or [{}]) if flatten else [result]
+                n_flattened += len(results)
+
+                if filter_collection:
+                    results = [r for r in results if r]
+
+                next_rows.extend(results)
+
+            if step_stats is not None:
+                stats = step_stats[idx]
+                stats.n_in += len(rows)
+                stats.n_out += len(next_rows)
+                stats.cpu_seconds += time.thread_time() - cpu_start
+                if flatten:
+                    stats.n_flattened += n_flattened
+            rows = next_rows
+        return rows
+
+
+# A list of rows derived from one input record, with its position
+RowListTask = namedtuple('RowListTask', ['index', 'rows', 'revision_id'])
+
+
+class RowListChain(StageChain):
+    """ StageChain over all rows of a RowListTask """
+
+    def __call__(self, task, step_stats=None):
+        rows = []
+        for row in task.rows:
+            rows.extend(super().__call__(row, step_stats=step_stats))
+        return task.index, rows
+
+
+class FusedStage(Stage):
+    """
+    Consecutive plain Stages with the same executor and workers run as
+    one, so each item crosses the process boundary once instead of once
+    per stage.
+    """
+
+    chain_class = StageChain
+
+    def __init__(self, stages):
+        first, last = stages[0], stages[-1]
+        super().__init__(
+            func=self.chain_class(stages),
+            n_workers=first.n_workers,
+            flatten=True,
+            materialize=last.materialize,
+            max_in_flight=first.max_in_flight,
+            executor=first.executor,
+            chunksize=first.chunksize,
+            ordered=first.ordered and last.ordered,
+            index_field=first.index_field or last.index_field,
+            max_tasks_per_worker=first.max_tasks_per_worker)
+        self.stages = stages
+
+    def flatten_results(self, results):
+        # The chain already produced the exact rows, including empty ones
+        for rows in results:
+            yield from rows
+
+    @staticmethod
+    def can_fuse(stage, next_stage):
+        return type(stage) is Stage and \
+            type(next_stage) is Stage and \
+            stage.executor == next_stage.executor and \
+            stage.n_workers == next_stage.n_workers and \
+            stage.max_tasks_per_worker == next_stage.max_tasks_per_worker and \
+            stage.timeout is None and next_stage.timeout is None
+
+
+class RowListStage(FusedStage):
+    """
+    Applies one Stage to RowListTasks, returning (index, rows) for each
+    task, so outputs can be traced back to the record they came from.
+    Tasks over the stage's timeout are quarantined and left out.
+    """
+
+    chain_class = RowListChain
+
+    def __init__(self, stage):
+        super().__init__([stage])
+        self.flatten = False
+        self.materialize = True
+        self.ordered = True
+        self.index_field = None
+        self.timeout = stage.timeout
+        self.quarantine_filepath = stage.quarantine_filepath
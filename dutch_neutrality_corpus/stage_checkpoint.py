@@ -0,0 +1,300 @@
+import os
+import sys
+import json
+import zlib
+import inspect
+import sqlite3
+import hashlib
+import logging
+import itertools
+
+from dutch_neutrality_corpus.stage import RowListTask, RowListStage
+from dutch_neutrality_corpus.metrics import ChainMetrics
+from dutch_neutrality_corpus.profiling import ChainProfile
+
+logging.basicConfig(
+    level='INFO',
+    format='%(asctime)s %(message)s',
+    filename='dwnc.log')
+
+# Input records per checkpointed shard
+DEFAULT_CHECKPOINT_SHARD_RECORDS = 1000
+
+STAGE_OUTPUTS_FILENAME = 'stage_outputs.sqlite'
+
+# Keys per SELECT, below SQLite's limit on query parameters
+LOOKUP_BATCH_SIZE = 500
+
+
+def hash_json(data):
+    encoded = json.dumps(data, sort_keys=True, default=str).encode()
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def get_source_modules(func):
+    """
+    The module func is defined in and, transitively, the modules of its
+    package it imports or imports names from
+    """
+    package = func.__module__.split('.')[0]
+    modules = {}
+    pending = [inspect.getmodule(func)]
+    while pending:
+        module = pending.pop()
+        if module is None or module.__name__ in modules:
+            continue
+        modules[module.__name__] = module
+
+        for value in vars(module).values():
+            if not inspect.ismodule(value):
+                value = sys.modules.get(getattr(value, '__module__', None))
+            name = getattr(value, '__name__', '')
+            if name == package or name.startswith(f'{package}.'):
+                pending.append(value)
+
+    return [modules[name] for name in sorted(modules)]
+
+
+def get_source_hash(func):
+    """ Hash of the sources of get_source_modules(func) """
+    source_hash = hashlib.sha256()
+    for module in get_source_modules(func):
+        try:
+            source = inspect.getsource(module)
+        except (TypeError, OSError):
+            source = ''
+        source_hash.update(module.__name__.encode())
+        source_hash.update(source.encode())
+    return source_hash.hexdigest()
+
+
+def get_stage_fingerprint(stage):
+    """
+    Everything that determines a Stage's output for a given input: the
+    function, its version attribute if any, the source of its module and
+    of the package modules that one uses, its kwargs and how results are
+    merged, flattened and filtered. Bump version when the function
+    depends on anything else that changes its output, e.g. a data file.
+    """
+    func = stage.func
+    return {
+        'func': f'{func.__module__}.{func.__qualname__}',
+        'version': getattr(func, 'version', None),
+        'source': get_source_hash(func),
+        'func_kwargs': stage.func_kwargs,
+        'accumulate': stage.accumulate,
+        'flatten': stage.flatten,
+        'filter_collection': stage.filter_collection
+    }
+
+
+def get_revision_id(rows):
+    for row in rows:
+        if isinstance(row, dict):
+            revision_id = row.get('revision_id')
+        else:
+            revision_id = getattr(row, 'revision_id', None)
+        if revision_id is not None:
+            return revision_id
+    return None
+
+
+class StageOutputStore():
+    """
+    Output rows of stages per input record in a single SQLite file,
+    zlib-compressed JSON keyed by record and stage. Outputs of a shard
+    are written in one transaction, so a shard is stored completely or
+    not at all.
+    """
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.connection = sqlite3.connect(
+            filepath,
+            timeout=60,
+            isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS stage_outputs ('
+            'key TEXT PRIMARY KEY, '
+            'stage TEXT NOT NULL, '
+            'rows BLOB NOT NULL)')
+
+    def get_many(self, keys):
+        """ Stored rows by key, for the keys that are stored """
+        stored = {}
+        for start in range(0, len(keys), LOOKUP_BATCH_SIZE):
+            batch = keys[start:start + LOOKUP_BATCH_SIZE]
+            placeholders = ', '.join('?' * len(batch))
+            query = (
+                'SELECT key, rows FROM stage_outputs '
+                f'WHERE key IN ({placeholders})')
+            for key, rows in self.connection.execute(query, batch):
+                stored[key] = json.loads(zlib.decompress(rows))
+        return stored
+
+    def put_many(self, stage_name, rows_by_key):
+        self.connection.execute('BEGIN')
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO stage_outputs (key, stage, rows) '
+            'VALUES (?, ?, ?)',
+            [(key, stage_name, zlib.compress(json.dumps(rows).encode()))
+             for key, rows in rows_by_key.items()])
+        self.connection.execute('COMMIT')
+
+    def close(self):
+        self.connection.close()
+
+
+class CheckpointedStages():
+    """
+    Runs consecutive Stages shard by shard, storing what every stage
+    produced from each input record. A record's key for a stage hashes
+    its key for the previous stage (the record itself for the first)
+    with the stage's fingerprint. Keys do not depend on which shard a
+    record arrives in, or in which order, so a rerun only applies
+    stages whose function, kwargs or input changed, and an interrupted
+    run picks up after the last stored shard.
+    """
+
+    # Set by Pipeline and passed on to the stages
+    pool_manager = None
+    metrics = None
+    profile = None
+
+    def __init__(self,
+                 stages,
+                 dirpath,
+                 shard_size=DEFAULT_CHECKPOINT_SHARD_RECORDS,
+                 materialize=True):
+        self.stages = stages
+        self.dirpath = dirpath
+        self.shard_size = shard_size
+        self.materialize = materialize
+        self.names = [stage.func.__name__ for stage in stages]
+        self.fingerprints = [
+            hash_json(get_stage_fingerprint(stage)) for stage in stages]
+        # Each stage applied to the rows derived from one record at once
+        self.row_list_stages = [RowListStage(stage) for stage in stages]
+        self.n_reused = 0
+        self.n_computed = 0
+
+    def iterate_shards(self, collection):
+        collection = iter(collection)
+        while True:
+            shard = list(itertools.islice(collection, self.shard_size))
+            if not shard:
+                return
+            yield shard
+
+    def get_keys(self, shard):
+        """ Per stage, the key of each record in the shard """
+        keys = [hash_json(record) for record in shard]
+        keys_by_stage = []
+        for fingerprint in self.fingerprints:
+            keys = [hash_json([key, fingerprint]) for key in keys]
+            keys_by_stage.append(keys)
+        return keys_by_stage
+
+    def load_stored_rows(self, store, keys_by_stage, n_records):
+        """
+        Rows of each record after the last stage stored for it, and the
+        index of the first stage still to apply
+        """
+        rows = [None] * n_records
+        first_stage = [0] * n_records
+        remaining = range(n_records)
+
+        for idx in reversed(range(len(self.stages))):
+            keys = keys_by_stage[idx]
+            stored = store.get_many([keys[j] for j in remaining])
+            for j in remaining:
+                if keys[j] in stored:
+                    rows[j] = stored[keys[j]]
+                    first_stage[j] = idx + 1
+            remaining = [j for j in remaining if keys[j] not in stored]
+            if not remaining:
+                break
+
+        return rows, first_stage
+
+    def apply_shard(self, shard, store):
+        keys_by_stage = self.get_keys(shard)
+        rows, first_stage = self.load_stored_rows(
+            store, keys_by_stage, len(shard))
+        for j, record in enumerate(shard):
+            if first_stage[j] == 0:
+                rows[j] = [record]
+
+        quarantined = set()
+        for idx, stage in enumerate(self.row_list_stages):
+            pending = [j for j in range(len(shard))
+                       if first_stage[j] <= idx and j not in quarantined]
+            n_reused = sum(1 for first in first_stage if first > idx)
+            self.n_reused += n_reused
+            self.n_computed += len(pending)
+            if self.metrics is not None:
+                self.metrics.stage_metrics[idx].n_reused += n_reused
+            if not pending:
+                continue
+
+            stage.pool_manager = self.pool_manager
+            outputs = dict(stage.apply(collection=[
+                RowListTask(
+                    index=j,
+                    rows=rows[j],
+                    revision_id=get_revision_id(rows[j]))
+                for j in pending]))
+
+            quarantined.update(j for j in pending if j not in outputs)
+            for j in outputs:
+                rows[j] = outputs[j]
+            store.put_many(
+                self.names[idx],
+                {keys_by_stage[idx][j]: rows[j] for j in outputs})
+
+        return [row
+                for j in range(len(shard)) if j not in quarantined
+                for row in rows[j]]
+
+    def iterate_results(self, collection):
+        os.makedirs(self.dirpath, exist_ok=True)
+        store = StageOutputStore(
+            os.path.join(self.dirpath, STAGE_OUTPUTS_FILENAME))
+        if self.metrics is not None:
+            # Workers report what each stage did with computed records
+            for stage, metrics in zip(self.row_list_stages,
+                                      self.metrics.stage_metrics):
+                stage.metrics = ChainMetrics([metrics])
+                metrics.n_reused = 0
+
+        if self.profile is not None:
+            for stage, original_stage, profile in zip(
+                    self.row_list_stages, self.stages, self.profile.profiles):
+                stage.profile = ChainProfile(
+                    profiles=[profile],
+                    funcs=[original_stage.func],
+                    glue=self.profile.glue)
+
+        n_shards = 0
+        try:
+            for shard in self.iterate_shards(collection):
+                yield from self.apply_shard(shard, store)
+                n_shards += 1
+        finally:
+            store.close()
+            for stage in self.row_list_stages:
+                stage.pool_manager = None
+                stage.metrics = None
+                stage.profile = None
+
+        logging.info(
+            f'Checkpointed {n_shards} shards in {self.dirpath}: '
+            f'{self.n_reused} records reused stored stage outputs, '
+            f'{self.n_computed} were computed')
+
+    def apply(self, collection):
+        results = self.iterate_results(collection)
+        if self.materialize:
+            results = list(results)
+        return results
@@ -0,0 +1,136 @@
+"""
+Events/sec of the identify pipeline before and after moving revision
+extraction into the parsing process.
+
+before: every iterparse event (including its Element) is pickled to a
+        multiprocessing.Pool and filtered on the tag in the worker.
+after:  LoadXMLFileStage reduces revisions to RevisionRecord tuples and
+        applies apply_npov_identification in-process.
+
+Usage:
+    python scripts/benchmark_identify.py [--input-file dump.xml]
+"""
+import os
+import time
+import argparse
+import tempfile
+import multiprocessing
+import xml.etree.ElementTree as ET
+
+from dutch_neutrality_corpus.io import LoadXMLFileStage
+from dutch_neutrality_corpus.dataset.identify import (
+    strip_tag_name,
+    RevisionComment,
+    apply_npov_identification)
+
+REVISION_TEMPLATE = (
+    '    <revision>\n'
+    '      <id>{revision_id}</id>\n'
+    '      <timestamp>2006-02-16T09:23:49Z</timestamp>\n'
+    '      <contributor><username>Voorbeeld</username><id>42</id>'
+    '</contributor>\n'
+    '      <comment>{comment}</comment>\n'
+    '      <model>wikitext</model>\n'
+    '      <format>text/x-wiki</format>\n'
+    '      <text bytes="1024" id="{revision_id}" />\n'
+    '    </revision>\n')
+
+COMMENTS = [
+    '/* Sport */ wikify -pov',
+    'typo',
+    'revert vandalisme',
+    'bron toegevoegd',
+    'tekst neutraler geformuleerd',
+]
+
+
+def write_synthetic_dump(filepath, n_pages, revisions_per_page):
+    with open(filepath, 'w') as f:
+        f.write('<mediawiki xmlns="http://www.mediawiki.org/xml/'
+                'export-0.10/" version="0.10" xml:lang="nl">\n')
+        revision_id = 0
+        for page_id in range(n_pages):
+            f.write(f'  <page>\n    <title>Pagina {page_id}</title>\n'
+                    f'    <ns>0</ns>\n    <id>{page_id}</id>\n')
+            for _ in range(revisions_per_page):
+                revision_id += 1
+                f.write(REVISION_TEMPLATE.format(
+                    revision_id=revision_id,
+                    comment=COMMENTS[revision_id % len(COMMENTS)]))
+            f.write('  </page>\n')
+        f.write('</mediawiki>\n')
+
+
+def legacy_npov_identification(item_context):
+    """ Previous worker-side identification over raw iterparse events """
+    event, revision_element = item_context
+
+    tag_name = strip_tag_name(tag=revision_element.tag)
+
+    if not (event == 'end' and tag_name == 'revision'):
+        return {}
+
+    comment = RevisionComment(element=revision_element)
+
+    if not comment.is_admissible():
+        return {}
+
+    return comment.asdict()
+
+
+def count_events(filepath):
+    return sum(1 for _ in ET.iterparse(filepath, events=('start', 'end')))
+
+
+def run_before(filepath, n_workers):
+    context = ET.iterparse(filepath, events=('start', 'end'))
+    with multiprocessing.Pool(n_workers) as pool:
+        results = pool.imap(legacy_npov_identification, context)
+        return len(list(filter(None, results)))
+
+
+def run_after(filepath):
+    stage = LoadXMLFileStage(
+        filepath=filepath,
+        n_revisions=None,
+        func=apply_npov_identification)
+    return len(stage.apply(collection=None))
+
+
+def report(name, n_events, n_results, seconds):
+    print(f'{name:<8} {n_events / seconds:>14,.0f} events/s '
+          f'{seconds:>8.2f}s {n_results:>8} results')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark identify events/sec before and after.')
+    parser.add_argument('--input-file', type=str, default=None)
+    parser.add_argument('--n-pages', type=int, default=200)
+    parser.add_argument('--revisions-per-page', type=int, default=250)
+    parser.add_argument('--n-workers', type=int, default=None)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        filepath = args.input_file
+        if not filepath:
+            filepath = os.path.join(directory, 'synthetic.xml')
+            write_synthetic_dump(
+                filepath=filepath,
+                n_pages=args.n_pages,
+                revisions_per_page=args.revisions_per_page)
+
+        n_events = count_events(filepath)
+        print(f'{filepath}: {n_events:,} parse events')
+
+        start = time.perf_counter()
+        n_results = run_before(filepath, n_workers=args.n_workers)
+        report('before', n_events, n_results, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        n_results = run_after(filepath)
+        report('after', n_events, n_results, time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    main()
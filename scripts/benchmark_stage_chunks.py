@@ -0,0 +1,144 @@
+"""
+Items/sec of each stage function under Stage across chunk sizes, with
+ordered and unordered dispatch.
+
+Records are synthetic, except for the HTML stages which repeat the
+sample diff page in tests/fixtures (or --html-file). Example extraction
+is skipped when spaCy or its language models cannot be loaded; nothing
+else imported here depends on them.
+
+Usage:
+    python scripts/benchmark_stage_chunks.py [--n-items 2000]
+"""
+import os
+import time
+import argparse
+
+from dutch_neutrality_corpus.stage import Stage
+from dutch_neutrality_corpus.dataset.identify import (
+    RevisionRecord,
+    apply_npov_identification)
+from dutch_neutrality_corpus.dataset.content import apply_content_filter
+from dutch_neutrality_corpus.dataset.categories import apply_category_filter
+from dutch_neutrality_corpus.dataset.compact import apply_compaction
+
+CHUNKSIZES = [1, 8, 64, 256, 'auto']
+
+FIXTURE_FILEPATH = os.path.join(
+    os.path.dirname(__file__),
+    '..', 'tests', 'fixtures', 'nlwiki-sample-diff-page.html')
+
+COMMENTS = [
+    '/* Sport */ wikify -pov',
+    'typo',
+    'revert vandalisme',
+    'bron toegevoegd',
+    'tekst neutraler geformuleerd',
+]
+
+SENTENCES = [
+    'Amsterdam is een geweldige stad aan het IJ',
+    '1984',
+    'png',
+    'De gemeente telt ruim achthonderdduizend inwoners',
+]
+
+
+def make_revision_records(n_items):
+    return [
+        RevisionRecord(
+            revision_id=str(i),
+            timestamp='2006-02-16T09:23:49Z',
+            comment=COMMENTS[i % len(COMMENTS)],
+            page_id=str(i // 10),
+            title=f'Pagina {i // 10}')
+        for i in range(n_items)
+    ]
+
+
+def make_sentences(n_items):
+    rows = []
+    for i in range(n_items):
+        text = SENTENCES[i % len(SENTENCES)]
+        rows.append({'revision_id': str(i), 'text': text,
+                     'tokens': text.split()})
+    return rows
+
+
+def make_html_rows(n_items, html_content):
+    return [{'revision_id': str(i), 'html_content': html_content}
+            for i in range(n_items)]
+
+
+def get_benchmarks(n_items, html_content):
+    """ (function, collection factory) per stage function """
+    benchmarks = [
+        (apply_npov_identification,
+         lambda: make_revision_records(n_items)),
+        (apply_content_filter,
+         lambda: make_sentences(n_items)),
+        (apply_category_filter,
+         lambda: make_html_rows(n_items, html_content)),
+        (apply_compaction,
+         lambda: make_html_rows(n_items, html_content)),
+    ]
+
+    try:
+        from dutch_neutrality_corpus.dataset.diff import (
+            apply_example_extraction)
+    except (ImportError, OSError) as e:
+        print(f'Skipping apply_example_extraction: {e}')
+    else:
+        benchmarks.append(
+            (apply_example_extraction,
+             lambda: [apply_compaction(row) for row in
+                      make_html_rows(n_items, html_content)]))
+
+    return benchmarks
+
+
+def run(func, collection, chunksize, ordered, n_workers):
+    stage = Stage(
+        func=func,
+        n_workers=n_workers,
+        chunksize=chunksize,
+        ordered=ordered,
+        index_field=None if ordered else '_index')
+
+    start = time.perf_counter()
+    stage.apply(collection=iter(collection))
+    return time.perf_counter() - start
+
+
+def report(name, chunksize, ordered, n_items, seconds):
+    dispatch = 'ordered' if ordered else 'unordered'
+    print(f'{name:<26} {str(chunksize):>5} {dispatch:<9} '
+          f'{n_items / seconds:>12,.0f} items/s {seconds:>8.2f}s')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark stage functions across chunk sizes.')
+    parser.add_argument('--n-items', type=int, default=2000)
+    parser.add_argument('--html-file', type=str, default=FIXTURE_FILEPATH)
+    parser.add_argument('--n-workers', type=int, default=None)
+    args = parser.parse_args()
+
+    with open(args.html_file) as f:
+        html_content = f.read()
+
+    for func, make_collection in get_benchmarks(args.n_items, html_content):
+        for ordered in (True, False):
+            for chunksize in CHUNKSIZES:
+                seconds = run(
+                    func=func,
+                    collection=make_collection(),
+                    chunksize=chunksize,
+                    ordered=ordered,
+                    n_workers=args.n_workers)
+                report(func.__name__, chunksize, ordered,
+                       args.n_items, seconds)
+
+
+if __name__ == '__main__':
+    main()
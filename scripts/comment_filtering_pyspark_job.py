@@ -1,12 +1,11 @@
 from pyspark.context import SparkContext
 from awsglue.context import GlueContext
 
-from pyspark.sql.functions import col
+from pyspark.sql.functions import col, pandas_udf
+from pyspark.sql.types import BooleanType
 
-INVALID_REVISION_REGEX = r'revert|undo|undid|robot'
-NPOV_REGEX = (r'([- wnv\/\\\:\{\(\[\"\+\'\.\|\_\)\#\=\;\~](rm)'
-              r'?(attribute)?(yes)?(de)?n?pov)|([- n\/\\\:\{\('
-              r'\[\"\+\'\.\|\_\)\#\;\~]neutral)')
+# Ship the package with the job, e.g. Glue --extra-py-files
+from dutch_neutrality_corpus.dataset.identify import NPOVCommentClassifier
 
 S3_PATH = 's3://mm-wikipedia-dump/nlwiki-20200901-stub-meta-history.xml'
 N_ROW_LIMIT = None
@@ -46,18 +45,13 @@ comment_data = \
     )
 print("Non-null comments: ", comment_data.count())
 
-# Filter out invalid revisions
-comment_data = \
-    comment_data.filter(
-        col('revision_comment').rlike(INVALID_REVISION_REGEX) == False
-    )
-
-print("Valid comments: ", comment_data.count())
+# Filter out invalid and non-NPOV comments, same rules as the CLI
+classifier = NPOVCommentClassifier()
+is_npov_comment = pandas_udf(classifier.classify, BooleanType())
 
-# Filter out non-NPOV comments
 comment_data = \
     comment_data.filter(
-        col('revision_comment').rlike(NPOV_REGEX) == True
+        is_npov_comment(col('revision_comment'))
     )
 
 print("NPOV comments: ", comment_data.count())
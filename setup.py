@@ -25,7 +25,7 @@ setuptools.setup(
     install_requires=required_packages,
     entry_points="""
           [console_scripts]
-          dutch_neutrality_corpus=dutch_neutrality_corpus:main
+          dutch_neutrality_corpus=dutch_neutrality_corpus.cli:main
       """,
     packages=['dutch_neutrality_corpus'],
     package_data={},
@@ -0,0 +1,263 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from dutch_neutrality_corpus.io import (
+    ResumableXMLFileStage
+)
+from dutch_neutrality_corpus.checkpoint import (
+    IdentifyCheckpoint
+)
+from dutch_neutrality_corpus.stage_checkpoint import (
+    CheckpointedStages,
+    get_source_modules
+)
+from dutch_neutrality_corpus.dataset.compact import (
+    apply_compaction
+)
+from dutch_neutrality_corpus.stage import (
+    Stage
+)
+from dutch_neutrality_corpus.pipeline import (
+    Pipeline
+)
+from dutch_neutrality_corpus.dataset.identify import (
+    apply_npov_identification
+)
+
+SAMPLE_DUMP_FILEPATH = os.path.join(
+    os.path.dirname(__file__),
+    'fixtures',
+    'nlwiki-sample-stub-meta-history.xml')
+
+NEW_PAGE = b'''  <page>
+    <title>Utrecht</title>
+    <ns>0</ns>
+    <id>4</id>
+    <revision>
+      <id>6000000</id>
+      <timestamp>2020-08-01T00:00:00Z</timestamp>
+      <comment>-pov</comment>
+    </revision>
+  </page>
+</mediawiki>'''
+
+
+def add(row, amount=1):
+    return {'value': row['value'] + amount}
+
+
+def add_worker_pid(row):
+    return {**row, 'pid': os.getpid()}
+
+
+def count_up(row):
+    return {'value': sum(range(100000 + row['value']))}
+
+
+def drop_odd(row):
+    if row['value'] % 2:
+        return {}
+    return row
+
+
+class TestResumableXMLFileStage(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.dump_filepath = os.path.join(self.directory, 'dump.xml')
+        self.output_filepath = os.path.join(self.directory, 'out.json')
+        self.checkpoint_filepath = os.path.join(self.directory, 'ckpt.json')
+        shutil.copy(SAMPLE_DUMP_FILEPATH, self.dump_filepath)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_stage(self, delta_by=None):
+        stage = ResumableXMLFileStage(
+            filepath=self.dump_filepath,
+            output_filepath=self.output_filepath,
+            checkpoint_filepath=self.checkpoint_filepath,
+            func=apply_npov_identification,
+            delta_by=delta_by,
+            shard_size=512,
+            n_workers=2)
+        return stage.apply(collection=None)
+
+    def read_revision_ids(self):
+        with open(self.output_filepath) as f:
+            return [json.loads(line)['revision_id'] for line in f]
+
+    def test_resumes_after_last_checkpoint(self):
+        self.run_stage()
+        expected_revision_ids = self.read_revision_ids()
+
+        # Simulate a crash after the first page, with a partial write
+        with open(self.dump_filepath, 'rb') as f:
+            second_page = f.read().index(b'<page>', 1000)
+
+        checkpoint = IdentifyCheckpoint(self.checkpoint_filepath)
+        with open(self.output_filepath) as f:
+            first_page_size = len(''.join(f.readlines()[:2]))
+        checkpoint.state.update({
+            'byte_offset': second_page,
+            'output_size': first_page_size,
+            'completed': False
+        })
+        checkpoint.save()
+        with open(self.output_filepath, 'a') as f:
+            f.truncate(first_page_size)
+            f.write('{"revision_id": "partial')
+
+        n_results = self.run_stage()
+        self.assertTrue(n_results == 2)
+        self.assertTrue(self.read_revision_ids() == expected_revision_ids)
+
+    def test_delta_appends_only_new_revisions(self):
+        self.run_stage(delta_by='revision_id')
+        revision_ids = self.read_revision_ids()
+
+        with open(self.dump_filepath, 'rb') as f:
+            dump = f.read()
+        with open(self.dump_filepath, 'wb') as f:
+            f.write(dump.replace(b'</mediawiki>', NEW_PAGE))
+
+        n_results = self.run_stage(delta_by='revision_id')
+        self.assertTrue(n_results == 1)
+        self.assertTrue(
+            self.read_revision_ids() == revision_ids + ['6000000'])
+
+        checkpoint = IdentifyCheckpoint(self.checkpoint_filepath)
+        self.assertTrue(
+            checkpoint.high_water_mark['revision_id'] == '6000000')
+
+
+class TestCheckpointedStages(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.collection = [{'value': i} for i in range(25)]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def get_stages(self, amount=1):
+        return [
+            Stage(func=drop_odd, n_workers=2, filter_collection=True),
+            Stage(func=add, n_workers=2, func_kwargs={'amount': amount})
+        ]
+
+    def run_stages(self, collection=None, amount=1):
+        if collection is None:
+            collection = self.collection
+        checkpointed_stages = CheckpointedStages(
+            stages=self.get_stages(amount=amount),
+            dirpath=self.directory,
+            shard_size=10)
+        results = checkpointed_stages.apply(collection=iter(collection))
+        return checkpointed_stages, results
+
+    def test_reruns_only_changed_stages(self):
+        checkpointed_stages, results = self.run_stages()
+        self.assertTrue(checkpointed_stages.n_computed == 50)
+        self.assertTrue(results == [{'value': i + 1} for i in range(0, 25, 2)])
+
+        checkpointed_stages, rerun_results = self.run_stages()
+        self.assertTrue(checkpointed_stages.n_reused == 50)
+        self.assertTrue(checkpointed_stages.n_computed == 0)
+        self.assertTrue(rerun_results == results)
+
+        checkpointed_stages, results = self.run_stages(amount=2)
+        self.assertTrue(checkpointed_stages.n_reused == 25)
+        self.assertTrue(checkpointed_stages.n_computed == 25)
+        self.assertTrue(results == [{'value': i + 2} for i in range(0, 25, 2)])
+
+    def test_keys_do_not_depend_on_arrival_order(self):
+        self.run_stages()
+
+        # Completion-ordered input puts records in other shards
+        shuffled = self.collection[13:] + self.collection[:13][::-1]
+        checkpointed_stages, results = self.run_stages(collection=shuffled)
+
+        self.assertTrue(checkpointed_stages.n_computed == 0)
+        self.assertTrue(sorted(r['value'] for r in results) ==
+                        list(range(1, 26, 2)))
+
+    def test_resumes_after_last_stored_shard(self):
+        # As if the first run stopped after its second shard
+        self.run_stages(collection=self.collection[:20])
+
+        checkpointed_stages, results = self.run_stages()
+        self.assertTrue(checkpointed_stages.n_computed == 10)
+        self.assertTrue(results == [{'value': i + 1} for i in range(0, 25, 2)])
+
+    def test_fingerprint_covers_helper_modules(self):
+        # apply_compaction uses helpers from dataset/categories.py
+        module_names = [
+            module.__name__ for module in get_source_modules(apply_compaction)]
+        self.assertTrue(module_names == [
+            'dutch_neutrality_corpus.dataset.categories',
+            'dutch_neutrality_corpus.dataset.compact'])
+
+    def test_pipeline_checkpoints_stages(self):
+        expected_results = Pipeline(stages=self.get_stages()).apply(
+            collection=self.collection)
+
+        pipeline = Pipeline(
+            stages=self.get_stages(),
+            streaming=True,
+            checkpoint_dirpath=self.directory,
+            shard_size=10)
+        results = pipeline.apply(collection=iter(self.collection))
+
+        self.assertTrue(results == expected_results)
+        self.assertTrue(os.listdir(self.directory))
+
+    def test_run_report_of_checkpointed_stages(self):
+        report_filepath = os.path.join(self.directory, 'report.json')
+        for _ in range(2):
+            Pipeline(
+                stages=self.get_stages(),
+                checkpoint_dirpath=self.directory,
+                shard_size=10,
+                report_filepath=report_filepath).apply(
+                    collection=self.collection)
+
+        with open(report_filepath) as f:
+            report = json.load(f)
+        drop, add = report['stages']
+
+        self.assertTrue(drop['name'] == 'drop_odd')
+        self.assertTrue(drop['items_reused'] == 25)
+        self.assertTrue(add['name'] == 'add')
+        self.assertTrue(add['items_reused'] == 25)
+        self.assertTrue(add['items_in'] == 0)
+
+    def test_profiles_checkpointed_stages(self):
+        profile_dirpath = os.path.join(self.directory, 'profile')
+        stages = [Stage(func=count_up, n_workers=1)]
+        Pipeline(
+            stages=stages,
+            checkpoint_dirpath=self.directory,
+            shard_size=10,
+            profile_dirpath=profile_dirpath,
+            profile_interval=0.001).apply(collection=self.collection)
+
+        with open(os.path.join(profile_dirpath, 'count_up.folded')) as f:
+            lines = f.read().splitlines()
+        self.assertTrue(lines)
+        self.assertTrue(all(
+            line.startswith('count_up (test_checkpoint.py)')
+            for line in lines))
+
+    def test_timeout_stage_keeps_its_pool_across_shards(self):
+        stages = [Stage(func=add_worker_pid, n_workers=1, timeout=30)]
+        results = Pipeline(
+            stages=stages,
+            checkpoint_dirpath=self.directory,
+            shard_size=5).apply(collection=self.collection)
+
+        self.assertTrue(len(results) == 25)
+        self.assertTrue(len(set(r['pid'] for r in results)) == 1)
@@ -0,0 +1,67 @@
+import os
+import unittest
+
+from bs4 import BeautifulSoup
+
+from dutch_neutrality_corpus.dataset.compact import (
+    NODE_REGEX,
+    get_diff_html,
+    apply_compaction
+)
+from dutch_neutrality_corpus.dataset.categories import (
+    apply_category_filter
+)
+
+SAMPLE_PAGE_FILEPATH = os.path.join(
+    os.path.dirname(__file__),
+    'fixtures',
+    'nlwiki-sample-diff-page.html')
+
+
+def parse_nodes(html):
+    soup = BeautifulSoup(html, features='html.parser')
+    return [str(node) for node in soup.find_all(class_=NODE_REGEX)]
+
+
+class TestCompaction(unittest.TestCase):
+
+    def setUp(self):
+        with open(SAMPLE_PAGE_FILEPATH) as f:
+            self.html_content = f.read()
+
+    def get_row(self):
+        return {
+            'revision_id': '1',
+            'html_content': self.html_content
+        }
+
+    def test_apply_compaction(self):
+        row = apply_compaction(self.get_row())
+
+        self.assertTrue('html_content' not in row)
+        self.assertTrue(len(row['diff_cells']) == 4)
+        self.assertTrue(row['category_titles'] == [
+            'Categorie',
+            'Categorieën',
+            'Hoofdstad in Europa',
+            'Plaats in Noord-Holland',
+            'Wikipedia:Etalage'
+        ])
+        self.assertTrue(apply_compaction(dict(row)) == row)
+
+    def test_diff_nodes_are_preserved(self):
+        row = apply_compaction(self.get_row())
+        self.assertTrue(
+            parse_nodes(get_diff_html(row)) ==
+            parse_nodes(self.html_content))
+
+    def test_category_filter_matches_full_page(self):
+        full_row = apply_category_filter(self.get_row())
+        compact_row = apply_category_filter(apply_compaction(self.get_row()))
+
+        self.assertTrue(compact_row['categories'] == full_row['categories'])
+        self.assertTrue(
+            compact_row['internal_wikpedia_categories'] ==
+            full_row['internal_wikpedia_categories'])
+        self.assertTrue(compact_row['categories'] == [
+            'Hoofdstad in Europa', 'Plaats in Noord-Holland'])
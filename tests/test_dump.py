@@ -0,0 +1,74 @@
+import os
+import bz2
+import gzip
+import shutil
+import tempfile
+import unittest
+
+from dutch_neutrality_corpus.dump import (
+    open_dump,
+    get_multistream_index_filepath
+)
+
+SAMPLE_DUMP_FILEPATH = os.path.join(
+    os.path.dirname(__file__),
+    'fixtures',
+    'nlwiki-sample-stub-meta-history.xml')
+
+
+def write_multistream_dump(xml, filepath):
+    """ One bz2 stream for the header, per page and for the footer """
+    first_page = xml.index(b'<page>')
+    last_page_end = xml.rindex(b'</page>') + len(b'</page>')
+
+    chunks = [xml[:first_page]]
+    pages = xml[first_page:last_page_end].split(b'</page>')
+    chunks.extend(p + b'</page>' for p in pages if p.strip())
+    chunks.append(xml[last_page_end:])
+
+    index_lines = []
+    with open(filepath, 'wb') as f:
+        for page_id, chunk in enumerate(chunks):
+            if 0 < page_id < len(chunks) - 1:
+                index_lines.append(f'{f.tell()}:{page_id}:Page{page_id}\n')
+            f.write(bz2.compress(chunk))
+
+    index_filepath = get_multistream_index_filepath(filepath)
+    with bz2.open(index_filepath, 'wt') as f:
+        f.writelines(index_lines)
+
+
+class TestOpenDump(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        with open(SAMPLE_DUMP_FILEPATH, 'rb') as f:
+            self.xml = f.read()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read_dump(self, filepath, **kwargs):
+        with open_dump(filepath, **kwargs) as f:
+            return f.read()
+
+    def test_plain(self):
+        self.assertTrue(self.read_dump(SAMPLE_DUMP_FILEPATH) == self.xml)
+
+    def test_gzip(self):
+        filepath = os.path.join(self.directory, 'dump.xml.gz')
+        with gzip.open(filepath, 'wb') as f:
+            f.write(self.xml)
+        self.assertTrue(self.read_dump(filepath) == self.xml)
+
+    def test_bz2(self):
+        filepath = os.path.join(self.directory, 'dump.xml.bz2')
+        with bz2.open(filepath, 'wb') as f:
+            f.write(self.xml)
+        self.assertTrue(self.read_dump(filepath) == self.xml)
+
+    def test_multistream_parallel(self):
+        filepath = os.path.join(self.directory, 'dump-multistream.xml.bz2')
+        write_multistream_dump(xml=self.xml, filepath=filepath)
+        response = self.read_dump(filepath, n_workers=2)
+        self.assertTrue(response == self.xml)
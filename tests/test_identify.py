@@ -0,0 +1,216 @@
+import io
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from dutch_neutrality_corpus.io import (
+    LoadXMLFileStage,
+    LoadShardedXMLFileStage,
+    ScanXMLFileStage
+)
+from dutch_neutrality_corpus.dump import (
+    PageFilter,
+    iterate_accepted_bytes
+)
+from dutch_neutrality_corpus.dataset.identify import (
+    RevisionRecord,
+    NPOVCommentClassifier,
+    apply_npov_identification
+)
+
+SAMPLE_DUMP_FILEPATH = os.path.join(
+    os.path.dirname(__file__),
+    'fixtures',
+    'nlwiki-sample-stub-meta-history.xml')
+
+EXPECTED_REVISION_IDS = ['3161315', '3161500', '4000000', '5000100']
+
+
+class TestLoadXMLFileStage(unittest.TestCase):
+
+    def setUp(self):
+        pass
+
+    def test_streams_completed_revisions(self):
+        stage = LoadXMLFileStage(
+            filepath=SAMPLE_DUMP_FILEPATH,
+            n_revisions=None)
+        results = [apply_npov_identification(item)
+                   for item in stage.apply(collection=None)]
+        revision_ids = [r['revision_id'] for r in results if r]
+        self.assertTrue(revision_ids == EXPECTED_REVISION_IDS)
+
+    def test_n_revisions_counts_revisions(self):
+        stage = LoadXMLFileStage(
+            filepath=SAMPLE_DUMP_FILEPATH,
+            n_revisions=2)
+        revisions = list(stage.apply(collection=None))
+        self.assertTrue(len(revisions) == 2)
+        self.assertTrue(revisions[0] == RevisionRecord(
+            revision_id='3161315',
+            timestamp='2006-02-16T09:23:49Z',
+            comment='/* Sport */ wikify -pov',
+            page_id='1',
+            title='Amsterdam'))
+
+    def test_applies_func_in_process(self):
+        stage = LoadXMLFileStage(
+            filepath=SAMPLE_DUMP_FILEPATH,
+            n_revisions=None,
+            func=apply_npov_identification)
+        results = stage.apply(collection=None)
+        revision_ids = [r['revision_id'] for r in results]
+        self.assertTrue(revision_ids == EXPECTED_REVISION_IDS)
+
+
+class TestLoadShardedXMLFileStage(unittest.TestCase):
+
+    def setUp(self):
+        pass
+
+    def test_matches_single_stream(self):
+        for n_shards in [1, 2, 3, 10]:
+            stage = LoadShardedXMLFileStage(
+                filepath=SAMPLE_DUMP_FILEPATH,
+                func=apply_npov_identification,
+                n_shards=n_shards,
+                n_workers=2)
+            results = stage.apply(collection=None)
+            revision_ids = [r['revision_id'] for r in results]
+            self.assertTrue(revision_ids == EXPECTED_REVISION_IDS)
+
+    def test_n_revisions_across_shards(self):
+        stage = LoadShardedXMLFileStage(
+            filepath=SAMPLE_DUMP_FILEPATH,
+            func=apply_npov_identification,
+            n_revisions=4,
+            n_shards=3,
+            n_workers=2)
+        results = stage.apply(collection=None)
+        revision_ids = [r['revision_id'] for r in results]
+        self.assertTrue(revision_ids == EXPECTED_REVISION_IDS[:3])
+
+
+class TestScanXMLFileStage(unittest.TestCase):
+
+    def setUp(self):
+        pass
+
+    def test_matches_element_tree(self):
+        expected_results = LoadXMLFileStage(
+            filepath=SAMPLE_DUMP_FILEPATH,
+            n_revisions=None,
+            func=apply_npov_identification).apply(collection=None)
+
+        results = ScanXMLFileStage(
+            filepath=SAMPLE_DUMP_FILEPATH,
+            n_revisions=None,
+            func=apply_npov_identification).apply(collection=None)
+
+        self.assertTrue(results == expected_results)
+        self.assertTrue(results[1]['comment'] ==
+                        'meer "neutrale" tekst & bronnen')
+
+    def test_n_revisions_counts_all_revisions(self):
+        results = ScanXMLFileStage(
+            filepath=SAMPLE_DUMP_FILEPATH,
+            n_revisions=4,
+            func=apply_npov_identification).apply(collection=None)
+        revision_ids = [r['revision_id'] for r in results]
+        self.assertTrue(revision_ids == EXPECTED_REVISION_IDS[:3])
+
+
+class TestPageFilter(unittest.TestCase):
+
+    def setUp(self):
+        self.page_filter = PageFilter(
+            namespaces=[0],
+            title_regex='dam$',
+            start_timestamp='2006-03-01',
+            end_timestamp='2010-01-02')
+
+    def test_pushdown_matches_across_readers(self):
+        for stage_class in [LoadXMLFileStage, ScanXMLFileStage]:
+            results = stage_class(
+                filepath=SAMPLE_DUMP_FILEPATH,
+                n_revisions=None,
+                func=apply_npov_identification,
+                page_filter=self.page_filter).apply(collection=None)
+            self.assertTrue(results == [{
+                'revision_id': '3161500',
+                'timestamp': '2006-03-01T12:00:00Z',
+                'comment': 'meer "neutrale" tekst & bronnen',
+                'page_id': '1',
+                'title': 'Amsterdam'
+            }])
+
+    def test_rejected_pages_are_not_parsed(self):
+        with open(SAMPLE_DUMP_FILEPATH, 'rb') as f:
+            dump = f.read()
+
+        # A parser reaching the rejected page would fail on it
+        page_start = dump.index(b'<page>')
+        broken_page = b'<page><title>Utrecht</title><ns>0</ns><revision>' \
+            b'<unclosed></revision></page>'
+        with tempfile.TemporaryDirectory() as directory:
+            filepath = os.path.join(directory, 'dump.xml')
+            with open(filepath, 'wb') as f:
+                f.write(dump[:page_start] + broken_page + dump[page_start:])
+
+            results = LoadXMLFileStage(
+                filepath=filepath,
+                n_revisions=None,
+                func=apply_npov_identification,
+                page_filter=self.page_filter).apply(collection=None)
+        self.assertTrue([r['revision_id'] for r in results] == ['3161500'])
+
+    def test_accepted_bytes_across_chunks(self):
+        with open(SAMPLE_DUMP_FILEPATH, 'rb') as f:
+            dump = f.read()
+        expected = b''.join(iterate_accepted_bytes(
+            io.BytesIO(dump), self.page_filter))
+
+        self.assertTrue(b'Overleg:Amsterdam' in dump)
+        self.assertTrue(b'Overleg:Amsterdam' not in expected)
+        self.assertTrue(b'<title>Amsterdam</title>' in expected)
+        for chunk_size in [1, 5, 7, 64]:
+            accepted = b''.join(iterate_accepted_bytes(
+                io.BytesIO(dump), self.page_filter, chunk_size=chunk_size))
+            self.assertTrue(accepted == expected)
+
+    def test_accepts_page(self):
+        self.assertTrue(self.page_filter.accepts_page('0', 'Rotterdam'))
+        self.assertFalse(
+            self.page_filter.accepts_page('1', 'Overleg:Amsterdam'))
+        self.assertFalse(self.page_filter.accepts_page('0', 'Utrecht'))
+
+
+class TestNPOVCommentClassifier(unittest.TestCase):
+
+    def setUp(self):
+        self.classifier = NPOVCommentClassifier()
+        self.comments = [
+            '/* Sport */ wikify -pov',
+            'Revert -POV edit',
+            'tekst [[POV]] aangepast',
+            'povere formulering',
+            'pov',
+            'neutraal gemaakt',
+            None,
+            ''
+        ]
+        self.expected_mask = [
+            True, False, True, False, False, False, False, False
+        ]
+
+    def test_classify_list(self):
+        response = self.classifier.classify(self.comments)
+        self.assertTrue(response == self.expected_mask)
+
+    def test_classify_array(self):
+        response = self.classifier.classify(
+            np.array(self.comments, dtype=object))
+        self.assertTrue(response.dtype == bool)
+        self.assertTrue(response.tolist() == self.expected_mask)
@@ -1,8 +1,75 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
 import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
-from dutch_neutrality_corpus.revision_retrieval import (
-    get_wikipedia_revision_url
+from dutch_neutrality_corpus.dataset.retrieve import (
+    get_wikipedia_revision_url,
+    query_url_with_backoff,
+    AsyncRetrievalStage
 )
+from dutch_neutrality_corpus.dataset.cache import (
+    RevisionCache)
+from dutch_neutrality_corpus.dataset.ratelimit import (
+    TokenBucket,
+    BackoffPolicy,
+    AdaptiveConcurrency,
+    FailedRevisionLog
+)
+
+DIFF_PAGE_TEMPLATE = (
+    '<html><body><table class="diff"><tr>'
+    '<td class="diff-deletedline"><div>Een <del class="diffchange '
+    'diffchange-inline">geweldige</del> stad {revision_id}</div></td>'
+    '<td class="diff-addedline"><div>Een stad {revision_id}</div></td>'
+    '</tr></table></body></html>')
+
+
+class DiffPageHandler(BaseHTTPRequestHandler):
+    """ Stand-in for Wikipedia serving canned diff pages """
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.connections.add(self.client_address)
+            server.n_requests += 1
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+
+        time.sleep(server.delay)
+        revision_id = self.path.rsplit('=', 1)[-1]
+
+        with server.lock:
+            server.in_flight -= 1
+            n_rate_limited = server.rate_limited.get(revision_id, 0)
+            if n_rate_limited:
+                server.rate_limited[revision_id] = n_rate_limited - 1
+
+        if n_rate_limited:
+            self.send_response(429)
+            self.send_header('Retry-After', '0')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        if revision_id in server.missing_revision_ids:
+            self.send_error(404)
+            return
+
+        body = DIFF_PAGE_TEMPLATE.format(revision_id=revision_id).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=UTF-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
 
 
 class TestRevisionRetrieval(unittest.TestCase):
@@ -15,3 +82,219 @@ class TestRevisionRetrieval(unittest.TestCase):
         expected_response = 'https://nl.wikipedia.org/wiki/?diff=123456789'
         response = get_wikipedia_revision_url(revision_id=test_revision_id)
         self.assertTrue(response == expected_response)
+
+
+class TestAsyncRetrievalStage(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), DiffPageHandler)
+        self.server.lock = threading.Lock()
+        self.server.connections = set()
+        self.server.in_flight = 0
+        self.server.max_in_flight = 0
+        self.server.n_requests = 0
+        self.server.delay = 0.01
+        self.server.missing_revision_ids = set()
+        self.server.rate_limited = {}
+        self.directory = tempfile.mkdtemp()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+        port = self.server.server_address[1]
+        self.url_template = \
+            f'http://127.0.0.1:{port}/wiki/?diff={{revision_id}}'
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def test_retrieves_all_revisions(self):
+        stage = AsyncRetrievalStage(
+            max_in_flight=8,
+            per_host_limit=4,
+            url_template=self.url_template)
+        collection = [{'revision_id': str(i)} for i in range(40)]
+        results = stage.apply(collection=iter(collection))
+
+        revision_ids = sorted(r['revision_id'] for r in results)
+        self.assertTrue(revision_ids == sorted(str(i) for i in range(40)))
+        self.assertTrue(all(
+            r['html_content'] == DIFF_PAGE_TEMPLATE.format(
+                revision_id=r['revision_id'])
+            for r in results))
+
+    def test_sends_requests_while_upstream_is_slow(self):
+        first_request_sent = threading.Event()
+
+        def generate():
+            yield {'revision_id': '0'}
+            # The next row only follows once the first request went out
+            deadline = time.monotonic() + 5
+            while not self.server.n_requests and \
+                    time.monotonic() < deadline:
+                time.sleep(0.01)
+            if self.server.n_requests:
+                first_request_sent.set()
+            yield {'revision_id': '1'}
+
+        stage = AsyncRetrievalStage(
+            max_in_flight=8,
+            url_template=self.url_template)
+        results = stage.apply(collection=generate())
+
+        self.assertTrue(first_request_sent.is_set())
+        self.assertTrue(sorted(r['revision_id'] for r in results) ==
+                        ['0', '1'])
+
+    def test_stops_early_and_raises_upstream_errors(self):
+        stage = AsyncRetrievalStage(
+            max_in_flight=4,
+            url_template=self.url_template,
+            materialize=False)
+        results = stage.apply(
+            collection=({'revision_id': str(i)} for i in range(100)))
+        next(results)
+        results.close()
+
+        def generate():
+            yield {'revision_id': '0'}
+            raise RuntimeError('upstream')
+
+        with self.assertRaises(RuntimeError):
+            list(stage.apply(collection=generate()))
+
+    def test_reuses_connections_within_limits(self):
+        stage = AsyncRetrievalStage(
+            max_in_flight=8,
+            per_host_limit=3,
+            url_template=self.url_template)
+        collection = [{'revision_id': str(i)} for i in range(30)]
+        stage.apply(collection=collection)
+
+        self.assertTrue(self.server.max_in_flight <= 3)
+        self.assertTrue(len(self.server.connections) <= 3)
+
+    def test_retries_rate_limited_and_logs_failures(self):
+        self.server.rate_limited = {'1': 2, '2': 1}
+        self.server.missing_revision_ids = {'3'}
+        failed_filepath = os.path.join(self.directory, 'failed.csv')
+
+        stage = AsyncRetrievalStage(
+            max_in_flight=4,
+            url_template=self.url_template,
+            requests_per_second=1000,
+            max_retries=3,
+            failed_filepath=failed_filepath)
+        collection = [{'revision_id': str(i)} for i in range(5)]
+        results = stage.apply(collection=collection)
+
+        revision_ids = sorted(r['revision_id'] for r in results)
+        self.assertTrue(revision_ids == ['0', '1', '2', '4'])
+
+        failed_log = FailedRevisionLog(failed_filepath)
+        self.assertTrue(failed_log.load_revision_ids() == ['3'])
+
+    def test_query_url_with_backoff(self):
+        self.server.rate_limited = {'7': 2}
+        url = self.url_template.format(revision_id='7')
+
+        html = query_url_with_backoff(
+            url=url,
+            rate_limiter=TokenBucket(rate=1000),
+            backoff_policy=BackoffPolicy(max_retries=2))
+        self.assertTrue(html == DIFF_PAGE_TEMPLATE.format(revision_id='7'))
+
+        self.server.rate_limited = {'7': 2}
+        with self.assertRaises(Exception):
+            query_url_with_backoff(
+                url=url,
+                backoff_policy=BackoffPolicy(max_retries=1))
+
+    def test_serves_cached_revisions(self):
+        cache_filepath = os.path.join(self.directory, 'cache.sqlite')
+        collection = [{'revision_id': str(i)} for i in range(10)]
+
+        stage = AsyncRetrievalStage(
+            url_template=self.url_template,
+            cache_filepath=cache_filepath)
+        stage.apply(collection=collection[:6])
+        self.assertTrue(self.server.n_requests == 6)
+
+        results = stage.apply(collection=collection)
+        self.assertTrue(self.server.n_requests == 10)
+        self.assertTrue(len(results) == 10)
+        self.assertTrue(all(
+            r['html_content'] == DIFF_PAGE_TEMPLATE.format(
+                revision_id=r['revision_id'])
+            for r in results))
+
+
+class TestRevisionCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.directory, 'cache.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_get_and_put(self):
+        cache = RevisionCache(filepath=self.filepath)
+        self.assertTrue(cache.get('https://nl/?diff=1') is None)
+        cache.put('https://nl/?diff=1', 'één diff')
+        cache.close()
+
+        cache = RevisionCache(filepath=self.filepath)
+        self.assertTrue(cache.get('https://nl/?diff=1') == 'één diff')
+        self.assertTrue(cache.get('https://en/?diff=1') is None)
+        cache.close()
+
+    def test_evicts_least_recently_used(self):
+        cache = RevisionCache(filepath=self.filepath, max_size=10 ** 9)
+        html_content = DIFF_PAGE_TEMPLATE.format(revision_id=0)
+        for i in range(10):
+            cache.put(f'url{i}', html_content)
+        cache.get('url0')
+
+        cache.max_size = cache.size - 1
+        cache.put('url10', html_content)
+
+        self.assertTrue(cache.size <= cache.max_size)
+        self.assertTrue(cache.get('url0') is not None)
+        self.assertTrue(cache.get('url1') is None)
+        self.assertTrue(cache.get('url10') is not None)
+        cache.close()
+
+
+class TestRateLimiting(unittest.TestCase):
+
+    def setUp(self):
+        pass
+
+    def test_token_bucket_paces_requests(self):
+        bucket = TokenBucket(rate=10, capacity=1)
+        waits = [bucket.reserve() for _ in range(3)]
+        self.assertTrue(waits[0] == 0)
+        self.assertTrue(0.15 < waits[2] <= 0.2)
+
+    def test_backoff_delay_is_capped(self):
+        policy = BackoffPolicy(max_retries=3, max_delay=4, seed=1)
+        self.assertTrue(all(
+            0 <= policy.get_delay(attempt) <= 4 for attempt in range(10)))
+        self.assertTrue(policy.get_delay(0, retry_after=30) == 4)
+        self.assertFalse(policy.should_retry(3))
+
+    def test_adaptive_concurrency(self):
+        concurrency = AdaptiveConcurrency(
+            initial_limit=16,
+            window=10,
+            max_error_rate=0.2)
+        for success in [True] * 5 + [False] * 5:
+            concurrency.record(success=success)
+        self.assertTrue(concurrency.limit == 8)
+
+        for _ in range(8):
+            concurrency.record(success=True)
+        self.assertTrue(concurrency.limit == 9)
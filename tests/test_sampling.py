@@ -0,0 +1,68 @@
+import unittest
+from collections import Counter
+
+from dutch_neutrality_corpus.sampling import (
+    ReservoirSampler
+)
+
+
+class TestReservoirSampler(unittest.TestCase):
+
+    def setUp(self):
+        self.collection = [
+            {'revision_id': str(i), 'timestamp': f'{2004 + i % 4}-01-01'}
+            for i in range(1000)
+        ]
+
+    def test_uniform_sample_is_seeded_and_ordered(self):
+        sampler = ReservoirSampler(n_items=50, seed=7)
+        sample = sampler.sample(iter(self.collection))
+        self.assertTrue(len(sample) == 50)
+        self.assertTrue(sample == sampler.sample(iter(self.collection)))
+
+        indices = [int(r['revision_id']) for r in sample]
+        self.assertTrue(indices == sorted(indices))
+        self.assertTrue(indices[-1] > 500)
+
+    def test_uniform_sample_covers_stream(self):
+        counts = Counter()
+        for seed in range(200):
+            sampler = ReservoirSampler(n_items=10, seed=seed)
+            for row in sampler.sample(range(100)):
+                counts[row // 25] += 1
+        for quarter in range(4):
+            self.assertTrue(400 < counts[quarter] < 600)
+
+    def test_short_stream(self):
+        sampler = ReservoirSampler(n_items=50, seed=7)
+        self.assertTrue(sampler.sample(range(10)) == list(range(10)))
+
+    def test_stratified_sample_is_proportional(self):
+        sampler = ReservoirSampler(
+            n_items=40,
+            seed=7,
+            stratify_by='timestamp',
+            stratify_prefix=4)
+        sample = sampler.sample(self.collection)
+        years = Counter(r['timestamp'][:4] for r in sample)
+        self.assertTrue(len(sample) == 40)
+        self.assertTrue(set(years.values()) == {10})
+
+    def test_many_strata_keep_memory_bounded(self):
+        n_read = 0
+
+        def iterate_collection():
+            nonlocal n_read
+            for i in range(100000):
+                n_read += 1
+                yield {'revision_id': str(i),
+                       'timestamp': f'2004-01-01T00:{i:06d}'}
+
+        sampler = ReservoirSampler(
+            n_items=40,
+            seed=7,
+            stratify_by='timestamp',
+            max_strata=20)
+        with self.assertRaises(ValueError):
+            sampler.sample(iterate_collection())
+        self.assertTrue(n_read == 21)
@@ -0,0 +1,645 @@
+import io
+import os
+import csv
+import json
+import time
+import types
+import shutil
+import tempfile
+import unittest
+
+from dutch_neutrality_corpus.stage import (
+    Stage,
+    ChunkSizer,
+    RestoreOrderStage
+)
+from dutch_neutrality_corpus.dataset.ratelimit import (
+    FailedRevisionLog
+)
+from dutch_neutrality_corpus.pipeline import (
+    Pipeline
+)
+from dutch_neutrality_corpus import (
+    parse_stage_workers
+)
+from dutch_neutrality_corpus.io import (
+    LoadCSVFileStage,
+    LoadJSONFileStage,
+    SaveIterableToJSONStage,
+    iterate_json_array
+)
+
+
+def square_even(row):
+    if row['value'] % 2:
+        return {}
+    return {'value': row['value'] ** 2}
+
+
+def increment(row):
+    return {'value': row['value'] + 1}
+
+
+def add_worker_pid(row):
+    return {**row, 'pids': row.get('pids', []) + [os.getpid()]}
+
+
+def split_words(row):
+    return [{'word': w} for w in row['text'].split()]
+
+
+def drop_short_words(row):
+    word = row.get('word', '')
+    if len(word) < 3:
+        return {}
+    return {'length': len(word)}
+
+
+def fail_on_five(row):
+    if row['value'] == 5:
+        raise RuntimeError('five')
+    return row
+
+
+def hang_on_three(row):
+    if row['value'] == 3:
+        time.sleep(60)
+    return row
+
+
+def count_up(row):
+    return {'value': sum(range(100000 + row['value']))}
+
+
+class TestStage(unittest.TestCase):
+
+    def setUp(self):
+        self.collection = [{'value': i} for i in range(10)]
+        self.expected = [{'value': i ** 2} for i in range(0, 10, 2)]
+
+    def test_materialized_results(self):
+        stage = Stage(func=square_even, n_workers=2, filter_collection=True)
+        results = stage.apply(collection=iter(self.collection))
+        self.assertTrue(results == self.expected)
+
+    def test_lazy_results(self):
+        stage = Stage(
+            func=square_even,
+            n_workers=2,
+            filter_collection=True,
+            materialize=False)
+        results = stage.apply(collection=iter(self.collection))
+
+        self.assertTrue(isinstance(results, types.GeneratorType))
+        self.assertTrue(list(results) == self.expected)
+
+    def test_bounded_read_ahead(self):
+        n_pulled = []
+
+        def generate():
+            for row in self.collection:
+                n_pulled.append(1)
+                yield row
+
+        stage = Stage(
+            func=square_even,
+            n_workers=2,
+            materialize=False,
+            max_in_flight=3)
+        results = stage.apply(collection=generate())
+
+        next(results)
+        self.assertTrue(len(n_pulled) == 3)
+        self.assertTrue(len(list(results)) == 9)
+
+    def test_accumulate_from_iterator(self):
+        stage = Stage(func=square_even, n_workers=2, accumulate=True)
+        results = stage.apply(
+            collection=({'id': i, 'value': i} for i in range(4)))
+        self.assertTrue(results == [
+            {'id': 0, 'value': 0},
+            {'id': 1, 'value': 1},
+            {'id': 2, 'value': 4},
+            {'id': 3, 'value': 3}
+        ])
+
+    def test_fixed_chunksize(self):
+        stage = Stage(
+            func=square_even,
+            n_workers=2,
+            filter_collection=True,
+            chunksize=4)
+        results = stage.apply(collection=iter(self.collection))
+        self.assertTrue(results == self.expected)
+
+    def test_auto_chunksize_follows_item_cost(self):
+        chunk_sizer = ChunkSizer('auto')
+        self.assertTrue(chunk_sizer.chunksize == 1)
+
+        chunk_sizer.record(seconds=0.001, n_items=1)
+        self.assertTrue(chunk_sizer.chunksize == 50)
+
+        chunk_sizer.record(seconds=1e-9, n_items=50)
+        self.assertTrue(50 < chunk_sizer.chunksize <= 1024)
+
+        self.assertTrue(ChunkSizer(8).chunksize == 8)
+
+    def test_unordered_results_restore_order(self):
+        stage = Stage(
+            func=square_even,
+            n_workers=2,
+            filter_collection=True,
+            ordered=False,
+            index_field='idx',
+            chunksize=3)
+        results = stage.apply(collection=iter(self.collection))
+
+        self.assertTrue(sorted(r['idx'] for r in results) == [0, 2, 4, 6, 8])
+        results = RestoreOrderStage(index_field='idx').apply(results)
+        self.assertTrue(results == self.expected)
+
+    def test_unordered_errors_are_raised(self):
+        stage = Stage(func=fail_on_five, n_workers=2, ordered=False)
+        with self.assertRaises(RuntimeError):
+            stage.apply(collection=iter(self.collection))
+
+    def test_timeout_quarantines_stragglers(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        quarantine_filepath = os.path.join(directory, 'quarantine.csv')
+        collection = [{'revision_id': str(i), 'value': i} for i in range(8)]
+
+        stage = Stage(
+            func=hang_on_three,
+            n_workers=2,
+            timeout=0.5,
+            quarantine_filepath=quarantine_filepath)
+        start = time.monotonic()
+        results = stage.apply(collection=iter(collection))
+
+        self.assertTrue(time.monotonic() - start < 30)
+        self.assertTrue(results == collection[:3] + collection[4:])
+        quarantine_log = FailedRevisionLog(quarantine_filepath)
+        self.assertTrue(quarantine_log.load_revision_ids() == ['3'])
+
+    def test_max_tasks_per_worker(self):
+        stage = Stage(
+            func=add_worker_pid,
+            n_workers=1,
+            chunksize=1,
+            max_tasks_per_worker=1)
+        results = stage.apply(collection=iter(self.collection[:4]))
+        self.assertTrue(len(set(r['pids'][0] for r in results)) == 4)
+
+
+class CollectStage():
+    """ Barrier stage recording what it receives """
+
+    barrier = True
+
+    def apply(self, collection):
+        self.collection = collection
+        return {'n_rows': len(collection)}
+
+
+class TestPipeline(unittest.TestCase):
+
+    def test_streaming_pipeline(self):
+        stages = [
+            Stage(func=increment, n_workers=2),
+            Stage(func=square_even, n_workers=2, filter_collection=True),
+            CollectStage()
+        ]
+        result = Pipeline(stages=stages, streaming=True, fuse=False).apply(
+            collection=({'value': i} for i in range(10)))
+
+        self.assertFalse(stages[0].materialize)
+        self.assertFalse(stages[1].materialize)
+        self.assertTrue(isinstance(stages[2].collection, list))
+        self.assertTrue(result == {'n_rows': 5})
+
+    def test_concurrent_pipeline(self):
+        collect_stage = CollectStage()
+        stages = [
+            Stage(func=increment, n_workers=4, executor='threads'),
+            Stage(func=square_even, n_workers=2, filter_collection=True),
+            collect_stage
+        ]
+        result = Pipeline(stages=stages, concurrent=True).apply(
+            collection=({'value': i} for i in range(10)))
+
+        self.assertTrue(result == {'n_rows': 5})
+        self.assertTrue(collect_stage.collection == [
+            {'value': v ** 2} for v in range(2, 11, 2)])
+
+    def test_concurrent_pipeline_raises_stage_errors(self):
+        stages = [
+            Stage(func=increment, n_workers=2, executor='threads'),
+            Stage(func=fail_on_five, n_workers=2),
+            Stage(func=increment, n_workers=2)
+        ]
+        with self.assertRaises(RuntimeError):
+            Pipeline(stages=stages, concurrent=True).apply(
+                collection=({'value': i} for i in range(10)))
+
+    def test_stages_share_worker_pool(self):
+        stages = [
+            Stage(func=add_worker_pid, n_workers=2),
+            Stage(func=add_worker_pid, n_workers=2),
+            Stage(func=add_worker_pid, n_workers=2)
+        ]
+        results = Pipeline(stages=stages, streaming=True).apply(
+            collection=({'value': i} for i in range(40)))
+
+        pids = {pid for row in results for pid in row['pids']}
+        self.assertTrue(len(pids) <= 2)
+        self.assertTrue(os.getpid() not in pids)
+        self.assertTrue(all(stage.pool_manager is None for stage in stages))
+
+    def test_fused_stages_match_separate_stages(self):
+        def get_stages():
+            return [
+                Stage(func=split_words, n_workers=2, flatten=True),
+                Stage(func=drop_short_words, n_workers=2, accumulate=True),
+                Stage(func=drop_short_words, n_workers=2,
+                      filter_collection=True)
+            ]
+
+        collection = [
+            {'text': 'een zeer mooie stad'},
+            {'text': ''},
+            {'text': 'de'},
+            {'text': 'amsterdam is groot'}
+        ]
+
+        pipeline = Pipeline(stages=get_stages(), streaming=True)
+        self.assertTrue(len(pipeline.fuse_stages(pipeline.stages)) == 1)
+
+        fused = pipeline.apply(collection=iter(collection))
+        separate = Pipeline(
+            stages=get_stages(),
+            streaming=True,
+            fuse=False).apply(collection=iter(collection))
+
+        self.assertTrue(fused == separate)
+        self.assertTrue(len(fused) == 6)
+
+    def test_fuses_only_compatible_stages(self):
+        stages = [
+            Stage(func=increment, n_workers=2, executor='threads'),
+            Stage(func=increment, n_workers=2),
+            Stage(func=increment, n_workers=2),
+            Stage(func=increment, n_workers=4),
+            CollectStage()
+        ]
+        fused_stages = Pipeline(stages=stages).fuse_stages(stages)
+
+        self.assertTrue(
+            [type(stage).__name__ for stage in fused_stages] ==
+            ['Stage', 'FusedStage', 'Stage', 'CollectStage'])
+
+    def test_run_report(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        report_filepath = os.path.join(directory, 'report.json')
+
+        stages = [
+            Stage(func=split_words, n_workers=2, flatten=True),
+            Stage(func=drop_short_words, n_workers=2,
+                  filter_collection=True),
+            CollectStage()
+        ]
+        collection = [
+            {'text': 'een zeer mooie stad'},
+            {'text': 'amsterdam is groot'}
+        ]
+        Pipeline(
+            stages=stages,
+            streaming=True,
+            fuse=False,
+            report_filepath=report_filepath).apply(collection=collection)
+
+        with open(report_filepath) as f:
+            report = json.load(f)
+        split, drop, collect = report['stages']
+
+        self.assertTrue(split['name'] == 'split_words')
+        self.assertTrue(split['items_out'] == 7)
+        self.assertTrue(split['flatten_ratio'] == 3.5)
+        self.assertTrue(drop['items_in'] == 7)
+        self.assertTrue(drop['items_out'] == 6)
+        self.assertTrue(drop['filter_ratio'] == 6 / 7)
+        self.assertTrue(drop['ipc_bytes_sent'] > 0)
+        self.assertTrue(drop['ipc_bytes_received'] > 0)
+        self.assertTrue(drop['worker_peak_rss_bytes'] > 0)
+        self.assertTrue(collect['items_in'] == 6)
+        self.assertTrue(all(
+            stage['wall_seconds'] is not None for stage in report['stages']))
+
+    def test_run_report_of_fused_stages(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        report_filepath = os.path.join(directory, 'report.json')
+
+        stages = [
+            Stage(func=split_words, n_workers=2, flatten=True),
+            Stage(func=drop_short_words, n_workers=2,
+                  filter_collection=True),
+            CollectStage()
+        ]
+        collection = [
+            {'text': 'een zeer mooie stad'},
+            {'text': 'amsterdam is groot'}
+        ]
+        pipeline = Pipeline(
+            stages=stages,
+            streaming=True,
+            report_filepath=report_filepath)
+        self.assertTrue(len(pipeline.fuse_stages(stages)) == 2)
+        pipeline.apply(collection=collection)
+
+        with open(report_filepath) as f:
+            report = json.load(f)
+        split, drop, collect = report['stages']
+
+        self.assertTrue(split['name'] == 'split_words')
+        self.assertTrue(split['items_in'] == 2)
+        self.assertTrue(split['items_out'] == 7)
+        self.assertTrue(split['flatten_ratio'] == 3.5)
+        self.assertTrue(split['ipc_bytes_sent'] > 0)
+        self.assertTrue(drop['name'] == 'drop_short_words')
+        self.assertTrue(drop['items_in'] == 7)
+        self.assertTrue(drop['items_out'] == 6)
+        self.assertTrue(drop['filter_ratio'] == 6 / 7)
+        self.assertTrue(drop['ipc_bytes_received'] > 0)
+        self.assertTrue(collect['items_in'] == 6)
+
+    def test_profiles_workers_by_stage(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        stages = [
+            Stage(func=count_up, n_workers=2),
+            Stage(func=increment, n_workers=1),
+            CollectStage()
+        ]
+        Pipeline(
+            stages=stages,
+            streaming=True,
+            profile_dirpath=directory,
+            profile_interval=0.001).apply(
+                collection=[{'value': i} for i in range(50)])
+
+        self.assertTrue('count_up.folded' in os.listdir(directory))
+        with open(os.path.join(directory, 'count_up.folded')) as f:
+            lines = f.read().splitlines()
+        self.assertTrue(lines)
+        self.assertTrue(all(
+            line.startswith('count_up (test_stage.py)') and
+            int(line.rsplit(' ', 1)[1]) > 0
+            for line in lines))
+
+    def test_profiles_fused_stages_by_function(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        profile_dirpath = os.path.join(directory, 'profile')
+
+        stages = [
+            Stage(func=increment, n_workers=2),
+            Stage(func=count_up, n_workers=2),
+            CollectStage()
+        ]
+        pipeline = Pipeline(
+            stages=stages,
+            streaming=True,
+            profile_dirpath=profile_dirpath,
+            profile_interval=0.001)
+        self.assertTrue(len(pipeline.fuse_stages(stages)) == 2)
+        pipeline.apply(collection=[{'value': i} for i in range(50)])
+
+        with open(os.path.join(profile_dirpath, 'count_up.folded')) as f:
+            lines = f.read().splitlines()
+        self.assertTrue(lines)
+        self.assertTrue(all(
+            line.startswith('count_up (test_stage.py)') for line in lines))
+
+    def test_no_profile_directory_without_samples(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        profile_dirpath = os.path.join(directory, 'profile')
+
+        Pipeline(
+            stages=[CollectStage()],
+            profile_dirpath=profile_dirpath).apply(collection=[1, 2])
+
+        self.assertTrue(not os.path.exists(profile_dirpath))
+
+    def test_profiles_workers_forked_after_sampling(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        # The thread stage starts a sampler in this process before the
+        # recycled workers of the next stage are forked
+        stages = [
+            Stage(func=increment, n_workers=2, executor='threads'),
+            Stage(func=count_up, n_workers=2, max_tasks_per_worker=1),
+            CollectStage()
+        ]
+        Pipeline(
+            stages=stages,
+            streaming=True,
+            fuse=False,
+            profile_dirpath=directory,
+            profile_interval=0.001).apply(
+                collection=[{'value': i} for i in range(20)])
+
+        with open(os.path.join(directory, 'count_up.folded')) as f:
+            self.assertTrue(f.read())
+
+    def test_parse_stage_workers(self):
+        self.assertTrue(parse_stage_workers(
+            ['apply_example_extraction=2', 'apply_compaction=8']) == {
+                'apply_example_extraction': 2,
+                'apply_compaction': 8
+            })
+        with self.assertRaises(ValueError):
+            parse_stage_workers(['apply_compaction'])
+
+    def test_last_stage_is_materialized(self):
+        stage = Stage(func=square_even, n_workers=2, filter_collection=True)
+        results = Pipeline(stages=[stage], streaming=True).apply(
+            collection=[{'value': i} for i in range(4)])
+        self.assertTrue(results == [{'value': 0}, {'value': 4}])
+
+
+class TestSaveIterableToJSONStage(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.directory, 'revisions.json')
+        self.collection = [
+            {'revision_id': str(i), 'text': f'Een stad {i}'}
+            for i in range(25)
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def load(self):
+        stage = LoadJSONFileStage(filepath=self.filepath)
+        return list(stage.apply(collection=None))
+
+    def test_writes_json_lines_from_iterator(self):
+        stage = SaveIterableToJSONStage(
+            filepath=self.filepath,
+            write_as_array=False,
+            fsync_every=10)
+        stage.apply(collection=iter(self.collection))
+
+        with open(self.filepath) as f:
+            self.assertTrue(len(f.readlines()) == 25)
+        self.assertTrue(self.load() == self.collection)
+
+    def test_writes_array_from_iterator(self):
+        stage = SaveIterableToJSONStage(filepath=self.filepath)
+        stage.apply(collection=iter(self.collection))
+
+        with open(self.filepath) as f:
+            self.assertTrue(f.read() == json.dumps(self.collection))
+        self.assertTrue(self.load() == self.collection)
+
+    def test_writes_empty_array(self):
+        stage = SaveIterableToJSONStage(filepath=self.filepath)
+        stage.apply(collection=iter([]))
+        self.assertTrue(self.load() == [])
+
+
+class TestLoadJSONFileStage(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.collection = [
+            {'revision_id': str(i), 'text': f'Een "stad", [{i}] é'}
+            for i in range(25)
+        ]
+
+        self.array_filepath = os.path.join(self.directory, 'array.json')
+        with open(self.array_filepath, 'w') as f:
+            json.dump(self.collection, f, indent=2)
+
+        self.lines_filepath = os.path.join(self.directory, 'lines.json')
+        with open(self.lines_filepath, 'w') as f:
+            for row in self.collection:
+                f.write(json.dumps(row) + '\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_iterate_json_array_across_chunks(self):
+        for chunk_size in [1, 7, 64, 1 << 20]:
+            with open(self.array_filepath) as f:
+                records = list(iterate_json_array(f, chunk_size=chunk_size))
+            self.assertTrue(records == self.collection)
+
+    def test_iterate_json_array_splits_scalars_across_chunks(self):
+        text = '  [1, 1.5e10, -0.25E-3, true, null, "een stad", 42]'
+        expected = [1, 1.5e10, -0.25E-3, True, None, 'een stad', 42]
+        for chunk_size in range(1, len(text) + 1):
+            records = list(iterate_json_array(
+                io.StringIO(text), chunk_size=chunk_size))
+            self.assertTrue(records == expected)
+
+    def test_iterate_invalid_json_array(self):
+        for text in ['[1.]', '[1 x, 2]', '[1, tru']:
+            with self.assertRaises(ValueError):
+                list(iterate_json_array(io.StringIO(text), chunk_size=2))
+
+    def test_iterate_truncated_json_array(self):
+        with open(self.array_filepath) as f:
+            text = f.read()
+        with open(self.array_filepath, 'w') as f:
+            f.write(text[:-10])
+
+        with open(self.array_filepath) as f:
+            with self.assertRaises(ValueError):
+                list(iterate_json_array(f, chunk_size=16))
+
+    def test_streams_both_formats(self):
+        for filepath in [self.array_filepath, self.lines_filepath]:
+            stage = LoadJSONFileStage(
+                filepath=filepath,
+                n_revisions=3,
+                select_fields=['revision_id'],
+                materialize=False)
+            records = stage.apply(collection=None)
+
+            self.assertTrue(hasattr(records, '__next__'))
+            self.assertTrue(list(records) == [
+                {'revision_id': '0'},
+                {'revision_id': '1'},
+                {'revision_id': '2'}
+            ])
+
+
+class TestLoadCSVFileStage(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.directory, 'comments.csv')
+        self.write_csv(self.filepath, range(10))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_csv(self, filepath, revision_ids):
+        with open(filepath, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['revision_id', 'comment'])
+            for i in revision_ids:
+                writer.writerow([str(i), f'npov, regel {i}'])
+
+    def test_streams_with_early_stop(self):
+        stage = LoadCSVFileStage(
+            filepath=self.filepath,
+            n_revisions=2,
+            select_fields=['revision_id'],
+            materialize=False)
+        rows = stage.apply(collection=None)
+
+        self.assertTrue(hasattr(rows, '__next__'))
+        self.assertTrue(list(rows) == [
+            {'revision_id': '0'},
+            {'revision_id': '1'}
+        ])
+
+    def test_tuple_rows(self):
+        stage = LoadCSVFileStage(
+            filepath=self.filepath,
+            select_fields=['comment', 'revision_id'],
+            row_type='tuple')
+        rows = stage.apply(collection=None)
+
+        self.assertTrue(len(rows) == 10)
+        self.assertTrue(rows[3] == ('npov, regel 3', '3'))
+
+    def test_missing_field(self):
+        stage = LoadCSVFileStage(
+            filepath=self.filepath,
+            select_fields=['page_id'])
+        with self.assertRaises(ValueError):
+            stage.apply(collection=None)
+
+    def test_spark_output_directory(self):
+        dirpath = os.path.join(self.directory, 'comments')
+        os.mkdir(dirpath)
+        self.write_csv(os.path.join(dirpath, 'part-00001-a.csv'), [3, 4])
+        self.write_csv(os.path.join(dirpath, 'part-00000-a.csv'), [1, 2])
+        open(os.path.join(dirpath, '_SUCCESS'), 'w').close()
+        open(os.path.join(dirpath, '.part-00000-a.csv.crc'), 'w').close()
+
+        stage = LoadCSVFileStage(filepath=dirpath)
+        rows = stage.apply(collection=None)
+
+        self.assertTrue(
+            [row['revision_id'] for row in rows] == ['1', '2', '3', '4'])
+        self.assertTrue(rows[0]['comment'] == 'npov, regel 1')